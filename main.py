@@ -1,11 +1,25 @@
 #Main.py
 import asyncio
+import bisect
+import concurrent.futures
+import contextvars
+import hashlib
+import heapq
 import httpx
 import json
 import os
 import sys
 import pickle
-from datetime import datetime, date, timedelta
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pydantic import BaseModel, Field
 from typing import Optional
 
@@ -31,6 +45,40 @@ MODELS_FALLBACK = [
     "openai/gpt-oss-120b",                    # GPT OSS (open source)
 ]
 
+
+def _modelos_env(nombre: str, default: list) -> list:
+    valor = os.environ.get(nombre, '')
+    return [m.strip() for m in valor.split(',') if m.strip()] or default
+
+
+# Perfiles por etapa: la clasificación (una palabra) va a modelos chicos y rápidos;
+# solo la extracción de JSON llega a los modelos pesados. Con ORGANIZADOR_MODO_COMBINADO=1
+# (por defecto) intención y datos salen en una sola llamada 'extraccion' y el perfil
+# 'clasificacion' solo se usa si esa respuesta no sirve; con 0 cada mensaje pasa primero por él
+PERFILES_LLM = {
+    "clasificacion": {
+        "modelos": _modelos_env('LLM_MODELOS_CLASIFICACION', [
+            "nvidia/nemotron-nano-12b-v2-vl:free",
+            "z-ai/glm-4.5-air:free",
+        ]),
+        "max_tokens": int(os.environ.get('LLM_MAX_TOKENS_CLASIFICACION', '64')),
+        "timeout": float(os.environ.get('LLM_TIMEOUT_CLASIFICACION', '10')),
+        "tiempo_max": float(os.environ.get('LLM_TIEMPO_MAX_CLASIFICACION', '60')),
+    },
+    "extraccion": {
+        "modelos": _modelos_env('LLM_MODELOS_EXTRACCION', MODELS_FALLBACK),
+        "max_tokens": int(os.environ.get('LLM_MAX_TOKENS_EXTRACCION', '512')),
+        "timeout": float(os.environ.get('LLM_TIMEOUT_EXTRACCION', '25')),
+        "tiempo_max": float(os.environ.get('LLM_TIEMPO_MAX_EXTRACCION', '180')),
+    },
+    "otro": {
+        "modelos": MODELS_FALLBACK,
+        "max_tokens": 512,
+        "timeout": 25.0,
+        "tiempo_max": 180.0,
+    },
+}
+
 SCOPES = [
     'https://www.googleapis.com/auth/calendar',
     'https://www.googleapis.com/auth/spreadsheets',
@@ -38,6 +86,55 @@ SCOPES = [
     'openid'  
 ]
 
+# Modo combinado: intención + extracción en una sola llamada (0 = flujo clásico de dos llamadas).
+# Esa llamada necesita el JSON completo, así que no usa streaming ni corte temprano: el corte
+# de OPENROUTER_STREAMING y el perfil 'clasificacion' solo corren con 0 o si la respuesta no sirve
+ORGANIZADOR_MODO_COMBINADO = os.environ.get('ORGANIZADOR_MODO_COMBINADO', '1') == '1'
+
+INTENCIONES_VALIDAS = ["PLANIFICAR", "PAGAR", "CONSULTA_FACTURA", "CONSULTA_DEUDAS", "CONSULTA_ESTADISTICAS"]
+
+# Mapeo de palabras clave a intenciones (se busca en la respuesta del clasificador)
+INTENT_KEYWORDS = {
+    "PLANIFICAR": ["PLANIFICAR", "CREAR", "REGISTRAR", "INGRESAR"],
+    "PAGAR": ["PAGAR", "PAGO", "ABONO"],
+    "CONSULTA_FACTURA": ["CONSULTA_FACTURA", "VER FACTURA", "INFO"],
+    "CONSULTA_DEUDAS": ["CONSULTA_DEUDAS", "DEUDAS", "DEBO"],
+    "CONSULTA_ESTADISTICAS": ["ESTADISTICAS", "STATS", "RESUMEN"]
+}
+
+# PLANNED: Calendar y Sheets a la vez; si falla el registro en Sheets se retira el recordatorio
+FANOUT_PARALELO = os.environ.get('FANOUT_PARALELO', '1') == '1'
+
+# Streaming del clasificador: se corta la respuesta apenas aparece una intención
+# (solo en el flujo de dos llamadas; ver ORGANIZADOR_MODO_COMBINADO)
+OPENROUTER_STREAMING = os.environ.get('OPENROUTER_STREAMING', '1') == '1'
+
+# Salida estructurada (JSON schema) para el modo combinado
+RESPUESTA_COMBINADA_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "intencion_y_datos",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "intent": {"type": "string", "enum": INTENCIONES_VALIDAS},
+                "numero_factura": {"type": ["string", "null"]},
+                "monto_total": {"type": "number"},
+                "monto_abono": {"type": "number"},
+                "dias_vencimiento": {"type": ["integer", "null"]},
+                "fecha_vencimiento": {"type": ["string", "null"]},
+                "cuota_especifica": {"type": ["integer", "null"]},
+            },
+            "required": [
+                "intent", "numero_factura", "monto_total", "monto_abono",
+                "dias_vencimiento", "fecha_vencimiento", "cuota_especifica"
+            ],
+            "additionalProperties": False,
+        },
+    },
+}
+
 CALENDAR_ID = 'primary'
 SPREADSHEET_ID = 'TU_ID_DE_HOJA_DE_CALCULO' 
 SHEETS_RANGE = 'Deuda Pendiente!A:H'
@@ -166,271 +263,3879 @@ def _normalize_sheet_date(value):
         except Exception: pass
     return None
 
-# En main.py, REEMPLAZA completamente la función call_openrouter() con esta:
+# --- Ledger compartido en memoria (Deuda Pendiente + Historial de Pagos) ---
+
+LEDGER_TTL = float(os.environ.get('LEDGER_TTL', '120'))  # segundos; cubre ediciones manuales en Sheets
+HISTORIAL_RANGE = 'Historial de Pagos!A:F'
+# 'Historial de Pagos' solo crece: se lee el delta A{n+1}:F y cada tanto se resincroniza completo
+HISTORIAL_DELTA = os.environ.get('HISTORIAL_DELTA', '1') == '1'
+HISTORIAL_RESYNC = float(os.environ.get('HISTORIAL_RESYNC', '1800'))  # segundos entre lecturas completas
+# Cuotas pagadas: se marcan PAGADA en su fila (lápida) y se compactan después en un solo batchUpdate
+CUOTAS_LAPIDA = os.environ.get('CUOTAS_LAPIDA', '1') == '1'
+ESTADO_LAPIDA = 'PAGADA'
+COMPACTACION_INACTIVIDAD = float(os.environ.get('COMPACTACION_INACTIVIDAD', '300'))  # segundos sin escrituras
+COMPACTACION_INTERVALO = float(os.environ.get('COMPACTACION_INTERVALO', '3600'))  # mínimo entre compactaciones
+# Antes de escribir sobre una fila se relee solo B:D de esa fila para detectar filas corridas a mano
+LEDGER_VERIFICAR_FILAS = os.environ.get('LEDGER_VERIFICAR_FILAS', '1') == '1'
+# Consultas de una sola factura: con el TTL vencido se releen solo sus filas (y lo nuevo al final)
+LECTURA_POR_FACTURA = os.environ.get('LECTURA_POR_FACTURA', '1') == '1'
+
+
+def _a_float(valor) -> float:
+    """Convierte un valor de celda a float; vacíos o ilegibles cuentan como 0."""
+    if valor is None or valor == '':
+        return 0.0
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(str(valor).replace('$', '').replace(',', '').strip())
+    except ValueError:
+        return 0.0
+
+
+def _celda(row: list, idx: int):
+    return row[idx] if idx < len(row) else ''
+
+
+def _fila_inicial_de_rango(rango: str | None) -> int | None:
+    """Extrae la primera fila de un rango A1 como "'Deuda Pendiente'!A5:H6"."""
+    if not rango:
+        return None
+    match = re.search(r'!\$?[A-Z]+\$?(\d+)', rango)
+    return int(match.group(1)) if match else None
+
 
-async def call_openrouter(system_prompt: str, user_prompt: str) -> str:
+_lecturas_stats = {"llamadas": 0, "rangos": 0, "reintentos_sin_opcionales": 0}
+
+
+def leer_rangos(sheets_service, rangos: list, opcionales: tuple = (), spreadsheet_id: str | None = None, **opciones) -> dict:
     """
-    Llama a OpenRouter con reintentos agresivos y delays progresivos.
-    Persiste hasta 3 minutos intentando obtener respuesta.
+    Lee varios rangos en una sola llamada values().batchGet y devuelve {rango: filas}.
+    Si falla y hay rangos opcionales (p. ej. una pestaña que puede no existir), se
+    reintenta sin ellos y esos rangos vuelven como lista vacía.
     """
-    
-    # 🔥 Modelos priorizados por disponibilidad
-    MODELS_PRIORITY = MODELS_FALLBACK
-    
-    payload_base = {
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.0,
-        "max_tokens": 512,
-    }
-    
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": YOUR_SITE_URL,
-        "X-Title": YOUR_SITE_NAME,
-    }
-    
-    start_time = asyncio.get_event_loop().time()
-    max_total_time = 180  # 3 minutos
-    
-    modelo_actual_idx = 0
-    intento_global = 0
-    
-    while (asyncio.get_event_loop().time() - start_time) < max_total_time:
-        intento_global += 1
-        
-        model_name = MODELS_PRIORITY[modelo_actual_idx % len(MODELS_PRIORITY)]
-        payload = {**payload_base, "model": model_name}
-        
-        if intento_global > 1:
-            delay = min(intento_global * 2, 30)
-            print(f"⏳ Esperando {delay}s antes de reintentar (intento {intento_global})...")
-            await asyncio.sleep(delay)
-        
-        try:
-            async with httpx.AsyncClient(timeout=25.0) as client:
-                response = await client.post(
-                    OPENROUTER_URL,
-                    headers=headers,
-                    json=payload
-                )
-            
-            if not response.content:
-                print(f"⚠️ {model_name}: Respuesta vacía")
-                modelo_actual_idx += 1
-                continue
-            
-            if response.status_code == 429:
-                print(f"⚠️ {model_name}: Rate limit, probando otro modelo...")
-                modelo_actual_idx += 1
-                continue
-            
-            if response.status_code == 404:
-                print(f"⚠️ {model_name}: No disponible")
-                modelo_actual_idx += 1
-                continue
-            
-            if response.status_code == 401:
-                return "ERROR: API Key inválida"
-            
-            if response.status_code == 503:
-                print(f"⚠️ {model_name}: Servicio no disponible")
-                continue
-            
-            if response.status_code != 200:
-                print(f"⚠️ {model_name}: HTTP {response.status_code}")
-                modelo_actual_idx += 1
-                continue
-            
-            try:
-                response_data = response.json()
-            except json.JSONDecodeError:
-                print(f"⚠️ {model_name}: JSON inválido")
-                modelo_actual_idx += 1
-                continue
-            
-            if 'choices' not in response_data or not response_data['choices']:
-                error_msg = response_data.get('error', {}).get('message', 'Sin detalles')
-                print(f"⚠️ {model_name}: {error_msg}")
-                modelo_actual_idx += 1
-                continue
-            
-            result = response_data['choices'][0]['message']['content'].strip()
-            
-            if intento_global > 1:
-                print(f"✅ Éxito con {model_name} (intento {intento_global})")
-            
-            return result
-            
-        except httpx.TimeoutException:
-            print(f"⏱️ {model_name}: Timeout")
-            continue
-        
-        except httpx.RequestError:
-            print(f"⚠️ {model_name}: Error de red")
-            await asyncio.sleep(5)
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    rangos = list(rangos)
+    try:
+        result = sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id, ranges=rangos, **opciones
+        ).execute()
+    except HttpError as e:
+        requeridos = [r for r in rangos if r not in opcionales]
+        if len(requeridos) == len(rangos) or not requeridos:
+            raise
+        print(f"⚠️ No se pudieron leer {[r for r in rangos if r in opcionales]}: {e}")
+        _lecturas_stats["reintentos_sin_opcionales"] += 1
+        leidos = leer_rangos(sheets_service, requeridos, spreadsheet_id=spreadsheet_id, **opciones)
+        return {r: leidos.get(r, []) for r in rangos}
+    _lecturas_stats["llamadas"] += 1
+    _lecturas_stats["rangos"] += len(rangos)
+    # valueRanges llega en el mismo orden que ranges
+    value_ranges = result.get('valueRanges', [])
+    return {r: (value_ranges[i].get('values', []) if i < len(value_ranges) else []) for i, r in enumerate(rangos)}
+
+
+def obtener_estadisticas_lecturas() -> dict:
+    return dict(_lecturas_stats)
+
+
+# --- Lectura tipada: números sin formato y fechas como serial, sin parsear texto ---
+
+SHEETS_LECTURA_TIPADA = os.environ.get('SHEETS_LECTURA_TIPADA', '1') == '1'
+OPCIONES_LECTURA_TIPADA = {'valueRenderOption': 'UNFORMATTED_VALUE', 'dateTimeRenderOption': 'SERIAL_NUMBER'}
+_ORDINAL_SERIAL_0 = date(1899, 12, 30).toordinal()
+_iso_por_ordinal = {}
+
+
+def _opciones_lectura() -> dict:
+    return OPCIONES_LECTURA_TIPADA if SHEETS_LECTURA_TIPADA else {}
+
+
+def _iso_de_ordinal(ordinal: int) -> str:
+    # Pocas fechas distintas por hoja: se formatea cada una una sola vez
+    iso = _iso_por_ordinal.get(ordinal)
+    if iso is None:
+        iso = _iso_por_ordinal[ordinal] = date.fromordinal(ordinal).isoformat()
+    return iso
+
+
+def _ordinal_de_celda(valor) -> int | None:
+    """Serial de Sheets -> ordinal de fecha. Si la celda quedó como texto, usa el parser de siempre."""
+    tipo = type(valor)
+    if tipo is int or tipo is float:
+        return _ORDINAL_SERIAL_0 + int(valor)
+    if valor == '' or valor is None:
+        return None
+    iso = _normalize_sheet_date(valor)
+    return date.fromisoformat(iso).toordinal() if iso else None
+
+
+def _monto_tipado(valor):
+    """int si el monto es entero (lo normal en COP), float si tiene decimales."""
+    tipo = type(valor)
+    if tipo is int:
+        return valor
+    if tipo is float:
+        return int(valor) if valor.is_integer() else valor
+    return _a_float(valor)
+
+
+def _texto_celda(valor) -> str:
+    """IDs que Sheets devuelve como número (p. ej. 123) vuelven a texto sin '.0'."""
+    if type(valor) is float and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _fecha_hora_de_celda(valor) -> str:
+    if type(valor) is int or type(valor) is float:
+        dias = int(valor)
+        segundos = round((valor - dias) * 86400)
+        momento = datetime.fromordinal(_ORDINAL_SERIAL_0 + dias) + timedelta(seconds=segundos)
+        return momento.strftime('%Y-%m-%d %H:%M:%S')
+    return str(valor)
+
+
+def decodificar_deuda(values: list, primera_fila: int = 1) -> list:
+    """
+    Decodifica en bloque filas de 'Deuda Pendiente' leídas con OPCIONES_LECTURA_TIPADA.
+    primera_fila es la fila de la hoja de values[0]; si es 1, se salta el encabezado.
+    """
+    cuotas = []
+    nueva = CuotaRegistro
+    for i, row in enumerate(values):
+        fila = primera_fila + i
+        n = len(row)
+        if fila == 1 or n <= 1:
             continue
-        
-        except Exception as e:
-            print(f"⚠️ {model_name}: {type(e).__name__}")
-            modelo_actual_idx += 1
+        if n < 8:
+            row = row + [''] * (8 - n)
+        ordinal_venc = _ordinal_de_celda(row[5])
+        ordinal_reg = _ordinal_de_celda(row[0])
+        venc_iso = _iso_de_ordinal(ordinal_venc) if ordinal_venc is not None else None
+        cuotas.append(nueva(
+            fila=fila,
+            fecha_registro=_iso_de_ordinal(ordinal_reg) if ordinal_reg is not None else str(row[0]),
+            cuota_id=_texto_celda(row[1]),
+            monto_total=_monto_tipado(row[2]),
+            monto_pendiente=_monto_tipado(row[3]),
+            monto_cuota=_monto_tipado(row[4]),
+            fecha_vencimiento_raw=venc_iso if venc_iso is not None else row[5],
+            fecha_vencimiento=venc_iso,
+            tipo_pago=str(row[6]),
+            estado=str(row[7]).strip(),
+            columnas=n,
+            fecha_vencimiento_ordinal=ordinal_venc,
+        ))
+    return cuotas
+
+
+def decodificar_historial(values: list, primera_fila: int = 1) -> list:
+    """Como decodificar_deuda, para 'Historial de Pagos'."""
+    movimientos = []
+    for i, row in enumerate(values):
+        fila = primera_fila + i
+        n = len(row)
+        if fila == 1 or n <= 1:
             continue
-    
-    elapsed = int(asyncio.get_event_loop().time() - start_time)
-    print(f"\n❌ No se pudo obtener respuesta después de {elapsed}s y {intento_global} intentos")
-    
-    return "ERROR: Los servicios de IA están sobrecargados. Intenta en 5-10 minutos."
-    
+        if n < 6:
+            row = row + [''] * (6 - n)
+        movimientos.append(MovimientoHistorial(
+            fila=fila,
+            fecha_hora=_fecha_hora_de_celda(row[0]),
+            cuota_id=_texto_celda(row[1]),
+            tipo_transaccion=str(row[2]),
+            monto_pagado=_monto_tipado(row[3]),
+            saldo_restante=_monto_tipado(row[4]),
+            observaciones=str(row[5]),
+            columnas=n,
+        ))
+    return movimientos
 
-# --- 4. DEFINICIÓN DE AGENTES ---
 
-@default_subscription
-class Consultor(RoutedAgent):
-    """Agente que maneja consultas de información: facturas específicas, deudas y estadísticas."""
-    
-    def __init__(self, sheets_service) -> None:
-        super().__init__("Consultor de información.")
-        self.sheets_service = sheets_service
-    
-    def _obtener_info_factura(self, factura_id: str) -> dict:
-        """Obtiene información detallada de una factura específica."""
-        try:
-            # Obtener cuotas PENDIENTES
-            result_pendientes = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, 
-                range='Deuda Pendiente!A:H'
-            ).execute()
-            
-            values_pendientes = result_pendientes.get('values', [])
-            cuotas_pendientes = []
-            monto_total = 0
-            
-            # Procesar cuotas pendientes
-            for i, row in enumerate(values_pendientes):
-                if i == 0: continue
-                if len(row) >= 8:
-                    cuota_id = str(row[1]).strip()
-                    if cuota_id.startswith(f"{factura_id}-"):
-                        monto_total = float(row[2]) if row[2] else 0  # Monto total de la factura
-                        cuotas_pendientes.append({
-                            'cuota_id': cuota_id,
-                            'monto_pendiente': float(row[3]) if row[3] else 0,
-                        })
-            
-            # 🔥 Obtener cuotas PAGADAS del historial
-            cuotas_pagadas = []
-            try:
-                result_historial = self.sheets_service.spreadsheets().values().get(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range='Historial de Pagos!A:F'
-                ).execute()
-                
-                values_historial = result_historial.get('values', [])
-                cuotas_pagadas_ids = set()
-                
-                for i, row in enumerate(values_historial):
-                    if i == 0: continue
-                    if len(row) >= 5:
-                        cuota_id = str(row[1]).strip()
-                        tipo_transaccion = row[2]
-                        saldo_restante = float(row[4]) if row[4] else 0
-                        
-                        # Si es "Pago Completo" y saldo es 0, la cuota está pagada
-                        if cuota_id.startswith(f"{factura_id}-") and tipo_transaccion == "Pago Completo" and saldo_restante == 0:
-                            cuotas_pagadas_ids.add(cuota_id)
-                
-                cuotas_pagadas = list(cuotas_pagadas_ids)
-            
-            except Exception as e:
-                print(f"⚠️ No se pudo obtener historial de pagos: {e}")
-            
-            # Calcular totales
-            total_pendiente = sum(c['monto_pendiente'] for c in cuotas_pendientes)
-            total_pagado = monto_total - total_pendiente if monto_total > 0 else 0
-            
-            num_cuotas_pagadas = len(cuotas_pagadas)
-            num_cuotas_pendientes = len(cuotas_pendientes)
-            total_cuotas = num_cuotas_pagadas + num_cuotas_pendientes
-            
-            return {
-                'existe': total_cuotas > 0,
-                'monto_total': monto_total,
-                'total_pendiente': total_pendiente,
-                'total_pagado': total_pagado,
-                'num_cuotas_total': total_cuotas,
-                'num_cuotas_pagadas': num_cuotas_pagadas,
-                'num_cuotas_pendientes': num_cuotas_pendientes,
-            }
-        except Exception as e:
-            return {'existe': False, 'error': str(e)}
-    
-    def _obtener_deudas_pendientes(self) -> list:
-        """Obtiene todas las deudas pendientes."""
-        try:
-            result = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, 
-                range=SHEETS_RANGE
+def benchmark_lectura_tipada(n: int = 100_000, repeticiones: int = 3) -> dict:
+    """
+    Microbenchmark: decodifica n filas sintéticas de 'Deuda Pendiente' por el camino
+    formateado (float() + _normalize_sheet_date por celda) y por el tipado (números y
+    seriales). Devuelve el mejor tiempo de cada uno en segundos.
+    """
+    base = date(2026, 1, 1)
+    encabezado = ['Fecha Registro', 'Factura ID', 'Monto Total', 'Monto Pendiente',
+                  'Monto Cuota', 'Fecha Vencimiento', 'Tipo Pago', 'Estado']
+    formateadas, tipadas = [encabezado], [encabezado]
+    for i in range(n):
+        venc = base + timedelta(days=i % 365)
+        monto = 100_000 + (i % 97) * 1_000
+        # Lo que devuelve FORMATTED_VALUE en una hoja con configuración regional es-CO
+        formateadas.append([base.strftime('%d/%m/%Y'), f"{1000 + i // 3}-{i % 3 + 1}", f"{monto * 3:,}",
+                            f"{monto:,}", f"{monto:,}", venc.strftime('%d/%m/%Y'), 'Fraccionado', 'PENDIENTE'])
+        tipadas.append([(base - date(1899, 12, 30)).days, f"{1000 + i // 3}-{i % 3 + 1}", monto * 3,
+                        monto, monto, (venc - date(1899, 12, 30)).days, 'Fraccionado', 'PENDIENTE'])
+
+    def _medir(fn):
+        mejor = None
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            fn()
+            transcurrido = time.perf_counter() - inicio
+            mejor = transcurrido if mejor is None else min(mejor, transcurrido)
+        return mejor
+
+    formateado = _medir(lambda: [CuotaRegistro.desde_fila(i + 1, row)
+                                 for i, row in enumerate(formateadas) if i > 0 and len(row) > 1])
+    _iso_por_ordinal.clear()
+    tipado = _medir(lambda: decodificar_deuda(tipadas))
+    a = CuotaRegistro.desde_fila(2, formateadas[1])
+    b = decodificar_deuda(tipadas[:2])[0]
+    assert (a.cuota_id, a.fecha_vencimiento, a.monto_pendiente) == (b.cuota_id, b.fecha_vencimiento, b.monto_pendiente)
+    return {"filas": n, "formateado_s": round(formateado, 4), "tipado_s": round(tipado, 4),
+            "aceleracion": round(formateado / tipado, 1) if tipado else None}
+
+
+def _decodificar(values: list, primera_fila: int, tipado_fn, clase) -> list:
+    """Lectura tipada en bloque o, con SHEETS_LECTURA_TIPADA=0, el camino de texto formateado."""
+    if SHEETS_LECTURA_TIPADA:
+        return tipado_fn(values, primera_fila)
+    return [
+        clase.desde_fila(primera_fila + i, row)
+        for i, row in enumerate(values) if primera_fila + i > 1 and len(row) > 1
+    ]
+
+
+@dataclass
+class CuotaRegistro:
+    """Fila de 'Deuda Pendiente'."""
+    fila: int
+    fecha_registro: str
+    cuota_id: str
+    monto_total: float
+    monto_pendiente: float
+    monto_cuota: float
+    fecha_vencimiento_raw: object
+    fecha_vencimiento: str | None
+    tipo_pago: str
+    estado: str
+    columnas: int = 8
+    fecha_vencimiento_ordinal: int | None = None
+
+    @classmethod
+    def desde_fila(cls, fila: int, row: list) -> "CuotaRegistro":
+        fecha_vencimiento = _normalize_sheet_date(_celda(row, 5)) if _celda(row, 5) != '' else None
+        return cls(
+            fila=fila,
+            fecha_registro=str(_celda(row, 0)),
+            cuota_id=str(_celda(row, 1)).strip(),
+            monto_total=_a_float(_celda(row, 2)),
+            monto_pendiente=_a_float(_celda(row, 3)),
+            monto_cuota=_a_float(_celda(row, 4)),
+            fecha_vencimiento_raw=_celda(row, 5),
+            fecha_vencimiento=fecha_vencimiento,
+            tipo_pago=str(_celda(row, 6)),
+            estado=str(_celda(row, 7)).strip(),
+            columnas=len(row),
+            fecha_vencimiento_ordinal=date.fromisoformat(fecha_vencimiento).toordinal() if fecha_vencimiento else None,
+        )
+
+    def como_fila(self) -> list:
+        return [self.fecha_registro, self.cuota_id, self.monto_total, self.monto_pendiente,
+                self.monto_cuota, self.fecha_vencimiento_raw, self.tipo_pago, self.estado]
+
+
+@dataclass
+class MovimientoHistorial:
+    """Fila de 'Historial de Pagos'."""
+    fila: int
+    fecha_hora: str
+    cuota_id: str
+    tipo_transaccion: str
+    monto_pagado: float
+    saldo_restante: float
+    observaciones: str
+    columnas: int = 6
+
+    @classmethod
+    def desde_fila(cls, fila: int, row: list) -> "MovimientoHistorial":
+        return cls(
+            fila=fila,
+            fecha_hora=str(_celda(row, 0)),
+            cuota_id=str(_celda(row, 1)).strip(),
+            tipo_transaccion=str(_celda(row, 2)),
+            monto_pagado=_a_float(_celda(row, 3)),
+            saldo_restante=_a_float(_celda(row, 4)),
+            observaciones=str(_celda(row, 5)),
+            columnas=len(row),
+        )
+
+
+class LedgerCache:
+    """
+    Copia en memoria de las dos pestañas de un Spreadsheet, compartida por todos los agentes.
+    Se carga una vez, nuestras escrituras la actualizan en el lugar y se recarga por TTL
+    (o con invalidar()) para recoger ediciones hechas a mano en Sheets.
+    """
+
+    def __init__(self, spreadsheet_id: str, ttl: float = LEDGER_TTL) -> None:
+        self.spreadsheet_id = spreadsheet_id
+        self.ttl = ttl
+        self.pendientes: list[CuotaRegistro] = []
+        self.historial: list[MovimientoHistorial] = []
+        self.version = 0
+        self._cargado_en = None
+        # Delta del historial: última fila consumida (encabezado incluido) y agregados acumulados
+        self._ultima_fila_historial = 0
+        self._historial_completo_en = None
+        self._total_pagado = 0.0
+        self._num_transacciones = 0
+        self._pagadas_por_factura: dict[str, set] = {}
+        self._lock = threading.RLock()
+        # Índices: ID de cuota -> registro, y factura base -> cuotas en orden de fila
+        self._por_cuota: dict[str, CuotaRegistro] = {}
+        self._por_factura: dict[str, list[CuotaRegistro]] = {}
+        self.stats = {"cargas": 0, "lecturas_api": 0, "hits": 0, "escrituras_locales": 0,
+                      "verificaciones": 0, "filas_desalineadas": 0,
+                      "historial_completo": 0, "historial_delta": 0, "filas_historial_delta": 0,
+                      "compactaciones": 0, "filas_compactadas": 0,
+                      "lecturas_factura": 0, "filas_factura": 0, "factura_a_completa": 0}
+
+    # -- carga --
+
+    def vencido(self) -> bool:
+        return self._cargado_en is None or (time.monotonic() - self._cargado_en) > self.ttl
+
+    def asegurar(self, sheets_service) -> "LedgerCache":
+        """Carga las pestañas si no están en memoria o venció el TTL."""
+        with self._lock:
+            if self.vencido():
+                self.recargar(sheets_service)
+            else:
+                self.stats["hits"] += 1
+        return self
+
+    def _historial_por_delta(self) -> bool:
+        return (HISTORIAL_DELTA and self._historial_completo_en is not None
+                and (time.monotonic() - self._historial_completo_en) <= HISTORIAL_RESYNC)
+
+    def recargar(self, sheets_service) -> None:
+        with self._lock:
+            delta = self._historial_por_delta()
+            rango_historial = (f'Historial de Pagos!A{self._ultima_fila_historial + 1}:F'
+                               if delta else HISTORIAL_RANGE)
+            # Ambas pestañas en una sola ida a la API; el historial es opcional
+            leidos = leer_rangos(
+                sheets_service, [SHEETS_RANGE, rango_historial],
+                opcionales=(rango_historial,), spreadsheet_id=self.spreadsheet_id, **_opciones_lectura()
+            )
+            self.stats["lecturas_api"] += 1
+            self.pendientes = _decodificar(leidos[SHEETS_RANGE], 1, decodificar_deuda, CuotaRegistro)
+            self._reindexar()
+
+            filas_historial = leidos[rango_historial]
+            if delta:
+                self._sumar_delta_historial(filas_historial)
+            else:
+                self._reiniciar_historial()
+                for mov in _decodificar(filas_historial, 1, decodificar_historial, MovimientoHistorial):
+                    self._sumar_movimiento(mov)
+                self._ultima_fila_historial = len(filas_historial)
+                self._historial_completo_en = time.monotonic()
+                self.stats["historial_completo"] += 1
+
+            self._cargado_en = time.monotonic()
+            self.version += 1
+            self.stats["cargas"] += 1
+
+    def _sumar_delta_historial(self, filas: list) -> None:
+        primera = self._ultima_fila_historial + 1
+        for mov in _decodificar(filas, primera, decodificar_historial, MovimientoHistorial):
+            self._sumar_movimiento(mov)
+        self._ultima_fila_historial += len(filas)
+        self.stats["historial_delta"] += 1
+        self.stats["filas_historial_delta"] += len(filas)
+
+    @staticmethod
+    def _tramos(filas: list) -> list:
+        """Agrupa números de fila ordenados en tramos contiguos (primera, última)."""
+        tramos = []
+        for fila in filas:
+            if tramos and tramos[-1][1] == fila - 1:
+                tramos[-1] = (tramos[-1][0], fila)
+            else:
+                tramos.append((fila, fila))
+        return tramos
+
+    def asegurar_factura(self, sheets_service, factura_id: str) -> "LedgerCache":
+        """
+        Como asegurar(), pero si solo venció el TTL relee únicamente las filas que el índice
+        conoce de la factura, más lo agregado al final de ambas pestañas, en un solo batchGet.
+        El costo depende del tamaño de la factura y no del ledger. Si una fila ya no trae la
+        cuota esperada (filas corridas a mano), cae en la recarga completa.
+        """
+        with self._lock:
+            if not self.vencido():
+                self.stats["hits"] += 1
+                return self
+            if not LECTURA_POR_FACTURA or self._cargado_en is None or not self._historial_por_delta():
+                return self.asegurar(sheets_service)
+
+            cuotas = list(self._por_factura.get(factura_id, []))
+            tramos = self._tramos([c.fila for c in cuotas])
+            ultima_deuda = self.pendientes[-1].fila if self.pendientes else 1
+            rangos = [f'Deuda Pendiente!A{a}:H{b}' for a, b in tramos]
+            cola_deuda = f'Deuda Pendiente!A{ultima_deuda + 1}:H'
+            cola_historial = f'Historial de Pagos!A{self._ultima_fila_historial + 1}:F'
+            leidos = leer_rangos(
+                sheets_service, rangos + [cola_deuda, cola_historial], opcionales=(cola_historial,),
+                spreadsheet_id=self.spreadsheet_id, **_opciones_lectura()
+            )
+            self.stats["lecturas_api"] += 1
+            self.stats["lecturas_factura"] += 1
+
+            frescas = {}
+            for (a, _b), rango in zip(tramos, rangos):
+                for c in _decodificar(leidos[rango], a, decodificar_deuda, CuotaRegistro):
+                    frescas[c.fila] = c
+            self.stats["filas_factura"] += len(frescas)
+            if any(frescas.get(c.fila) is None or frescas[c.fila].cuota_id != c.cuota_id for c in cuotas):
+                self.stats["filas_desalineadas"] += 1
+                self.stats["factura_a_completa"] += 1
+                print(f"🔄 Las filas de la factura {factura_id} se movieron en la hoja; recargando ledger...")
+                self.recargar(sheets_service)
+                return self
+
+            # Mismas cuotas en las mismas filas: se reemplazan por su versión fresca
+            for c in cuotas:
+                self._desindexar(c)
+            for c in cuotas:
+                nueva = frescas[c.fila]
+                self.pendientes[self._posicion(c.fila)] = nueva
+                self._indexar(nueva)
+            nuevas = _decodificar(leidos[cola_deuda], ultima_deuda + 1, decodificar_deuda, CuotaRegistro)
+            self.pendientes.extend(nuevas)
+            for c in nuevas:
+                self._indexar(c)
+            self._sumar_delta_historial(leidos[cola_historial])
+            self.version += 1
+        return self
+
+    def invalidar(self, resincronizar: bool = False) -> None:
+        """Fuerza recarga en el próximo acceso; con resincronizar=True, también del historial completo."""
+        with self._lock:
+            self._cargado_en = None
+            if resincronizar:
+                self._historial_completo_en = None
+
+    # -- historial y agregados --
+
+    def _reiniciar_historial(self) -> None:
+        self.historial = []
+        self._total_pagado = 0.0
+        self._num_transacciones = 0
+        self._pagadas_por_factura = {}
+
+    def _sumar_movimiento(self, mov: MovimientoHistorial) -> None:
+        self.historial.append(mov)
+        if mov.columnas >= 4:
+            self._total_pagado += mov.monto_pagado
+            self._num_transacciones += 1
+        if mov.columnas >= 5 and mov.tipo_transaccion == "Pago Completo" and mov.saldo_restante == 0:
+            self._pagadas_por_factura.setdefault(self._factura_base(mov.cuota_id), set()).add(mov.cuota_id)
+
+    def siguiente_fila_historial(self) -> int | None:
+        """Fila donde caerá el próximo append al historial, si ya se leyó alguna vez."""
+        return self._ultima_fila_historial + 1 if self._historial_completo_en is not None else None
+
+    def totales_historial(self) -> dict:
+        return {"total_pagado": self._total_pagado, "num_transacciones": self._num_transacciones}
+
+    def cuotas_pagadas_de_factura(self, factura_id: str) -> list:
+        return list(self._pagadas_por_factura.get(factura_id, ()))
+
+    # -- índice cuota -> fila --
+
+    @staticmethod
+    def _factura_base(cuota_id: str) -> str:
+        return cuota_id.rsplit('-', 1)[0] if '-' in cuota_id else cuota_id
+
+    def _reindexar(self) -> None:
+        self._por_cuota = {}
+        self._por_factura = {}
+        for c in self.pendientes:
+            self._indexar(c)
+
+    def _indexar(self, c: CuotaRegistro) -> None:
+        # Las lápidas siguen ocupando su fila pero no existen para las consultas
+        if c.columnas <= 7 or not c.cuota_id or c.estado == ESTADO_LAPIDA:
+            return
+        # Igual que el escaneo lineal: ante IDs repetidos gana la primera fila
+        self._por_cuota.setdefault(c.cuota_id, c)
+        if '-' in c.cuota_id:
+            self._por_factura.setdefault(self._factura_base(c.cuota_id), []).append(c)
+
+    def _desindexar(self, c: CuotaRegistro) -> None:
+        if self._por_cuota.get(c.cuota_id) is c:
+            del self._por_cuota[c.cuota_id]
+            # Si había otra fila con el mismo ID, pasa a ser la vigente
+            for otra in self.pendientes:
+                if otra is not c and otra.cuota_id == c.cuota_id and otra.columnas > 7 and otra.estado != ESTADO_LAPIDA:
+                    self._por_cuota[c.cuota_id] = otra
+                    break
+        base = self._factura_base(c.cuota_id)
+        cuotas = self._por_factura.get(base)
+        if cuotas is not None:
+            cuotas[:] = [x for x in cuotas if x is not c]
+            if not cuotas:
+                del self._por_factura[base]
+
+    def fila_de(self, cuota_id: str) -> int | None:
+        c = self._por_cuota.get(cuota_id)
+        return c.fila if c else None
+
+    def verificar_fila(self, sheets_service, cuota: CuotaRegistro) -> bool:
+        """
+        Relee solo B:D de la fila indexada y confirma que sigue siendo la misma cuota con
+        el mismo saldo. Si no coincide (edición manual), recarga el ledger completo.
+        """
+        with self._lock:
+            self.stats["verificaciones"] += 1
+            rango = f'Deuda Pendiente!B{cuota.fila}:D{cuota.fila}'
+            filas = leer_rangos(sheets_service, [rango], spreadsheet_id=self.spreadsheet_id, **_opciones_lectura())[rango]
+            self.stats["lecturas_api"] += 1
+            row = filas[0] if filas else []
+            if (_texto_celda(_celda(row, 0)) == cuota.cuota_id
+                    and abs(_a_float(_celda(row, 2)) - cuota.monto_pendiente) < 0.005):
+                return True
+            self.stats["filas_desalineadas"] += 1
+            print(f"🔄 La fila {cuota.fila} ya no corresponde a {cuota.cuota_id}; recargando ledger...")
+            self.recargar(sheets_service)
+            return False
+
+    # -- consultas --
+
+    def cuotas_de_factura(self, factura_id: str) -> list:
+        prefijo = f"{factura_id}-"
+        return [c for c in self.pendientes
+                if c.columnas >= 8 and c.estado != ESTADO_LAPIDA and c.cuota_id.startswith(prefijo)]
+
+    def cuotas_pendientes(self) -> list:
+        return [c for c in self.pendientes if c.columnas >= 8 and c.estado == 'PENDIENTE']
+
+    def historial_de_factura(self, factura_id: str) -> list:
+        prefijo = f"{factura_id}-"
+        return [m for m in self.historial if m.cuota_id.startswith(prefijo)]
+
+    def buscar_cuota(self, factura_id: str):
+        """Misma regla que Registrador._find_factura_row: ID exacto o primera cuota PENDIENTE."""
+        exacta = self._por_cuota.get(factura_id)
+        pendiente = next(
+            (c for c in self._por_factura.get(factura_id, []) if c.estado == "PENDIENTE"), None
+        )
+        if exacta and pendiente:
+            return exacta if exacta.fila <= pendiente.fila else pendiente
+        return exacta or pendiente
+
+    def fechas_ocupadas(self) -> dict:
+        fechas_count = {}
+        for c in self.pendientes:
+            if c.fecha_vencimiento and c.estado != ESTADO_LAPIDA:
+                fechas_count[c.fecha_vencimiento] = fechas_count.get(c.fecha_vencimiento, 0) + 1
+        return fechas_count
+
+    # -- escrituras propias (actualizan la copia en el lugar) --
+
+    def agregar_cuotas(self, rows: list, fila_inicial: int | None) -> None:
+        with self._lock:
+            if fila_inicial is None:
+                self.invalidar()
+                return
+            nuevas = [CuotaRegistro.desde_fila(fila_inicial + offset, row) for offset, row in enumerate(rows)]
+            if self.pendientes and self.pendientes[-1].fila >= fila_inicial:
+                # El append no cayó al final de lo que conocemos: más seguro recargar
+                self.invalidar()
+                return
+            self.pendientes.extend(nuevas)
+            for c in nuevas:
+                self._indexar(c)
+            self._tocar()
+
+    def _posicion(self, fila: int) -> int | None:
+        """Índice en self.pendientes de la fila dada (la lista está ordenada por fila)."""
+        i = bisect.bisect_left(self.pendientes, fila, key=lambda c: c.fila)
+        if i < len(self.pendientes) and self.pendientes[i].fila == fila:
+            return i
+        return None
+
+    def actualizar_monto_pendiente(self, fila: int, monto_pendiente: float) -> None:
+        with self._lock:
+            i = self._posicion(fila)
+            if i is None:
+                self.invalidar()
+                return
+            self.pendientes[i].monto_pendiente = monto_pendiente
+            self._tocar()
+
+    def actualizar_estado(self, fila: int, estado: str) -> None:
+        """Refleja el cambio de la columna Estado; marcar PAGADA deja la fila como lápida."""
+        with self._lock:
+            i = self._posicion(fila)
+            if i is None:
+                self.invalidar()
+                return
+            cuota = self.pendientes[i]
+            if estado == ESTADO_LAPIDA:
+                self._desindexar(cuota)
+            cuota.estado = estado
+            self._tocar()
+
+    def lapidas(self) -> list:
+        return [c.fila for c in self.pendientes if c.estado == ESTADO_LAPIDA]
+
+    def compactar(self, sheets_service, sheet_id: int) -> int:
+        """
+        Borra todas las filas lápida en un solo batchUpdate (rangos contiguos agrupados, de
+        abajo hacia arriba). Relee la hoja antes para no borrar filas editadas a mano.
+        """
+        with self._lock:
+            self.recargar(sheets_service)
+            filas = sorted(self.lapidas(), reverse=True)
+            if not filas:
+                return 0
+            rangos = []  # (primera, última) en base 1, de abajo hacia arriba
+            for fila in filas:
+                if rangos and rangos[-1][0] == fila + 1:
+                    rangos[-1] = (fila, rangos[-1][1])
+                else:
+                    rangos.append((fila, fila))
+            sheets_service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': [
+                    {'deleteDimension': {'range': {
+                        'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': primera - 1, 'endIndex': ultima
+                    }}}
+                    for primera, ultima in rangos
+                ]}
             ).execute()
-            
-            values = result.get('values', [])
-            deudas = []
-            
-            for i, row in enumerate(values):
-                if i == 0: continue
-                if len(row) >= 8 and row[7] == 'PENDIENTE':
-                    deudas.append({
-                        'cuota_id': row[1],
-                        'monto_pendiente': float(row[3]) if row[3] else 0,
-                        'fecha_vencimiento': row[5]
-                    })
-            
-            return deudas
+            for fila in filas:
+                self.eliminar_fila(fila)
+            self.stats["compactaciones"] += 1
+            self.stats["filas_compactadas"] += len(filas)
+            print(f"🧹 Compactación: {len(filas)} cuota(s) pagada(s) eliminadas de 'Deuda Pendiente'")
+            return len(filas)
+
+    def eliminar_fila(self, fila: int) -> None:
+        """Refleja un deleteDimension: quita la fila y corre una posición las de abajo."""
+        with self._lock:
+            i = self._posicion(fila)
+            if i is None:
+                self.invalidar()
+                return
+            eliminada = self.pendientes.pop(i)
+            self._desindexar(eliminada)
+            for c in self.pendientes[i:]:
+                c.fila -= 1
+            self._tocar()
+
+    def agregar_historial(self, row: list, fila: int | None) -> None:
+        with self._lock:
+            if fila is None or fila <= self._ultima_fila_historial:
+                # Sin fila fiable: la próxima lectura delta la recoge desde la hoja
+                self.invalidar()
+                return
+            self._sumar_movimiento(MovimientoHistorial.desde_fila(fila, row))
+            self._ultima_fila_historial = fila
+            self._tocar()
+
+    def _tocar(self) -> None:
+        self.version += 1
+        self.stats["escrituras_locales"] += 1
+
+    def estadisticas(self) -> dict:
+        return {
+            **self.stats,
+            "version": self.version,
+            "cuotas": len(self.pendientes),
+            "cuotas_indexadas": len(self._por_cuota),
+            "lapidas": len(self.lapidas()),
+            "movimientos": len(self.historial),
+            "ultima_fila_historial": self._ultima_fila_historial,
+        }
+
+
+_LEDGERS = {}
+_LEDGERS_LOCK = threading.Lock()
+
+
+def obtener_ledger(spreadsheet_id: str | None = None) -> LedgerCache:
+    """Ledger compartido del Spreadsheet (por defecto el SPREADSHEET_ID activo)."""
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    with _LEDGERS_LOCK:
+        if spreadsheet_id not in _LEDGERS:
+            _LEDGERS[spreadsheet_id] = LedgerCache(spreadsheet_id)
+        return _LEDGERS[spreadsheet_id]
+
+
+def agregar_estadisticas(por_hoja: list) -> dict:
+    """Suma las métricas numéricas de varias hojas: totales sin IDs de Spreadsheet por usuario."""
+    total = {"hojas": len(por_hoja)}
+    for stats in por_hoja:
+        _sumar_estadisticas(total, stats)
+    return total
+
+
+def _sumar_estadisticas(total: dict, stats: dict) -> None:
+    for clave, valor in stats.items():
+        if isinstance(valor, dict):
+            _sumar_estadisticas(total.setdefault(clave, {}), valor)
+        elif isinstance(valor, (int, float)):  # los bool cuentan cuántas hojas lo cumplen
+            total[clave] = round(total.get(clave, 0) + valor, 3)
+
+
+def obtener_estadisticas_ledgers() -> dict:
+    with _LEDGERS_LOCK:
+        ledgers = list(_LEDGERS.values())
+    return agregar_estadisticas([ledger.estadisticas() for ledger in ledgers])
+
+
+def lecturas_sheets_totales() -> int:
+    with _LEDGERS_LOCK:
+        return sum(ledger.stats["lecturas_api"] for ledger in _LEDGERS.values())
+
+
+# --- Plan de escrituras: todas las mutaciones de un mensaje en un solo batchUpdate ---
+
+_escrituras_stats = {"planes": 0, "batch_updates": 0, "operaciones": 0, "reintentos_por_cuota": 0, "cuotas_fallidas": 0}
+
+
+def _serial_sheets(momento: datetime) -> float:
+    """Fecha/hora como número de serie de Sheets (días desde 1899-12-30)."""
+    delta = momento - datetime(1899, 12, 30)
+    return delta.days + delta.seconds / 86400
+
+
+def _celda_api(valor) -> dict:
+    """CellData equivalente a lo que produciría USER_ENTERED para nuestros tipos de valor."""
+    if isinstance(valor, datetime):
+        return {
+            'userEnteredValue': {'numberValue': _serial_sheets(valor)},
+            'userEnteredFormat': {'numberFormat': {'type': 'DATE_TIME', 'pattern': 'yyyy-mm-dd hh:mm:ss'}},
+        }
+    if isinstance(valor, date):
+        return {
+            'userEnteredValue': {'numberValue': float((valor - date(1899, 12, 30)).days)},
+            'userEnteredFormat': {'numberFormat': {'type': 'DATE', 'pattern': 'yyyy-mm-dd'}},
+        }
+    if isinstance(valor, bool):
+        return {'userEnteredValue': {'boolValue': valor}}
+    if isinstance(valor, (int, float)):
+        return {'userEnteredValue': {'numberValue': valor}}
+    return {'userEnteredValue': {'stringValue': '' if valor is None else str(valor)}}
+
+
+def _valores_para_hoja(valores: list) -> list:
+    """Convierte fechas ISO guardadas como texto en date/datetime, como las interpretaría USER_ENTERED."""
+    convertidos = []
+    for v in valores:
+        if isinstance(v, str) and re.fullmatch(r'\d{4}-\d{2}-\d{2}', v):
+            v = datetime.strptime(v, '%Y-%m-%d').date()
+        elif isinstance(v, str) and re.fullmatch(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', v):
+            v = datetime.strptime(v, '%Y-%m-%d %H:%M:%S')
+        convertidos.append(v)
+    return convertidos
+
+
+def _estado_http(error) -> int | None:
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+def _es_error_de_cuota(e: Exception) -> bool:
+    """429 / rateLimitExceeded / RESOURCE_EXHAUSTED: hay que esperar, no reintentar por partes."""
+    status = _estado_http(e)
+    texto = str(e)
+    return (status == 429
+            or (status == 403 and 'rateLimitExceeded' in texto)
+            or 'RESOURCE_EXHAUSTED' in texto
+            or 'Quota exceeded' in texto)
+
+
+class CuotaSheetsAgotada(Exception):
+    """La API de Sheets rechazó el lote por cuota; no se escribió nada."""
+
+
+class PlanEscrituras:
+    """
+    Junta las escrituras de un mensaje (appendCells, updateCells, deleteDimension) y las
+    envía en un solo spreadsheets.batchUpdate. Si el lote falla, se reintenta cuota por
+    cuota para reportar qué cuotas quedaron escritas y cuáles no.
+    """
+
+    def __init__(self, sheet_ids: dict, spreadsheet_id: str | None = None, compactar_luego: bool = False) -> None:
+        self.sheet_ids = sheet_ids
+        self.spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+        # Sin ledger local no hay hilo espejo que compacte: el plan agenda la compactación
+        self.compactar_luego = compactar_luego
+        self._ops = []
+        self.cuota_agotada = False
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def agregar_fila(self, cuota_id: str, hoja: str, valores: list) -> None:
+        self._ops.append({"cuota": cuota_id, "tipo": "append", "hoja": hoja, "valores": valores})
+
+    def actualizar_celda(self, cuota_id: str, hoja: str, fila: int, columna: int, valor) -> None:
+        """fila en base 1 (como en A1), columna en base 0."""
+        self._ops.append({"cuota": cuota_id, "tipo": "update", "hoja": hoja, "fila": fila,
+                          "columna": columna, "valor": valor})
+
+    def eliminar_fila(self, cuota_id: str, hoja: str, fila: int) -> None:
+        self._ops.append({"cuota": cuota_id, "tipo": "delete", "hoja": hoja, "fila": fila})
+
+    def marcar_pagada(self, cuota_id: str, hoja: str, fila: int) -> None:
+        """Lápida: saldo en 0 y Estado PAGADA en la misma fila; no corre las filas de abajo."""
+        self.actualizar_celda(cuota_id, hoja, fila, 3, 0)
+        self.actualizar_celda(cuota_id, hoja, fila, 7, ESTADO_LAPIDA)
+
+    @staticmethod
+    def _ordenar(ops: list) -> list:
+        """
+        Updates primero (con los números de fila originales), luego appends y al final los
+        deleteDimension de abajo hacia arriba, para que ningún borrado corra filas pendientes.
+        """
+        updates = [op for op in ops if op["tipo"] == "update"]
+        appends = [op for op in ops if op["tipo"] == "append"]
+        deletes = sorted((op for op in ops if op["tipo"] == "delete"), key=lambda op: op["fila"], reverse=True)
+        return updates + appends + deletes
+
+    def _request(self, op: dict) -> dict:
+        sheet_id = self.sheet_ids[op["hoja"]]
+        if op["tipo"] == "append":
+            return {'appendCells': {
+                'sheetId': sheet_id,
+                'rows': [{'values': [_celda_api(v) for v in op["valores"]]}],
+                'fields': 'userEnteredValue,userEnteredFormat.numberFormat',
+            }}
+        if op["tipo"] == "update":
+            return {'updateCells': {
+                'start': {'sheetId': sheet_id, 'rowIndex': op["fila"] - 1, 'columnIndex': op["columna"]},
+                'rows': [{'values': [_celda_api(op["valor"])]}],
+                'fields': 'userEnteredValue',
+            }}
+        return {'deleteDimension': {'range': {
+            'sheetId': sheet_id, 'dimension': 'ROWS',
+            'startIndex': op["fila"] - 1, 'endIndex': op["fila"],
+        }}}
+
+    def _enviar(self, sheets_service, ops: list) -> None:
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'requests': [self._request(op) for op in ops]}
+        ).execute()
+        _escrituras_stats["batch_updates"] += 1
+        _escrituras_stats["operaciones"] += len(ops)
+        self._aplicar_en_ledger(ops)
+        if self.compactar_luego and CUOTAS_LAPIDA and any(
+                op["tipo"] == "update" and op["columna"] == 7 and op["valor"] == ESTADO_LAPIDA for op in ops):
+            programar_compactacion(sheets_service, self.spreadsheet_id)
+
+    def _aplicar_en_ledger(self, ops: list) -> None:
+        ledger = obtener_ledger(self.spreadsheet_id)
+        for op in ops:
+            if op["hoja"] != 'Deuda Pendiente' and op["hoja"] != 'Historial de Pagos':
+                continue
+            if op["tipo"] == "update" and op["columna"] == 3:
+                ledger.actualizar_monto_pendiente(op["fila"], op["valor"])
+            elif op["tipo"] == "update" and op["columna"] == 7:
+                ledger.actualizar_estado(op["fila"], op["valor"])
+            elif op["tipo"] == "delete":
+                ledger.eliminar_fila(op["fila"])
+            elif op["tipo"] == "append" and op["hoja"] == 'Historial de Pagos':
+                # appendCells no devuelve el rango: la fila nueva va justo debajo de la última conocida
+                fila = ledger.siguiente_fila_historial()
+                valores = [v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else v for v in op["valores"]]
+                ledger.agregar_historial(valores, fila)
+            else:
+                ledger.invalidar()
+
+    def ejecutar(self, sheets_service, propagar_cuota: bool = False) -> dict:
+        """
+        Envía el plan. Devuelve {cuota_id: None si quedó escrita, o el mensaje de error}.
+        Con propagar_cuota=True, un rechazo por cuota del lote completo lanza CuotaSheetsAgotada.
+        """
+        resultados = {op["cuota"]: None for op in self._ops}
+        if not self._ops:
+            return resultados
+        _escrituras_stats["planes"] += 1
+
+        faltantes = [op for op in self._ops if op["hoja"] not in self.sheet_ids]
+        for op in faltantes:
+            resultados[op["cuota"]] = f"No existe la hoja '{op['hoja']}'"
+        ops = [op for op in self._ops if resultados[op["cuota"]] is None]
+        if not ops:
+            return resultados
+
+        try:
+            self._enviar(sheets_service, self._ordenar(ops))
+            return resultados
+        except HttpError as e:
+            if _es_error_de_cuota(e):
+                self.cuota_agotada = True
+                if propagar_cuota:
+                    raise CuotaSheetsAgotada(str(e)) from e
+            print(f"⚠️ batchUpdate del pago falló ({e}); reintentando cuota por cuota...")
+
+        # batchUpdate es atómico: nada se escribió. Se reenvía por cuota, primero las que
+        # solo actualizan y luego las que borran filas, de abajo hacia arriba.
+        grupos = {}
+        for op in ops:
+            grupos.setdefault(op["cuota"], []).append(op)
+
+        def _orden_grupo(cuota_ops):
+            borrados = [op["fila"] for op in cuota_ops if op["tipo"] == "delete"]
+            return (1, -max(borrados)) if borrados else (0, 0)
+
+        for cuota_id, cuota_ops in sorted(grupos.items(), key=lambda kv: _orden_grupo(kv[1])):
+            if self.cuota_agotada and propagar_cuota:
+                resultados[cuota_id] = "Cuota de Sheets agotada"
+                continue
+            _escrituras_stats["reintentos_por_cuota"] += 1
+            try:
+                self._enviar(sheets_service, self._ordenar(cuota_ops))
+            except HttpError as e:
+                self.cuota_agotada = self.cuota_agotada or _es_error_de_cuota(e)
+                resultados[cuota_id] = str(e)
+                _escrituras_stats["cuotas_fallidas"] += 1
+        return resultados
+
+
+def obtener_estadisticas_escrituras() -> dict:
+    return dict(_escrituras_stats)
+
+
+# --- Ledger local en SQLite (sistema de registro) con Google Sheets como espejo asíncrono ---
+
+LEDGER_LOCAL = os.environ.get('LEDGER_LOCAL', '1') == '1'
+LEDGER_DB_DIR = os.environ.get('LEDGER_DB_DIR', 'ledgers')
+ESPEJO_INTERVALO = float(os.environ.get('ESPEJO_INTERVALO', '2'))  # segundos entre vaciados de la cola
+ESPEJO_LOTE = int(os.environ.get('ESPEJO_LOTE', '50'))  # operaciones por batchUpdate
+ESPEJO_MAX_INTENTOS = int(os.environ.get('ESPEJO_MAX_INTENTOS', '5'))
+ESPEJO_BACKOFF_MAX = float(os.environ.get('ESPEJO_BACKOFF_MAX', '300'))
+# Cada cuánto el espejo relee Sheets para traer ediciones hechas a mano (0 = nunca); solo
+# si el ledger se usó desde la última relectura, así un usuario inactivo no gasta cuota
+LEDGER_RECONCILIAR = float(os.environ.get('LEDGER_RECONCILIAR', str(LEDGER_TTL)))
+# Sin uso ni cola durante este tiempo el hilo espejo se detiene; el próximo acceso lo rearranca (0 = nunca)
+ESPEJO_INACTIVIDAD = float(os.environ.get('ESPEJO_INACTIVIDAD', '900'))
+
+
+class LedgerLocal:
+    """
+    Ledger de un Spreadsheet en SQLite: cuotas, historial y la cola de operaciones pendientes
+    de replicar en Sheets. Las consultas y escrituras de los agentes se resuelven aquí; el
+    EspejoSheets asociado lleva los cambios a 'Deuda Pendiente' / 'Historial de Pagos'.
+    En este ledger, CuotaRegistro.fila es el orden de inserción (rowid), no la fila de la hoja.
+    Las ediciones hechas a mano en Sheets se incorporan cada LEDGER_RECONCILIAR segundos,
+    solo con la cola del espejo vacía: mientras haya escrituras propias sin replicar, mandan ellas.
+    """
+
+    def __init__(self, spreadsheet_id: str, path: str) -> None:
+        self.spreadsheet_id = spreadsheet_id
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS cuotas ("
+            " orden INTEGER PRIMARY KEY AUTOINCREMENT, cuota_id TEXT NOT NULL, factura TEXT NOT NULL,"
+            " fecha_registro TEXT, monto_total REAL, monto_pendiente REAL, monto_cuota REAL,"
+            " fecha_vencimiento_raw TEXT, fecha_vencimiento TEXT, tipo_pago TEXT, estado TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_cuotas_cuota ON cuotas(cuota_id);"
+            "CREATE INDEX IF NOT EXISTS idx_cuotas_factura ON cuotas(factura, orden);"
+            "CREATE INDEX IF NOT EXISTS idx_cuotas_estado ON cuotas(estado);"
+            "CREATE TABLE IF NOT EXISTS historial ("
+            " orden INTEGER PRIMARY KEY AUTOINCREMENT, fecha_hora TEXT, cuota_id TEXT, factura TEXT,"
+            " tipo_transaccion TEXT, monto_pagado REAL, saldo_restante REAL, observaciones TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_historial_factura ON historial(factura);"
+            "CREATE TABLE IF NOT EXISTS espejo ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, operacion TEXT NOT NULL, cuota_id TEXT NOT NULL,"
+            " datos TEXT NOT NULL, estado TEXT NOT NULL DEFAULT 'pendiente', intentos INTEGER NOT NULL DEFAULT 0,"
+            " creado REAL NOT NULL, replicado REAL, error TEXT);"
+            "CREATE INDEX IF NOT EXISTS idx_espejo_estado ON espejo(estado, id);"
+            "CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);"
+        )
+        columnas_espejo = {r[1] for r in self._db.execute("PRAGMA table_info(espejo)")}
+        if 'mensaje_id' not in columnas_espejo:
+            self._db.execute("ALTER TABLE espejo ADD COLUMN mensaje_id TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_espejo_mensaje ON espejo(mensaje_id)")
+        self._db.commit()
+        self.espejo = EspejoSheets(self)
+        self.stats = {"consultas": 0, "escrituras": 0, "importaciones": 0, "reconciliaciones": 0, "cambios_externos": 0}
+
+    # -- carga inicial --
+
+    def _meta(self, clave: str) -> str | None:
+        row = self._db.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return row[0] if row else None
+
+    def asegurar(self, sheets_service) -> "LedgerLocal":
+        """La primera vez importa las pestañas desde Sheets; además deja el espejo listo."""
+        with self._lock:
+            if self._meta('importado_en') is None:
+                self.importar_desde_hojas(sheets_service)
+            self.espejo.configurar(sheets_service)
+        return self
+
+    def importar_desde_hojas(self, sheets_service) -> None:
+        """Trae cuotas e historial desde lo que haya hoy en Sheets (solo si no hay cambios sin replicar)."""
+        with self._lock:
+            if self.operaciones_en_cola(1):
+                print("⚠️ Hay cambios sin replicar en Sheets; no se reimporta el ledger local")
+                return
+            # Se usa la vista compartida: así el espejo arranca con las filas de la hoja ya cargadas
+            vista = obtener_ledger(self.spreadsheet_id)
+            vista.invalidar(resincronizar=True)
+            vista.recargar(sheets_service)
+            self._sincronizar_con_vista(vista)
+            self.stats["importaciones"] += 1
+            print(f"📥 Ledger local importado desde Sheets: {len(vista.pendientes)} cuota(s), {len(vista.historial)} movimiento(s)")
+
+    def reconciliar(self, sheets_service) -> int:
+        """
+        Relee la hoja (recarga por TTL de la vista, con historial por delta) y aplica al SQLite
+        las ediciones hechas a mano. Devuelve cuántas cuotas cambiaron. Lo llama el hilo
+        espejo, que es el único que replica: con la cola vacía, la vista es la hoja.
+        """
+        if self.operaciones_en_cola(1):
+            return 0
+        vista = obtener_ledger(self.spreadsheet_id)
+        vista.invalidar()
+        vista.asegurar(sheets_service)  # lectura de red fuera del lock del ledger local
+        with self._lock:
+            if self.operaciones_en_cola(1):
+                return 0  # llegaron escrituras mientras se leía la hoja; se reintenta en la próxima vuelta
+            cambios = self._sincronizar_con_vista(vista)
+            self.stats["reconciliaciones"] += 1
+        if cambios:
+            self.stats["cambios_externos"] += cambios
+            print(f"🔄 Ledger local: {cambios} cuota(s) editadas a mano en Sheets incorporadas")
+        return cambios
+
+    def _sincronizar_con_vista(self, vista: "LedgerCache") -> int:
+        """
+        Deja cuotas e historial iguales a la vista de la hoja. Las cuotas se emparejan por ID,
+        así las que no cambiaron conservan su orden (lo usan los planes en curso).
+        """
+        hoja = [c for c in vista.pendientes if c.columnas > 7 and c.cuota_id and c.estado != ESTADO_LAPIDA]
+        locales = {}
+        for orden, cuota_id in self._db.execute("SELECT orden, cuota_id FROM cuotas ORDER BY orden"):
+            locales.setdefault(cuota_id, []).append(orden)
+        cambios = 0
+        with self._db:
+            for c in hoja:
+                ordenes = locales.get(c.cuota_id)
+                if ordenes:
+                    cambios += self._actualizar_cuota(ordenes.pop(0), c.como_fila())
+                else:
+                    self._insertar_cuota(c.como_fila())
+                    cambios += 1
+            sobrantes = [(orden,) for ordenes in locales.values() for orden in ordenes]
+            self._db.executemany("DELETE FROM cuotas WHERE orden = ?", sobrantes)
+            cambios += len(sobrantes)
+
+            self._db.execute("DELETE FROM historial")
+            for m in vista.historial:
+                self._insertar_movimiento([m.fecha_hora, m.cuota_id, m.tipo_transaccion,
+                                           m.monto_pagado, m.saldo_restante, m.observaciones])
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (clave, valor) VALUES ('importado_en', ?)",
+                (datetime.now().isoformat(timespec='seconds'),)
+            )
+        return cambios
+
+    # -- consultas (mismas que LedgerCache, resueltas con índices de SQLite) --
+
+    _COLUMNAS_CUOTA = ("orden, fecha_registro, cuota_id, monto_total, monto_pendiente, monto_cuota,"
+                       " fecha_vencimiento_raw, fecha_vencimiento, tipo_pago, estado")
+
+    @staticmethod
+    def _cuota(row) -> CuotaRegistro:
+        return CuotaRegistro(
+            fila=row[0], fecha_registro=row[1] or '', cuota_id=row[2], monto_total=row[3] or 0.0,
+            monto_pendiente=row[4] or 0.0, monto_cuota=row[5] or 0.0, fecha_vencimiento_raw=row[6] or '',
+            fecha_vencimiento=row[7], tipo_pago=row[8] or '', estado=row[9] or '',
+        )
+
+    def _consultar(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            self.stats["consultas"] += 1
+            return self._db.execute(sql, params).fetchall()
+
+    def cuotas_de_factura(self, factura_id: str) -> list:
+        return [self._cuota(r) for r in self._consultar(
+            f"SELECT {self._COLUMNAS_CUOTA} FROM cuotas WHERE factura = ? ORDER BY orden", (factura_id,))]
+
+    def cuotas_pendientes(self) -> list:
+        return [self._cuota(r) for r in self._consultar(
+            f"SELECT {self._COLUMNAS_CUOTA} FROM cuotas WHERE estado = 'PENDIENTE' ORDER BY orden")]
+
+    def historial_de_factura(self, factura_id: str) -> list:
+        return [
+            MovimientoHistorial(fila=r[0], fecha_hora=r[1] or '', cuota_id=r[2], tipo_transaccion=r[3] or '',
+                                monto_pagado=r[4] or 0.0, saldo_restante=r[5] or 0.0, observaciones=r[6] or '')
+            for r in self._consultar(
+                "SELECT orden, fecha_hora, cuota_id, tipo_transaccion, monto_pagado, saldo_restante, observaciones "
+                "FROM historial WHERE factura = ? ORDER BY orden", (factura_id,))
+        ]
+
+    def buscar_cuota(self, factura_id: str):
+        """Misma regla que Registrador._find_factura_row: ID exacto o primera cuota PENDIENTE."""
+        rows = self._consultar(
+            f"SELECT {self._COLUMNAS_CUOTA} FROM cuotas "
+            "WHERE cuota_id = ? OR (factura = ? AND estado = 'PENDIENTE') ORDER BY orden LIMIT 1",
+            (factura_id, factura_id))
+        return self._cuota(rows[0]) if rows else None
+
+    def fechas_ocupadas(self) -> dict:
+        return dict(self._consultar(
+            "SELECT fecha_vencimiento, COUNT(*) FROM cuotas WHERE fecha_vencimiento IS NOT NULL GROUP BY fecha_vencimiento"))
+
+    def totales_historial(self) -> dict:
+        total, num = self._consultar("SELECT COALESCE(SUM(monto_pagado), 0), COUNT(*) FROM historial")[0]
+        return {"total_pagado": total, "num_transacciones": num}
+
+    def cuotas_pagadas_de_factura(self, factura_id: str) -> list:
+        return [r[0] for r in self._consultar(
+            "SELECT DISTINCT cuota_id FROM historial "
+            "WHERE factura = ? AND tipo_transaccion = 'Pago Completo' AND saldo_restante = 0", (factura_id,))]
+
+    # -- escrituras (transacción local + operación en la cola del espejo) --
+
+    _CAMPOS_CUOTA = ("cuota_id", "factura", "fecha_registro", "monto_total", "monto_pendiente", "monto_cuota",
+                     "fecha_vencimiento_raw", "fecha_vencimiento", "tipo_pago", "estado")
+
+    @staticmethod
+    def _valores_cuota(valores: list) -> tuple:
+        c = CuotaRegistro.desde_fila(0, valores)
+        return (c.cuota_id, LedgerCache._factura_base(c.cuota_id), c.fecha_registro, c.monto_total, c.monto_pendiente,
+                c.monto_cuota, str(c.fecha_vencimiento_raw), c.fecha_vencimiento, c.tipo_pago, c.estado)
+
+    def _insertar_cuota(self, valores: list) -> int:
+        cursor = self._db.execute(
+            f"INSERT INTO cuotas ({', '.join(self._CAMPOS_CUOTA)}) VALUES ({', '.join('?' * len(self._CAMPOS_CUOTA))})",
+            self._valores_cuota(valores)
+        )
+        return cursor.lastrowid
+
+    def _actualizar_cuota(self, orden: int, valores: list) -> int:
+        """Reescribe la cuota solo si algún campo cambió; devuelve 1 si la tocó."""
+        nuevos = self._valores_cuota(valores)
+        cursor = self._db.execute(
+            f"UPDATE cuotas SET {', '.join(f'{campo} = ?' for campo in self._CAMPOS_CUOTA)} "
+            f"WHERE orden = ? AND ({' OR '.join(f'{campo} IS NOT ?' for campo in self._CAMPOS_CUOTA)})",
+            (*nuevos, orden, *nuevos)
+        )
+        return cursor.rowcount
+
+    def _insertar_movimiento(self, valores: list) -> None:
+        m = MovimientoHistorial.desde_fila(0, valores)
+        self._db.execute(
+            "INSERT INTO historial (fecha_hora, cuota_id, factura, tipo_transaccion, monto_pagado, saldo_restante,"
+            " observaciones) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (m.fecha_hora, m.cuota_id, LedgerCache._factura_base(m.cuota_id), m.tipo_transaccion,
+             m.monto_pagado, m.saldo_restante, m.observaciones)
+        )
+
+    def _encolar(self, operacion: str, cuota_id: str, datos: dict) -> None:
+        self._db.execute(
+            "INSERT INTO espejo (operacion, cuota_id, datos, creado, mensaje_id) VALUES (?, ?, ?, ?, ?)",
+            (operacion, cuota_id, json.dumps(datos, default=str), time.time(), MENSAJE_ACTUAL.get())
+        )
+
+    def aplicar(self, ops: list) -> dict:
+        """
+        Aplica las operaciones de un PlanLocal en una sola transacción y las deja en cola
+        para el espejo. Devuelve {cuota_id: None | error} como PlanEscrituras.ejecutar.
+        """
+        resultados = {op["cuota"]: None for op in ops}
+        with self._lock:
+            try:
+                with self._db:
+                    for op in ops:
+                        if op["tipo"] == "append" and op["hoja"] == 'Deuda Pendiente':
+                            self._insertar_cuota(op["valores"])
+                            self._encolar('agregar_cuota', op["cuota"], {"valores": op["valores"]})
+                        elif op["tipo"] == "append":
+                            self._insertar_movimiento(op["valores"])
+                            self._encolar('agregar_historial', op["cuota"], {"hoja": op["hoja"], "valores": op["valores"]})
+                        elif op["tipo"] == "update" and op["columna"] == 3:
+                            self._db.execute("UPDATE cuotas SET monto_pendiente = ? WHERE orden = ?", (op["valor"], op["fila"]))
+                            self._encolar('actualizar_pendiente', op["cuota"], {"monto": op["valor"]})
+                        elif op["tipo"] == "delete":
+                            self._db.execute("DELETE FROM cuotas WHERE orden = ?", (op["fila"],))
+                            self._encolar('eliminar_cuota', op["cuota"], {})
+                        else:
+                            raise ValueError(f"Operación no soportada en el ledger local: {op}")
+                self.stats["escrituras"] += 1
+            except (sqlite3.Error, ValueError) as e:
+                return {cuota: str(e) for cuota in resultados}
+        self.espejo.despertar()
+        return resultados
+
+    def limpiar_cuotas(self) -> None:
+        """Refleja el comando 'limpiar hoja' (que ya borró la pestaña en Sheets)."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM cuotas")
+            self._db.execute(
+                "DELETE FROM espejo WHERE estado = 'pendiente' AND operacion IN "
+                "('agregar_cuota', 'actualizar_pendiente', 'eliminar_cuota')"
+            )
+
+    # -- cola del espejo --
+
+    def operaciones_en_cola(self, limite: int | None = None) -> list:
+        sql = "SELECT id, operacion, cuota_id, datos, intentos FROM espejo WHERE estado = 'pendiente' ORDER BY id"
+        with self._lock:
+            if limite:
+                return self._db.execute(sql + " LIMIT ?", (limite,)).fetchall()
+            return self._db.execute(sql).fetchall()
+
+    def marcar_replicadas(self, ids: list) -> None:
+        if not ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE espejo SET estado = 'replicado', replicado = ?, error = NULL WHERE id = ?",
+                [(time.time(), i) for i in ids]
+            )
+
+    def marcar_fallidas(self, ids: list, error: str) -> None:
+        """Suma un intento; al llegar a ESPEJO_MAX_INTENTOS la operación queda en estado 'error'."""
+        if not ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE espejo SET intentos = intentos + 1, error = ?, "
+                "estado = CASE WHEN intentos + 1 >= ? THEN 'error' ELSE estado END WHERE id = ?",
+                [(error, ESPEJO_MAX_INTENTOS, i) for i in ids]
+            )
+
+    def estado_de_mensaje(self, mensaje_id: str) -> dict:
+        """{estado: cantidad} de las réplicas a Sheets que generó un mensaje."""
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT estado, COUNT(*) FROM espejo WHERE mensaje_id = ? GROUP BY estado", (mensaje_id,)
+            ).fetchall())
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            por_estado = dict(self._db.execute("SELECT estado, COUNT(*) FROM espejo GROUP BY estado").fetchall())
+            cuotas = self._db.execute("SELECT COUNT(*) FROM cuotas").fetchone()[0]
+            movimientos = self._db.execute("SELECT COUNT(*) FROM historial").fetchone()[0]
+        return {**self.stats, "cuotas": cuotas, "movimientos": movimientos,
+                "cola_espejo": por_estado, "espejo": self.espejo.estadisticas()}
+
+
+class PlanLocal:
+    """Misma interfaz que PlanEscrituras, pero escribe en el ledger SQLite y encola el espejo."""
+
+    def __init__(self, ledger: LedgerLocal) -> None:
+        self.ledger = ledger
+        self._ops = []
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def agregar_fila(self, cuota_id: str, hoja: str, valores: list) -> None:
+        valores = [v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else v for v in valores]
+        self._ops.append({"cuota": cuota_id, "tipo": "append", "hoja": hoja, "valores": valores})
+
+    def actualizar_celda(self, cuota_id: str, hoja: str, fila: int, columna: int, valor) -> None:
+        self._ops.append({"cuota": cuota_id, "tipo": "update", "hoja": hoja, "fila": fila,
+                          "columna": columna, "valor": valor})
+
+    def eliminar_fila(self, cuota_id: str, hoja: str, fila: int) -> None:
+        self._ops.append({"cuota": cuota_id, "tipo": "delete", "hoja": hoja, "fila": fila})
+
+    def marcar_pagada(self, cuota_id: str, hoja: str, fila: int) -> None:
+        # En SQLite borrar no corre nada; el espejo decide si en la hoja es lápida o borrado
+        self.eliminar_fila(cuota_id, hoja, fila)
+
+    def ejecutar(self, sheets_service=None) -> dict:
+        return self.ledger.aplicar(self._ops) if self._ops else {}
+
+
+def _servicio_para_hilo(servicio, api: str = 'sheets', version: str = 'v4'):
+    """
+    httplib2 no es seguro entre hilos: los hilos de fondo usan su propio cliente de Google
+    con las mismas credenciales. Si no se pueden obtener, comparten el del agente.
+    """
+    creds = getattr(getattr(servicio, '_http', None), 'credentials', None)
+    if creds is None:
+        return servicio
+    try:
+        return build(api, version, credentials=creds, cache_discovery=False)
+    except Exception:
+        return servicio
+
+
+GOOGLE_CLIENTES_POR_HILO = int(os.environ.get('GOOGLE_CLIENTES_POR_HILO', '32'))
+
+
+class ClientesPorHilo:
+    """
+    Clientes de Google propios de cada hilo (httplib2 no es seguro entre hilos), por clave
+    (usuario y API). Se reutilizan mientras las credenciales sean las mismas y cada hilo
+    guarda como mucho `maximo` (LRU), así la memoria no crece con los mensajes.
+    """
+
+    def __init__(self, maximo: int = GOOGLE_CLIENTES_POR_HILO) -> None:
+        self.maximo = maximo
+        self._hilo = threading.local()
+
+    @staticmethod
+    def _huella(servicio):
+        creds = getattr(getattr(servicio, '_http', None), 'credentials', None)
+        if creds is None:
+            return servicio  # sin credenciales (servicio compartido) se compara el propio objeto
+        return (getattr(creds, 'client_id', None), getattr(creds, 'refresh_token', None) or id(creds))
+
+    def obtener(self, clave, servicio, construir):
+        """Cliente del hilo para la clave; lo construye con construir(servicio) si falta o cambiaron las credenciales."""
+        clientes = getattr(self._hilo, 'clientes', None)
+        if clientes is None:
+            clientes = self._hilo.clientes = OrderedDict()
+        huella = self._huella(servicio)
+        entrada = clientes.get(clave)
+        if entrada is None or entrada[0] != huella:
+            entrada = clientes[clave] = (huella, construir(servicio))
+        clientes.move_to_end(clave)
+        while len(clientes) > self.maximo:
+            clientes.popitem(last=False)
+        return entrada[1]
+
+
+class EspejoSheets:
+    """
+    Hilo que replica en Sheets las operaciones encoladas por un LedgerLocal, en lotes de un
+    solo batchUpdate. Las filas se resuelven en el momento de replicar con la vista en
+    memoria de la hoja (LedgerCache). Si la API responde por cuota agotada, espera con
+    backoff exponencial y reintenta sin gastar intentos.
+    """
+
+    def __init__(self, ledger: LedgerLocal) -> None:
+        self.ledger = ledger
+        self._servicio = None
+        self._servicio_origen = None
+        self._sheet_ids = None
+        self._evento = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._pausa_hasta = 0.0
+        self._backoff = 0.0
+        self._ultima_replica = time.monotonic()
+        self._ultima_compactacion = time.monotonic()
+        self._ultima_reconciliacion = time.monotonic()
+        self._ultimo_uso = time.monotonic()
+        self._compactar_ya = False
+        self.stats = {"lotes": 0, "operaciones_replicadas": 0, "operaciones_fallidas": 0,
+                      "cuota_agotada": 0, "detenciones_por_inactividad": 0, "ultimo_error": None}
+
+    def configurar(self, sheets_service) -> None:
+        """
+        Deja el hilo en marcha con el servicio del último mensaje que escribió en este
+        Spreadsheet (el de su dueño, con credenciales vigentes), no con el del primero.
+        """
+        with self._lock:
+            if sheets_service is not None and sheets_service is not self._servicio_origen:
+                self._servicio_origen = sheets_service
+                self._servicio = _servicio_para_hilo(sheets_service)
+            self._ultimo_uso = time.monotonic()
+            self._detener.clear()
+            self._arrancar()
+            self._evento.set()
+
+    def _arrancar(self) -> None:
+        """Con self._lock tomado: pone en marcha el hilo si no está corriendo (o se detuvo por inactividad)."""
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._bucle, name=f"espejo-{self.ledger.spreadsheet_id[:8]}", daemon=True)
+            self._hilo.start()
+
+    def despertar(self) -> None:
+        # El aviso va dentro del lock: el hilo decide detenerse bajo el mismo lock y lo ve
+        with self._lock:
+            if self._servicio is not None and not self._detener.is_set():
+                self._arrancar()
+            self._evento.set()
+
+    def detener(self, timeout: float = 10.0) -> None:
+        """Intenta vaciar la cola antes de parar el hilo (al cerrar la app)."""
+        self._detener.set()
+        self._evento.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+
+    def _bucle(self) -> None:
+        while True:
+            self._evento.wait(ESPEJO_INTERVALO)
+            self._evento.clear()
+            espera = self._pausa_hasta - time.monotonic()
+            if espera > 0 and not self._detener.is_set():
+                self._detener.wait(espera)
+            try:
+                if self.vaciar():
+                    self._ultima_replica = time.monotonic()
+                elif self._toca_compactar():
+                    self._ultima_compactacion = time.monotonic()
+                    compactar_deuda(self._servicio, self.ledger.spreadsheet_id, self._obtener_sheet_ids())
+                elif self._toca_reconciliar():
+                    self._ultima_reconciliacion = time.monotonic()
+                    self.ledger.reconciliar(self._servicio)
+            except Exception as e:
+                self.stats["ultimo_error"] = str(e)
+                print(f"⚠️ Espejo de Sheets: {e}")
+            if self._detener.is_set():
+                return
+            if self._inactivo():
+                if CUOTAS_LAPIDA and self._ultima_replica > self._ultima_compactacion:
+                    self._compactar_ya = True  # antes de detenerse, se compactan las lápidas que dejó
+                    continue
+                with self._lock:
+                    # Bajo el lock (sin tocar el del ledger): un despertar() concurrente ya dejó
+                    # el aviso puesto, o llega después y rearranca el hilo
+                    if self._inactivo(consultar_cola=False):
+                        self._hilo = None
+                        self.stats["detenciones_por_inactividad"] += 1
+                        return
+
+    def _inactivo(self, consultar_cola: bool = True) -> bool:
+        """Nadie usó el ledger ni escribió en ESPEJO_INACTIVIDAD s y no queda nada por replicar."""
+        if not ESPEJO_INACTIVIDAD or self._evento.is_set() or self._compactar_ya:
+            return False
+        ahora = time.monotonic()
+        if min(ahora - self._ultimo_uso, ahora - self._ultima_replica) < ESPEJO_INACTIVIDAD:
+            return False
+        return self._pausa_hasta <= ahora and not (consultar_cola and self.ledger.operaciones_en_cola(1))
+
+    def solicitar_compactacion(self) -> None:
+        """Compacta en la próxima vuelta del hilo en que la cola esté vacía."""
+        self._compactar_ya = True
+        self.despertar()
+
+    def _toca_compactar(self) -> bool:
+        """Solo en momentos tranquilos: cola vacía, sin escrituras recientes y sin pausa por cuota."""
+        if self._detener.is_set() or self._pausa_hasta > time.monotonic() or self.ledger.operaciones_en_cola(1):
+            return False
+        if self._compactar_ya:
+            self._compactar_ya = False
+            return True
+        ahora = time.monotonic()
+        return (CUOTAS_LAPIDA
+                and ahora - self._ultima_replica >= COMPACTACION_INACTIVIDAD
+                and ahora - self._ultima_compactacion >= COMPACTACION_INTERVALO)
+
+    def _toca_reconciliar(self) -> bool:
+        """
+        Releer Sheets para traer ediciones manuales: cada LEDGER_RECONCILIAR s, sin pausa ni
+        cola, y solo si alguien usó el ledger desde la última relectura (perezoso).
+        """
+        if not LEDGER_RECONCILIAR or self._servicio is None or self._detener.is_set():
+            return False
+        if self._ultimo_uso <= self._ultima_reconciliacion:
+            return False
+        if self._pausa_hasta > time.monotonic() or self.ledger.operaciones_en_cola(1):
+            return False
+        return time.monotonic() - self._ultima_reconciliacion >= LEDGER_RECONCILIAR
+
+    def _obtener_sheet_ids(self) -> dict:
+        if self._sheet_ids is None:
+            self._sheet_ids = obtener_sheet_ids(self._servicio, self.ledger.spreadsheet_id)
+        return self._sheet_ids
+
+    def vaciar(self) -> int:
+        """Replica lotes hasta vaciar la cola o toparse con la cuota. Devuelve cuántas operaciones replicó."""
+        if self._servicio is None:
+            return 0
+        total = 0
+        while not (self._pausa_hasta > time.monotonic()):
+            ops = self.ledger.operaciones_en_cola(ESPEJO_LOTE)
+            if not ops:
+                break
+            replicadas = self._replicar_lote(ops)
+            total += replicadas
+            if replicadas == 0:
+                break
+        return total
+
+    def _replicar_lote(self, ops: list) -> int:
+        vista = obtener_ledger(self.ledger.spreadsheet_id).asegurar(self._servicio)
+        plan = PlanEscrituras(self._obtener_sheet_ids(), self.ledger.spreadsheet_id)
+        ids_por_cuota, agregadas, sin_fila = {}, set(), []
+
+        for op_id, operacion, cuota_id, datos, _intentos in ops:
+            datos = json.loads(datos)
+            if operacion in ('actualizar_pendiente', 'eliminar_cuota'):
+                if cuota_id in agregadas:
+                    break  # su fila aún no existe en la hoja: va en el próximo lote
+                fila = vista.fila_de(cuota_id)
+                if fila is None:
+                    sin_fila.append(op_id)
+                    continue
+                if operacion == 'actualizar_pendiente':
+                    plan.actualizar_celda(cuota_id, 'Deuda Pendiente', fila, 3, datos["monto"])
+                elif CUOTAS_LAPIDA:
+                    plan.marcar_pagada(cuota_id, 'Deuda Pendiente', fila)
+                else:
+                    plan.eliminar_fila(cuota_id, 'Deuda Pendiente', fila)
+            elif operacion == 'agregar_cuota':
+                plan.agregar_fila(cuota_id, 'Deuda Pendiente', _valores_para_hoja(datos["valores"]))
+                agregadas.add(cuota_id)
+            else:
+                plan.agregar_fila(cuota_id, datos.get("hoja", 'Historial de Pagos'), _valores_para_hoja(datos["valores"]))
+            ids_por_cuota.setdefault(cuota_id, []).append(op_id)
+
+        if sin_fila:
+            # La vista puede estar atrasada (p. ej. tras un appendCells): la próxima vuelta recarga
+            vista.invalidar()
+            self.ledger.marcar_fallidas(sin_fila, "La cuota no está en la hoja")
+            self.stats["operaciones_fallidas"] += len(sin_fila)
+        if not len(plan):
+            return 0
+
+        try:
+            resultados = plan.ejecutar(self._servicio, propagar_cuota=True)
+        except CuotaSheetsAgotada as e:
+            self._pausar(str(e))
+            return 0
+
+        replicadas, fallidas = [], []
+        for cuota_id, error in resultados.items():
+            (fallidas if error else replicadas).extend(ids_por_cuota.get(cuota_id, []))
+        self.ledger.marcar_replicadas(replicadas)
+        if plan.cuota_agotada:
+            self._pausar("cuota agotada durante el reintento por cuota")
+        else:
+            errores = {e for e in resultados.values() if e}
+            self.ledger.marcar_fallidas(fallidas, "; ".join(sorted(errores))[:500])
+            self.stats["operaciones_fallidas"] += len(fallidas)
+            self._backoff = 0.0
+        self.stats["lotes"] += 1
+        self.stats["operaciones_replicadas"] += len(replicadas)
+        return len(replicadas)
+
+    def _pausar(self, motivo: str) -> None:
+        self._backoff = min(ESPEJO_BACKOFF_MAX, (self._backoff * 2) or ESPEJO_INTERVALO)
+        self._pausa_hasta = time.monotonic() + self._backoff
+        self.stats["cuota_agotada"] += 1
+        self.stats["ultimo_error"] = motivo
+        print(f"⏳ Espejo de Sheets en pausa {self._backoff:.0f}s: {motivo}")
+
+    def estadisticas(self) -> dict:
+        return {**self.stats, "activo": bool(self._hilo and self._hilo.is_alive()),
+                "pausa_restante": max(0.0, round(self._pausa_hasta - time.monotonic(), 1))}
+
+
+_SHEET_IDS = {}
+_SHEET_IDS_LOCK = threading.Lock()
+
+
+def obtener_sheet_ids(sheets_service, spreadsheet_id: str | None = None) -> dict:
+    """{título: sheetId} de las pestañas; se pide una sola vez por Spreadsheet (no cambian)."""
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    with _SHEET_IDS_LOCK:
+        if spreadsheet_id in _SHEET_IDS:
+            return dict(_SHEET_IDS[spreadsheet_id])
+    spreadsheet = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(title,sheetId)'
+    ).execute()
+    sheet_ids = {s['properties']['title']: s['properties']['sheetId'] for s in spreadsheet.get('sheets', [])}
+    if sheet_ids:
+        with _SHEET_IDS_LOCK:
+            _SHEET_IDS[spreadsheet_id] = sheet_ids
+    return dict(sheet_ids)
+
+
+def compactar_deuda(sheets_service, spreadsheet_id: str | None = None, sheet_ids: dict | None = None) -> int:
+    """Borra de 'Deuda Pendiente' las cuotas marcadas PAGADA. Devuelve cuántas filas quitó."""
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    if sheet_ids is None:
+        sheet_ids = obtener_sheet_ids(sheets_service, spreadsheet_id)
+    if 'Deuda Pendiente' not in sheet_ids:
+        return 0
+    return obtener_ledger(spreadsheet_id).compactar(sheets_service, sheet_ids['Deuda Pendiente'])
+
+
+_COMPACTACIONES = {}  # spreadsheet_id -> threading.Timer de la compactación agendada
+_ULTIMA_COMPACTACION = {}
+_COMPACTACIONES_LOCK = threading.Lock()
+
+
+def programar_compactacion(sheets_service, spreadsheet_id: str | None = None) -> None:
+    """
+    Agenda compactar_deuda para cuando pasen COMPACTACION_INACTIVIDAD s sin nuevas lápidas
+    (cada lápida la posterga) y nunca antes de COMPACTACION_INTERVALO desde la anterior.
+    Es el equivalente del hilo espejo para el ledger en memoria (LEDGER_LOCAL=0).
+    """
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    with _COMPACTACIONES_LOCK:
+        anterior = _COMPACTACIONES.get(spreadsheet_id)
+        if anterior is not None:
+            anterior.cancel()
+        ultima = _ULTIMA_COMPACTACION.get(spreadsheet_id)
+        espera = COMPACTACION_INACTIVIDAD
+        if ultima is not None:
+            espera = max(espera, ultima + COMPACTACION_INTERVALO - time.monotonic())
+        timer = threading.Timer(espera, _compactar_agendada, (sheets_service, spreadsheet_id))
+        timer.daemon = True
+        _COMPACTACIONES[spreadsheet_id] = timer
+        timer.start()
+
+
+def _compactar_agendada(sheets_service, spreadsheet_id: str) -> None:
+    with _COMPACTACIONES_LOCK:
+        if _COMPACTACIONES.get(spreadsheet_id) is not threading.current_thread():
+            return  # la reemplazó una lápida más nueva
+        del _COMPACTACIONES[spreadsheet_id]
+        _ULTIMA_COMPACTACION[spreadsheet_id] = time.monotonic()
+    try:
+        compactar_deuda(_servicio_para_hilo(sheets_service), spreadsheet_id)
+    except Exception as e:
+        print(f"⚠️ Compactación agendada de 'Deuda Pendiente': {e}")
+
+
+def cancelar_compactaciones() -> None:
+    with _COMPACTACIONES_LOCK:
+        for timer in _COMPACTACIONES.values():
+            timer.cancel()
+        _COMPACTACIONES.clear()
+
+
+_LEDGERS_LOCALES = {}
+
+
+def obtener_ledger_local(spreadsheet_id: str | None = None) -> LedgerLocal:
+    """Ledger SQLite del Spreadsheet (un archivo por Spreadsheet, es decir, por usuario)."""
+    spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    with _LEDGERS_LOCK:
+        if spreadsheet_id not in _LEDGERS_LOCALES:
+            os.makedirs(LEDGER_DB_DIR, exist_ok=True)
+            nombre = re.sub(r'[^A-Za-z0-9_-]', '_', spreadsheet_id)
+            _LEDGERS_LOCALES[spreadsheet_id] = LedgerLocal(spreadsheet_id, os.path.join(LEDGER_DB_DIR, f'{nombre}.sqlite3'))
+        return _LEDGERS_LOCALES[spreadsheet_id]
+
+
+def ledger_activo(sheets_service, spreadsheet_id: str | None = None):
+    """Ledger contra el que consultan los agentes: el SQLite local o, con LEDGER_LOCAL=0, la copia de Sheets."""
+    if LEDGER_LOCAL:
+        return obtener_ledger_local(spreadsheet_id).asegurar(sheets_service)
+    return obtener_ledger(spreadsheet_id).asegurar(sheets_service)
+
+
+def ledger_de_factura(sheets_service, factura_id: str, spreadsheet_id: str | None = None):
+    """Como ledger_activo, pero para consultar una sola factura (el SQLite ya filtra por índice)."""
+    if LEDGER_LOCAL:
+        return obtener_ledger_local(spreadsheet_id).asegurar(sheets_service)
+    return obtener_ledger(spreadsheet_id).asegurar_factura(sheets_service, factura_id)
+
+
+def obtener_estadisticas_ledger_local() -> dict:
+    with _LEDGERS_LOCK:
+        ledgers = list(_LEDGERS_LOCALES.values())
+    return agregar_estadisticas([ledger.estadisticas() for ledger in ledgers])
+
+
+def detener_espejos(timeout: float = 10.0) -> None:
+    """Vacía lo que se pueda de las colas del espejo y detiene los hilos."""
+    with _LEDGERS_LOCK:
+        ledgers = list(_LEDGERS_LOCALES.values())
+    for ledger in ledgers:
+        ledger.espejo.detener(timeout)
+
+
+# --- Recordatorios de Google Calendar (usados por el Notificador y por la cola de trabajos) ---
+
+CALENDAR_LOTE_MAX = 50  # peticiones por BatchHttpRequest (límite recomendado por Calendar)
+# Espejo local de los recordatorios, al día con sincronización incremental (syncToken)
+CALENDAR_ESPEJO = os.environ.get('CALENDAR_ESPEJO', '1') == '1'
+CALENDAR_SYNC_INTERVALO = float(os.environ.get('CALENDAR_SYNC_INTERVALO', '15'))  # segundos entre sincronizaciones
+_PATRON_ID_CUOTA = re.compile(r'\[ID: ([^\]\s]+)\]')
+
+
+class LoteCalendarFallido(Exception):
+    """Algunas operaciones del lote fallaron; resultado trae el detalle por cuota."""
+
+    def __init__(self, resultado: list) -> None:
+        self.resultado = resultado
+        errores = [f"{r['cuota_id']}: {r['error']}" for r in resultado if r.get('error')]
+        super().__init__(f"{len(errores)} de {len(resultado)} operación(es) de Calendar fallaron: " + "; ".join(errores))
+
+
+class EspejoCalendar:
+    """
+    Copia local de los recordatorios de pago de un usuario. La primera vez lista el
+    calendario completo; después, con el syncToken, Calendar devuelve solo los eventos que
+    cambiaron (incluidos los movidos o borrados a mano). Nuestras propias escrituras se
+    anotan al momento. Responde "¿existe?" y "¿qué borro?" sin consultar rangos de fechas.
+    """
+
+    def __init__(self, spreadsheet_id: str, calendar_id: str = 'primary') -> None:
+        self.spreadsheet_id = spreadsheet_id
+        self.calendar_id = calendar_id
+        self._eventos: dict[str, dict] = {}
+        self._por_cuota: dict[str, set] = {}
+        self._sync_token = None
+        self._sincronizado_en = None
+        self._lock = threading.RLock()
+        self.stats = {"completas": 0, "incrementales": 0, "eventos_recibidos": 0, "tokens_vencidos": 0}
+
+    def sincronizar(self, calendar_service, forzar: bool = False) -> "EspejoCalendar":
+        with self._lock:
+            if (not forzar and self._sincronizado_en is not None
+                    and time.monotonic() - self._sincronizado_en < CALENDAR_SYNC_INTERVALO):
+                return self
+            if self._sync_token is None:
+                self._listar(calendar_service, {})
+                self.stats["completas"] += 1
+            else:
+                try:
+                    self._listar(calendar_service, {'syncToken': self._sync_token})
+                    self.stats["incrementales"] += 1
+                except HttpError as e:
+                    if _estado_http(e) != 410:
+                        raise
+                    # Token vencido: Calendar exige volver a listar todo
+                    self.stats["tokens_vencidos"] += 1
+                    self._eventos, self._por_cuota, self._sync_token = {}, {}, None
+                    self._listar(calendar_service, {})
+                    self.stats["completas"] += 1
+            self._sincronizado_en = time.monotonic()
+        return self
+
+    def _listar(self, calendar_service, filtro: dict) -> None:
+        pagina = None
+        while True:
+            result = calendar_service.events().list(
+                calendarId=self.calendar_id, showDeleted=True, maxResults=2500, pageToken=pagina,
+                fields='items(id,status,description,start,extendedProperties),nextPageToken,nextSyncToken',
+                **filtro
+            ).execute()
+            for evento in result.get('items', []):
+                self._recibir(evento)
+            self.stats["eventos_recibidos"] += len(result.get('items', []))
+            pagina = result.get('nextPageToken')
+            if not pagina:
+                self._sync_token = result.get('nextSyncToken')
+                return
+
+    def _recibir(self, evento: dict) -> None:
+        privado = (evento.get('extendedProperties') or {}).get('private') or {}
+        if evento.get('status') == 'cancelled' and evento['id'] in self._eventos:
+            # Los borrados llegan sin descripción: basta con marcar el que ya conocemos
+            self._eventos[evento['id']]['estado'] = 'cancelled'
+            return
+        if privado.get('spreadsheet_id') not in (None, self.spreadsheet_id):
+            return
+        cuota_id = privado.get('cuota_id')
+        if not cuota_id:
+            # Recordatorios anteriores a las propiedades privadas: el ID va en la descripción
+            match = _PATRON_ID_CUOTA.search(evento.get('description') or '')
+            if not match:
+                return
+            cuota_id = match.group(1)
+        self.anotar(evento['id'], cuota_id, evento.get('status', 'confirmed'),
+                    (evento.get('start') or {}).get('date'), privado.get('fecha_plan'))
+
+    def anotar(self, evento_id: str, cuota_id: str, estado: str, fecha: str | None = None,
+               fecha_plan: str | None = None) -> None:
+        with self._lock:
+            previo = self._eventos.get(evento_id, {})
+            self._eventos[evento_id] = {
+                "cuota_id": cuota_id, "estado": estado,
+                "fecha": fecha or previo.get("fecha"), "fecha_plan": fecha_plan or previo.get("fecha_plan"),
+            }
+            self._por_cuota.setdefault(cuota_id, set()).add(evento_id)
+
+    def olvidar(self, evento_id: str) -> None:
+        with self._lock:
+            evento = self._eventos.pop(evento_id, None)
+            if evento:
+                self._por_cuota.get(evento["cuota_id"], set()).discard(evento_id)
+
+    def evento(self, evento_id: str) -> dict | None:
+        return self._eventos.get(evento_id)
+
+    def legados(self, cuota_id: str, evento_id: str | None) -> list:
+        """Eventos vigentes de la cuota creados sin ID fijo (o con otro)."""
+        with self._lock:
+            return [i for i in self._por_cuota.get(cuota_id, ())
+                    if i != evento_id and self._eventos[i]["estado"] != 'cancelled']
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            vigentes = sum(1 for e in self._eventos.values() if e["estado"] != 'cancelled')
+        return {**self.stats, "eventos": len(self._eventos), "vigentes": vigentes,
+                "con_token": self._sync_token is not None}
+
+
+_ESPEJOS_CALENDAR = {}
+_ESPEJOS_CALENDAR_LOCK = threading.Lock()
+
+
+def obtener_espejo_calendar(spreadsheet_id: str, calendar_id: str = 'primary') -> EspejoCalendar:
+    """Espejo de recordatorios del usuario (identificado por su Spreadsheet)."""
+    with _ESPEJOS_CALENDAR_LOCK:
+        clave = (spreadsheet_id, calendar_id)
+        if clave not in _ESPEJOS_CALENDAR:
+            _ESPEJOS_CALENDAR[clave] = EspejoCalendar(spreadsheet_id, calendar_id)
+        return _ESPEJOS_CALENDAR[clave]
+
+
+def obtener_estadisticas_espejos_calendar() -> dict:
+    with _ESPEJOS_CALENDAR_LOCK:
+        espejos = list(_ESPEJOS_CALENDAR.values())
+    return agregar_estadisticas([espejo.estadisticas() for espejo in espejos])
+
+
+class CalendarRecordatorios:
+    """
+    Operaciones de Calendar de una cuota. Lanzan HttpError para que la cola pueda reintentar.
+    Cada cuota tiene un ID de evento fijo, derivado del Spreadsheet y del ID de la cuota:
+    crear es idempotente y actualizar o borrar es una sola petición, sin buscar eventos.
+    Con el espejo (EspejoCalendar) se sabe de antemano si el evento existe, si el usuario
+    lo movió o lo borró a mano, y qué recordatorios viejos hay que quitar.
+    """
+
+    def __init__(self, calendar_service, calendar_id: str = 'primary') -> None:
+        self.calendar_service = calendar_service
+        self.calendar_id = calendar_id
+
+    @staticmethod
+    def evento_id(spreadsheet_id: str | None, cuota_id: str) -> str | None:
+        """ID de evento estable (Calendar solo admite base32hex: 0-9 y a-v, 5 a 1024 caracteres)."""
+        if not spreadsheet_id:
+            return None
+        return "cuota" + hashlib.sha1(f"{spreadsheet_id}:{cuota_id}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def titulo(cuota_id: str, monto_pendiente: float) -> str:
+        """Genera título mostrando solo el monto pendiente total."""
+        factura_id, cuota_num = cuota_id.split('-')
+        if monto_pendiente <= 0:
+            return f"✅ PAGO COMPLETADO - Factura {factura_id}, Cuota {cuota_num}"
+        return f"💰 PAGO PENDIENTE - Factura {factura_id}, Cuota {cuota_num}: ${monto_pendiente:,.0f} COP"
+
+    @staticmethod
+    def descripcion(cuota_id: str, monto_pendiente: float) -> str:
+        factura_id, cuota_num = cuota_id.split('-')
+        return f"[ID: {cuota_id}] Pago de cuota #{cuota_num} de Factura {factura_id}. Monto PENDIENTE: ${monto_pendiente:,.0f} COP."
+
+    def _evento(self, cuota_id: str, monto: float, fecha_pago: str, spreadsheet_id: str | None = None) -> dict:
+        evento = {
+            'summary': self.titulo(cuota_id, monto),
+            'description': self.descripcion(cuota_id, monto),
+            'start': {'date': fecha_pago},
+            'end': {'date': fecha_pago},
+            'reminders': {'useDefault': False, 'overrides': [{'method': 'email', 'minutes': 24 * 60}]},
+        }
+        if spreadsheet_id:
+            # Permite reconocer el evento en la sincronización y saber si se movió a mano
+            evento['extendedProperties'] = {'private': {
+                'cuota_id': cuota_id, 'spreadsheet_id': spreadsheet_id, 'fecha_plan': fecha_pago,
+            }}
+        return evento
+
+    def _espejo(self, spreadsheet_id: str | None) -> EspejoCalendar | None:
+        if not CALENDAR_ESPEJO or not spreadsheet_id:
+            return None
+        try:
+            return obtener_espejo_calendar(spreadsheet_id, self.calendar_id).sincronizar(self.calendar_service)
+        except HttpError as e:
+            print(f"⚠️ No se pudo sincronizar el espejo de Calendar: {e}")
+            return None
+
+    def planificar_cuota(self, cuota_id: str, monto: float, fecha_pago: str, spreadsheet_id: str | None = None) -> dict:
+        """Crea el recordatorio de la cuota; con ID fijo, repetirlo no duplica eventos."""
+        if self.evento_id(spreadsheet_id, cuota_id):
+            op = {"tipo": "planificar", "cuota_id": cuota_id, "monto": monto, "fecha": fecha_pago}
+            return {"creado": self.ejecutar_lote([op], spreadsheet_id)[0]["accion"] == "creado"}
+        # Trabajos encolados antes de los IDs fijos: se busca si ese día ya hay uno
+        try:
+            time_min = datetime.strptime(fecha_pago, '%Y-%m-%d').isoformat() + 'Z'
+            time_max = (datetime.strptime(fecha_pago, '%Y-%m-%d') + timedelta(days=1)).isoformat() + 'Z'
+            events_result = self.calendar_service.events().list(
+                calendarId=self.calendar_id, timeMin=time_min, timeMax=time_max,
+                q=cuota_id, singleEvents=True, orderBy='startTime'
+            ).execute()
+            if events_result.get('items', []):
+                return {"creado": False}
+        except HttpError:
+            pass
+        self.crear_o_actualizar(cuota_id, monto, fecha_pago)
+        return {"creado": True}
+
+    def post_abono(self, cuota_id: str, monto_pendiente_nuevo: float, fecha_pago_original: str,
+                   spreadsheet_id: str | None = None) -> dict:
+        """
+        Con saldo, un events.patch del título y la descripción; pagada, un events.delete.
+        Solo si el evento no existe con su ID fijo (creado antes de este esquema) se busca.
+        """
+        if self.evento_id(spreadsheet_id, cuota_id):
+            op = {"tipo": "post_abono", "cuota_id": cuota_id, "monto": monto_pendiente_nuevo, "fecha": fecha_pago_original}
+            return self.ejecutar_lote([op], spreadsheet_id)[0]
+        return self._post_abono_sin_id(cuota_id, monto_pendiente_nuevo, fecha_pago_original, None)
+
+    def _post_abono_sin_id(self, cuota_id: str, monto_pendiente_nuevo: float, fecha_pago_original: str,
+                           spreadsheet_id: str | None) -> dict:
+        """La cuota no tiene evento con ID fijo: se quitan los viejos y, si queda saldo, se crea uno."""
+        espejo = self._espejo(spreadsheet_id)
+        if espejo is not None:
+            eventos_eliminados = 0
+            for evento_id in espejo.legados(cuota_id, self.evento_id(spreadsheet_id, cuota_id)):
+                try:
+                    self.calendar_service.events().delete(calendarId=self.calendar_id, eventId=evento_id).execute()
+                    eventos_eliminados += 1
+                except HttpError as e:
+                    if _estado_http(e) not in (404, 410):
+                        raise
+                espejo.anotar(evento_id, cuota_id, 'cancelled')
+        else:
+            eventos_eliminados = self._eliminar_por_busqueda(cuota_id, fecha_pago_original)
+        if monto_pendiente_nuevo > 0:
+            self.crear_o_actualizar(cuota_id, monto_pendiente_nuevo, fecha_pago_original, spreadsheet_id)
+        return {"eliminados": eventos_eliminados, "creado": monto_pendiente_nuevo > 0}
+
+    def _eliminar_por_busqueda(self, cuota_id: str, fecha_pago_original: str) -> int:
+        """Camino sin espejo ni ID fijo: borra los eventos de la cuota en ±90 días."""
+        fecha_base = datetime.strptime(fecha_pago_original, '%Y-%m-%d')
+        events_result = self.calendar_service.events().list(
+            calendarId=self.calendar_id,
+            timeMin=(fecha_base - timedelta(days=90)).isoformat() + 'Z',
+            timeMax=(fecha_base + timedelta(days=90)).isoformat() + 'Z',
+            singleEvents=True, maxResults=250
+        ).execute()
+
+        factura_id_base, cuota_num = cuota_id.split('-')
+        eventos_eliminados = 0
+        for event in events_result.get('items', []):
+            summary = event.get('summary', '')
+            description = event.get('description', '')
+            match_cuota_id = cuota_id in summary or cuota_id in description
+            match_factura_cuota = (
+                f"Factura {factura_id_base}" in summary and f"Cuota {cuota_num}" in summary
+            ) or (
+                f"Factura {factura_id_base}" in description and f"#{cuota_num}" in description
+            )
+            if not (match_cuota_id or match_factura_cuota):
+                continue
+            try:
+                self.calendar_service.events().delete(calendarId=self.calendar_id, eventId=event['id']).execute()
+                eventos_eliminados += 1
+            except HttpError as e:
+                # Ya borrado (p. ej. en un intento anterior): no es un error
+                if _estado_http(e) not in (404, 410):
+                    raise
+        return eventos_eliminados
+
+    def crear_o_actualizar(self, cuota_id: str, monto_pendiente_nuevo: float, fecha_pago: str,
+                           spreadsheet_id: str | None = None, sobrescribir: bool = True) -> bool:
+        """
+        Crea el recordatorio con cuota_id explícito en la descripción. Con ID fijo, si el
+        evento ya existe (o fue borrado y sigue como cancelado) se reescribe con update;
+        con sobrescribir=False (planificar) un evento vigente se deja como está.
+        Devuelve True si lo creó.
+        """
+        event = self._evento(cuota_id, monto_pendiente_nuevo, fecha_pago, spreadsheet_id)
+        evento_id = self.evento_id(spreadsheet_id, cuota_id)
+        if evento_id is None:
+            self.calendar_service.events().insert(calendarId=self.calendar_id, body=event).execute()
+            return True
+        espejo = obtener_espejo_calendar(spreadsheet_id, self.calendar_id) if CALENDAR_ESPEJO else None
+        creado = True
+        try:
+            self.calendar_service.events().insert(calendarId=self.calendar_id, body={**event, 'id': evento_id}).execute()
+        except HttpError as e:
+            if _estado_http(e) != 409:
+                raise
+            creado = False
+            if not sobrescribir:
+                actual = self.calendar_service.events().get(calendarId=self.calendar_id, eventId=evento_id).execute()
+                if actual.get('status') != 'cancelled':
+                    if espejo is not None:
+                        espejo._recibir(actual)
+                    return False
+            self.calendar_service.events().update(
+                calendarId=self.calendar_id, eventId=evento_id, body={**event, 'status': 'confirmed'}
+            ).execute()
+        if espejo is not None:
+            espejo.anotar(evento_id, cuota_id, 'confirmed', fecha_pago, fecha_pago)
+        return creado
+
+    def _en_lote(self, peticiones: list) -> list:
+        """Envía las peticiones en BatchHttpRequest de hasta 50; devuelve (respuesta, error) en el mismo orden."""
+        if len(peticiones) == 1:
+            # Una sola petición no justifica el sobre multipart del lote
+            try:
+                return [(peticiones[0].execute(), None)]
+            except HttpError as e:
+                return [(None, e)]
+        resultados = [(None, None)] * len(peticiones)
+
+        def _callback(request_id, respuesta, error):
+            resultados[int(request_id)] = (respuesta, error)
+
+        for inicio in range(0, len(peticiones), CALENDAR_LOTE_MAX):
+            lote = self.calendar_service.new_batch_http_request(callback=_callback)
+            for i in range(inicio, min(inicio + CALENDAR_LOTE_MAX, len(peticiones))):
+                lote.add(peticiones[i], request_id=str(i))
+            lote.execute()
+        return resultados
+
+    def _peticiones(self, op: dict, spreadsheet_id: str, espejo: EspejoCalendar | None) -> tuple:
+        """
+        Decide qué pedirle a Calendar para una operación. Devuelve (acción_sin_petición,
+        [(acción, evento_id, petición)]). Sin espejo se intenta a ciegas y se corrige con
+        los 409/404; con espejo se elige de entrada.
+        """
+        eventos = self.calendar_service.events()
+        cuota_id, monto, fecha = op["cuota_id"], op["monto"], op["fecha"]
+        evento_id = self.evento_id(spreadsheet_id, cuota_id)
+        conocido = espejo.evento(evento_id) if espejo is not None else None
+        cuerpo = self._evento(cuota_id, monto, fecha, spreadsheet_id)
+
+        if op["tipo"] == 'planificar':
+            if conocido and conocido["estado"] != 'cancelled':
+                # Ya está: planificar nunca pisa un recordatorio vigente (la factura ya existía,
+                # o el usuario lo movió a mano); solo se reactiva uno cancelado
+                return "existente", []
+            if conocido:
+                return None, [("reescrito", evento_id, eventos.update(
+                    calendarId=self.calendar_id, eventId=evento_id, body={**cuerpo, 'status': 'confirmed'}))]
+            return None, [("creado", evento_id, eventos.insert(calendarId=self.calendar_id, body={**cuerpo, 'id': evento_id}))]
+
+        if espejo is not None and conocido is None:
+            # Sin evento con ID fijo: se quitan los viejos y, si queda saldo, se crea el nuevo
+            peticiones = [("legado", legado, eventos.delete(calendarId=self.calendar_id, eventId=legado))
+                          for legado in espejo.legados(cuota_id, evento_id)]
+            if monto > 0:
+                peticiones.append(("creado", evento_id, eventos.insert(
+                    calendarId=self.calendar_id, body={**cuerpo, 'id': evento_id})))
+            return ("eliminado" if monto <= 0 else None), peticiones
+        if conocido and conocido["estado"] == 'cancelled':
+            return ("eliminado" if monto <= 0 else "omitido"), []  # el usuario lo borró a mano
+        if monto > 0:
+            return None, [("actualizado", evento_id, eventos.patch(
+                calendarId=self.calendar_id, eventId=evento_id,
+                body={'summary': cuerpo['summary'], 'description': cuerpo['description']}))]
+        return None, [("eliminado", evento_id, eventos.delete(calendarId=self.calendar_id, eventId=evento_id))]
+
+    def ejecutar_lote(self, operaciones: list, spreadsheet_id: str | None = None) -> list:
+        """
+        Todas las operaciones de Calendar de un mensaje en una sola ida (BatchHttpRequest).
+        Cada operación es {"tipo": "planificar"|"post_abono", "cuota_id", "monto", "fecha"}.
+        Los 409 de un insert se consultan en un segundo lote y solo los cancelados se
+        reescriben (planificar no pisa un recordatorio vigente); los 404 (eventos sin ID fijo)
+        van por el camino sin ID. Devuelve el resultado por cuota y, si alguna falló,
+        lanza LoteCalendarFallido para que la cola reintente (todas las operaciones son idempotentes).
+        """
+        resultado = [{"cuota_id": op["cuota_id"], "tipo": op["tipo"], "accion": None, "error": None} for op in operaciones]
+        if not self.evento_id(spreadsheet_id, 'x-0'):
+            # Sin Spreadsheet no hay IDs fijos: una petición por cuota, como antes
+            for op, r in zip(operaciones, resultado):
+                if op["tipo"] == 'planificar':
+                    r["accion"] = "creado" if self.planificar_cuota(op["cuota_id"], op["monto"], op["fecha"])["creado"] else "existente"
+                else:
+                    self.post_abono(op["cuota_id"], op["monto"], op["fecha"])
+                    r["accion"] = "actualizado" if op["monto"] > 0 else "eliminado"
+            return resultado
+
+        espejo = self._espejo(spreadsheet_id)
+        pendientes = []  # (índice de la operación, acción, evento_id, petición)
+        for i, op in enumerate(operaciones):
+            accion, peticiones = self._peticiones(op, spreadsheet_id, espejo)
+            resultado[i]["accion"] = accion
+            pendientes.extend((i, *p) for p in peticiones)
+
+        reescribir, sin_id = [], []
+        for (i, accion, evento_id, _peticion), (_respuesta, error) in zip(
+                pendientes, self._en_lote([p[3] for p in pendientes])):
+            op = operaciones[i]
+            estado = _estado_http(error) if error else None
+            if error is None or (estado == 410 and accion in ("eliminado", "legado")) or (estado == 404 and accion == "legado"):
+                if accion == "legado":
+                    resultado[i]["eliminados"] = resultado[i].get("eliminados", 0) + 1
+                else:
+                    resultado[i]["accion"] = accion
+                if espejo is not None:
+                    borrado = accion in ("eliminado", "legado")
+                    espejo.anotar(evento_id, op["cuota_id"], 'cancelled' if borrado else 'confirmed',
+                                  None if borrado or accion == "actualizado" else op["fecha"],
+                                  None if borrado or accion == "actualizado" else op["fecha"])
+            elif accion == "creado" and estado == 409:
+                reescribir.append(i)
+            elif accion in ("actualizado", "eliminado", "reescrito") and estado == 404:
+                if espejo is not None:
+                    espejo.olvidar(evento_id)  # el espejo estaba atrasado
+                sin_id.append(i)
+            else:
+                resultado[i]["error"] = str(error)[:300]
+
+        if reescribir:
+            # El ID ya existía: un evento vigente se respeta; solo uno cancelado se reescribe.
+            # Ambos pasos van en lote (primero los get, después los update)
+            consultas = [self.calendar_service.events().get(
+                calendarId=self.calendar_id, eventId=self.evento_id(spreadsheet_id, operaciones[i]["cuota_id"]))
+                for i in reescribir]
+            cancelados = []
+            for i, (actual, error) in zip(reescribir, self._en_lote(consultas)):
+                if error is not None:
+                    resultado[i]["error"] = str(error)[:300]
+                elif actual.get('status') == 'cancelled':
+                    cancelados.append(i)
+                else:
+                    resultado[i]["accion"] = "existente"
+                    if espejo is not None:
+                        espejo._recibir(actual)
+            actualizaciones = []
+            for i in cancelados:
+                op = operaciones[i]
+                cuerpo = self._evento(op["cuota_id"], op["monto"], op["fecha"], spreadsheet_id)
+                actualizaciones.append(self.calendar_service.events().update(
+                    calendarId=self.calendar_id, eventId=self.evento_id(spreadsheet_id, op["cuota_id"]),
+                    body={**cuerpo, 'status': 'confirmed'}))
+            for i, (_respuesta, error) in zip(cancelados, self._en_lote(actualizaciones)):
+                if error is None:
+                    resultado[i]["accion"] = "reescrito"
+                    if espejo is not None:
+                        op = operaciones[i]
+                        espejo.anotar(self.evento_id(spreadsheet_id, op["cuota_id"]), op["cuota_id"], 'confirmed', op["fecha"], op["fecha"])
+                else:
+                    resultado[i]["error"] = str(error)[:300]
+
+        for i in sin_id:
+            op = operaciones[i]
+            try:
+                if op["tipo"] == 'planificar':
+                    creado = self.crear_o_actualizar(op["cuota_id"], op["monto"], op["fecha"], spreadsheet_id, sobrescribir=False)
+                    resultado[i]["accion"] = "creado" if creado else "existente"
+                else:
+                    r = self._post_abono_sin_id(op["cuota_id"], op["monto"], op["fecha"], spreadsheet_id)
+                    resultado[i]["accion"] = "actualizado" if op["monto"] > 0 else "eliminado"
+                    resultado[i]["eliminados"] = r.get("eliminados", 0)
+            except HttpError as e:
+                resultado[i]["error"] = str(e)[:300]
+
+        if any(r["error"] for r in resultado):
+            raise LoteCalendarFallido(resultado)
+        return resultado
+
+
+# --- Cola durable de trabajos con efectos secundarios (escritura diferida) ---
+
+TRABAJOS_DIFERIDOS = os.environ.get('TRABAJOS_DIFERIDOS', '1') == '1'
+TRABAJOS_DB = os.environ.get('TRABAJOS_DB', 'trabajos.sqlite3')
+TRABAJOS_WORKERS = int(os.environ.get('TRABAJOS_WORKERS', '2'))
+TRABAJOS_MAX_INTENTOS = int(os.environ.get('TRABAJOS_MAX_INTENTOS', '6'))
+TRABAJOS_BACKOFF_BASE = float(os.environ.get('TRABAJOS_BACKOFF_BASE', '2'))  # segundos; se duplica por intento
+TRABAJOS_SIN_SERVICIO_TTL = float(os.environ.get('TRABAJOS_SIN_SERVICIO_TTL', str(24 * 3600)))  # espera máxima por un servicio
+
+# Identifica el mensaje de chat en curso: agrupa sus trabajos para el endpoint de estado
+MENSAJE_ACTUAL = contextvars.ContextVar('mensaje_actual', default=None)
+
+MANEJADORES_TRABAJOS = {
+    'calendar_planificar': lambda cal, d: cal.planificar_cuota(d["cuota_id"], d["monto"], d["fecha"], d.get("spreadsheet_id")),
+    'calendar_post_abono': lambda cal, d: cal.post_abono(d["cuota_id"], d["monto"], d["fecha"], d.get("spreadsheet_id")),
+    'calendar_lote': lambda cal, d: cal.ejecutar_lote(d["operaciones"], d.get("spreadsheet_id")),
+}
+
+
+class ColaTrabajos:
+    """
+    Cola persistente (SQLite) de efectos secundarios: el agente encola y responde, y un
+    pool de hilos los ejecuta con reintentos y backoff exponencial. Cada trabajo lleva una
+    clave de idempotencia: encolar dos veces lo mismo devuelve el trabajo existente.
+    Los trabajos de un mismo grupo (la cuota) se ejecutan en orden, nunca en paralelo.
+    """
+
+    def __init__(self, path: str, workers: int = TRABAJOS_WORKERS) -> None:
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            " id TEXT PRIMARY KEY, clave TEXT NOT NULL UNIQUE, tipo TEXT NOT NULL, datos TEXT NOT NULL,"
+            " usuario TEXT NOT NULL, mensaje_id TEXT, grupo TEXT, estado TEXT NOT NULL DEFAULT 'pendiente',"
+            " intentos INTEGER NOT NULL DEFAULT 0, proximo_intento REAL NOT NULL, resultado TEXT,"
+            " error TEXT, creado REAL NOT NULL, actualizado REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_trabajos_cola ON trabajos(estado, proximo_intento);"
+            "CREATE INDEX IF NOT EXISTS idx_trabajos_mensaje ON trabajos(mensaje_id);"
+            "CREATE INDEX IF NOT EXISTS idx_trabajos_grupo ON trabajos(grupo, estado);"
+        )
+        # Trabajos que quedaron a medias por un reinicio vuelven a la cola
+        self._db.execute("UPDATE trabajos SET estado = 'pendiente' WHERE estado = 'en_curso'")
+        self._db.commit()
+        self._servicios = {}   # (usuario, tipo_servicio) -> servicio de Google del agente
+        self._clientes = ClientesPorHilo()  # cada worker, su propio cliente por (usuario, tipo_servicio)
+        self._ultima_expiracion = 0.0
+        self._evento = threading.Event()
+        self._detener = threading.Event()
+        self.stats = {"encolados": 0, "duplicados": 0, "completados": 0, "reintentos": 0, "fallidos": 0, "expirados": 0}
+        self._hilos = [
+            threading.Thread(target=self._bucle, name=f"trabajos-{i}", daemon=True) for i in range(max(1, workers))
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def registrar_servicio(self, usuario: str, tipo_servicio: str, servicio) -> None:
+        with self._lock:
+            self._servicios[(usuario, tipo_servicio)] = servicio
+        self._evento.set()
+
+    def encolar(self, tipo: str, datos: dict, clave: str, usuario: str, mensaje_id: str | None = None,
+                grupo: str | None = None) -> str:
+        """Devuelve el id del trabajo (el existente si la clave ya estaba encolada)."""
+        ahora = time.time()
+        trabajo_id = uuid.uuid4().hex
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO trabajos (id, clave, tipo, datos, usuario, mensaje_id, grupo, proximo_intento, creado, actualizado)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (trabajo_id, clave, tipo, json.dumps(datos), usuario, mensaje_id, grupo, ahora, ahora, ahora)
+            )
+            if cursor.rowcount == 0:
+                self.stats["duplicados"] += 1
+                return self._db.execute("SELECT id FROM trabajos WHERE clave = ?", (clave,)).fetchone()[0]
+            self.stats["encolados"] += 1
+        self._evento.set()
+        return trabajo_id
+
+    # Servicio que necesita cada trabajo ('calendar_lote' -> 'calendar') junto al usuario dueño
+    _SQL_SERVICIO = "substr(tipo, 1, instr(tipo, '_') - 1) || ':' || usuario"
+
+    def _con_servicio(self) -> tuple[str, list]:
+        """Condición SQL 'el trabajo tiene su servicio registrado' (llamar con self._lock tomado)."""
+        registrados = [f"{tipo_servicio}:{usuario}" for usuario, tipo_servicio in self._servicios]
+        if not registrados:
+            return "0", []
+        return f"{self._SQL_SERVICIO} IN ({','.join('?' * len(registrados))})", registrados
+
+    def _tomar(self):
+        """Marca como en curso el próximo trabajo listo cuyo servicio esté disponible."""
+        ahora = time.time()
+        with self._lock, self._db:
+            con_servicio, params = self._con_servicio()
+            self._expirar_sin_servicio(ahora, con_servicio, params)
+            if not params:
+                return None
+            # Sin servicio registrado (p. ej. tras reiniciar) el trabajo espera al próximo mensaje
+            # del usuario; se filtra en SQL para que esos trabajos no tapen a los de otros usuarios
+            fila = self._db.execute(
+                "SELECT id, tipo, datos, usuario, intentos FROM trabajos t "
+                f"WHERE estado = 'pendiente' AND proximo_intento <= ? AND {con_servicio} AND NOT EXISTS ("
+                " SELECT 1 FROM trabajos p WHERE t.grupo IS NOT NULL AND p.grupo = t.grupo"
+                " AND p.estado IN ('pendiente', 'en_curso') AND p.rowid < t.rowid)"
+                " ORDER BY rowid LIMIT 1", (ahora, *params)
+            ).fetchone()
+            if fila is None:
+                return None
+            trabajo_id, tipo, datos, usuario, intentos = fila
+            self._db.execute(
+                "UPDATE trabajos SET estado = 'en_curso', actualizado = ? WHERE id = ?", (ahora, trabajo_id)
+            )
+            return trabajo_id, tipo, json.loads(datos), usuario, intentos
+
+    def _expirar_sin_servicio(self, ahora: float, con_servicio: str, params: list) -> None:
+        """Da por fallidos los trabajos que llevan TRABAJOS_SIN_SERVICIO_TTL sin servicio para ejecutarse."""
+        if ahora - self._ultima_expiracion < 60:
+            return
+        self._ultima_expiracion = ahora
+        cursor = self._db.execute(
+            "UPDATE trabajos SET estado = 'error', error = ?, actualizado = ? "
+            f"WHERE estado = 'pendiente' AND creado < ? AND NOT ({con_servicio})",
+            ("Sin servicio de Google registrado para el usuario (expirado)", ahora,
+             ahora - TRABAJOS_SIN_SERVICIO_TTL, *params)
+        )
+        if cursor.rowcount:
+            self.stats["expirados"] += cursor.rowcount
+            print(f"⌛ {cursor.rowcount} trabajo(s) expirados sin servicio registrado")
+
+    def _cliente(self, usuario: str, tipo_servicio: str):
+        with self._lock:
+            servicio = self._servicios[(usuario, tipo_servicio)]
+        if tipo_servicio == 'calendar':
+            construir = lambda s: CalendarRecordatorios(_servicio_para_hilo(s, 'calendar', 'v3'))
+        else:
+            construir = _servicio_para_hilo
+        return self._clientes.obtener((usuario, tipo_servicio), servicio, construir)
+
+    def _bucle(self) -> None:
+        while not self._detener.is_set():
+            tomado = self._tomar()
+            if tomado is None:
+                self._evento.wait(1.0)
+                self._evento.clear()
+                continue
+            self._ejecutar(*tomado)
+
+    def _ejecutar(self, trabajo_id: str, tipo: str, datos: dict, usuario: str, intentos: int) -> None:
+        try:
+            resultado = MANEJADORES_TRABAJOS[tipo](self._cliente(usuario, tipo.split('_')[0]), datos)
+        except Exception as e:
+            intentos += 1
+            definitivo = intentos >= TRABAJOS_MAX_INTENTOS or isinstance(e, (KeyError, ValueError))
+            espera = TRABAJOS_BACKOFF_BASE * (2 ** (intentos - 1))
+            # Los lotes dejan el detalle por ítem aunque fallen
+            parcial = getattr(e, 'resultado', None)
+            with self._lock, self._db:
+                self._db.execute(
+                    "UPDATE trabajos SET estado = ?, intentos = ?, error = ?, resultado = ?, proximo_intento = ?, actualizado = ? WHERE id = ?",
+                    ('error' if definitivo else 'pendiente', intentos, str(e)[:500],
+                     json.dumps(parcial, default=str) if parcial is not None else None,
+                     time.time() + espera, time.time(), trabajo_id)
+                )
+                self.stats["fallidos" if definitivo else "reintentos"] += 1
+            return
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE trabajos SET estado = 'completado', intentos = ?, resultado = ?, error = NULL, actualizado = ? WHERE id = ?",
+                (intentos + 1, json.dumps(resultado, default=str), time.time(), trabajo_id)
+            )
+            self.stats["completados"] += 1
+
+    def trabajos_de_mensaje(self, mensaje_id: str, usuario: str | None = None) -> list:
+        sql = ("SELECT id, tipo, datos, estado, intentos, error, resultado, creado, actualizado "
+               "FROM trabajos WHERE mensaje_id = ?")
+        params = [mensaje_id]
+        if usuario is not None:
+            sql += " AND usuario = ?"
+            params.append(usuario)
+        with self._lock:
+            filas = self._db.execute(sql + " ORDER BY creado", params).fetchall()
+        return [
+            {"id": f[0], "tipo": f[1], "datos": json.loads(f[2]), "estado": f[3], "intentos": f[4],
+             "error": f[5], "resultado": json.loads(f[6]) if f[6] else None, "creado": f[7], "actualizado": f[8]}
+            for f in filas
+        ]
+
+    def detener(self, timeout: float = 10.0) -> None:
+        """Deja terminar lo que esté en curso y para los hilos (lo pendiente sigue en disco)."""
+        self._detener.set()
+        self._evento.set()
+        limite = time.monotonic() + timeout
+        for hilo in self._hilos:
+            hilo.join(max(0.0, limite - time.monotonic()))
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            por_estado = dict(self._db.execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado").fetchall())
+        return {**self.stats, "por_estado": por_estado, "workers": len(self._hilos),
+                "servicios_registrados": len(self._servicios)}
+
+
+_COLA_TRABAJOS = None
+
+
+def obtener_cola_trabajos() -> ColaTrabajos:
+    global _COLA_TRABAJOS
+    with _LEDGERS_LOCK:
+        if _COLA_TRABAJOS is None:
+            _COLA_TRABAJOS = ColaTrabajos(TRABAJOS_DB)
+        return _COLA_TRABAJOS
+
+
+def encolar_trabajo(tipo: str, datos: dict, clave: str) -> str:
+    """Encola un trabajo del usuario y mensaje en curso; la clave se acota a ese mensaje."""
+    usuario = USUARIO_ACTUAL.get()
+    mensaje_id = MENSAJE_ACTUAL.get()
+    clave_completa = f"{usuario}:{mensaje_id or uuid.uuid4().hex}:{clave}"
+    # Orden por cuota; los lotes de Calendar ordenan por factura (abarcan varias cuotas)
+    grupo = datos.get('cuota_id') or datos.get('factura_id')
+    grupo = f"{usuario}:{grupo}" if grupo else None
+    return obtener_cola_trabajos().encolar(tipo, datos, clave_completa, usuario, mensaje_id, grupo)
+
+
+def estado_de_mensaje(mensaje_id: str, usuario: str | None = None, spreadsheet_id: str | None = None) -> dict:
+    """Estado de todo lo que dejó pendiente un mensaje: trabajos de Calendar y réplicas a Sheets."""
+    calendar = obtener_cola_trabajos().trabajos_de_mensaje(mensaje_id, usuario) if TRABAJOS_DIFERIDOS else []
+    sheets = {}
+    if LEDGER_LOCAL and spreadsheet_id:
+        sheets = obtener_ledger_local(spreadsheet_id).estado_de_mensaje(mensaje_id)
+    pendientes = sum(1 for t in calendar if t["estado"] in ('pendiente', 'en_curso'))
+    pendientes += sheets.get('pendiente', 0)
+    errores = sum(1 for t in calendar if t["estado"] == 'error') + sheets.get('error', 0)
+    return {
+        "mensaje_id": mensaje_id,
+        "completo": pendientes == 0,
+        "pendientes": pendientes,
+        "errores": errores,
+        "calendar": calendar,
+        "sheets": sheets,
+    }
+
+
+def obtener_estadisticas_trabajos() -> dict:
+    return obtener_cola_trabajos().estadisticas() if TRABAJOS_DIFERIDOS else {}
+
+
+def detener_trabajos(timeout: float = 10.0) -> None:
+    if _COLA_TRABAJOS is not None:
+        _COLA_TRABAJOS.detener(timeout)
+
+
+# --- Llamadas bloqueantes a Google fuera del event loop ---
+
+GOOGLE_HILOS = int(os.environ.get('GOOGLE_HILOS', '8'))
+# Peticiones simultáneas por API (las cuotas de Sheets y Calendar se cuentan por separado)
+GOOGLE_CONCURRENCIA = {
+    'sheets': int(os.environ.get('GOOGLE_CONCURRENCIA_SHEETS', '4')),
+    'calendar': int(os.environ.get('GOOGLE_CONCURRENCIA_CALENDAR', '4')),
+}
+_VERSIONES_GOOGLE = {'sheets': 'v4', 'calendar': 'v3'}
+_SEMAFOROS_GOOGLE = {api: threading.BoundedSemaphore(max(1, n)) for api, n in GOOGLE_CONCURRENCIA.items()}
+_EJECUTOR_GOOGLE = None
+_EJECUTOR_GOOGLE_LOCK = threading.Lock()
+_google_stats = {"llamadas": 0, "errores": 0, "en_curso": 0, "max_en_curso": 0, "espera_cupo_s": 0.0}
+_google_stats_lock = threading.Lock()
+
+
+def _ejecutor_google():
+    global _EJECUTOR_GOOGLE
+    with _EJECUTOR_GOOGLE_LOCK:
+        if _EJECUTOR_GOOGLE is None:
+            _EJECUTOR_GOOGLE = concurrent.futures.ThreadPoolExecutor(max_workers=GOOGLE_HILOS, thread_name_prefix='google')
+        return _EJECUTOR_GOOGLE
+
+
+_CLIENTES_GOOGLE = ClientesPorHilo()
+
+
+def _cliente_de_hilo(servicio, api: str):
+    """
+    Cada hilo del pool usa su propio cliente (httplib2 no es seguro entre hilos), por usuario
+    y API: server.py crea servicios nuevos en cada mensaje, pero con las mismas credenciales
+    el cliente se reutiliza, y el tope LRU acota la memoria por hilo.
+    """
+    return _CLIENTES_GOOGLE.obtener(
+        (USUARIO_ACTUAL.get(), api), servicio,
+        lambda s: _servicio_para_hilo(s, api, _VERSIONES_GOOGLE.get(api, 'v4'))
+    )
+
+
+def _llamar_con_cupo(servicio, fn, api: str):
+    semaforo = _SEMAFOROS_GOOGLE.get(api)
+    inicio = time.perf_counter()
+    if semaforo is not None:
+        semaforo.acquire()
+    try:
+        with _google_stats_lock:
+            _google_stats["espera_cupo_s"] += time.perf_counter() - inicio
+            _google_stats["en_curso"] += 1
+            _google_stats["max_en_curso"] = max(_google_stats["max_en_curso"], _google_stats["en_curso"])
+        try:
+            return fn(_cliente_de_hilo(servicio, api))
+        except Exception:
+            with _google_stats_lock:
+                _google_stats["errores"] += 1
+            raise
+    finally:
+        with _google_stats_lock:
+            _google_stats["en_curso"] -= 1
+            _google_stats["llamadas"] += 1
+        if semaforo is not None:
+            semaforo.release()
+
+
+async def llamar_google(servicio, fn, api: str = 'sheets'):
+    """
+    Ejecuta fn(cliente) en el pool de hilos de Google, donde fn hace el .execute() (o usa
+    el ledger) con el cliente del hilo. El event loop queda libre, así que los agentes
+    pueden hacer asyncio.gather de llamadas independientes. Conserva el contexto
+    (usuario y mensaje en curso) y respeta el cupo de peticiones simultáneas por API.
+    """
+    contexto = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_ejecutor_google(), contexto.run, _llamar_con_cupo, servicio, fn, api)
+
+
+def obtener_estadisticas_google() -> dict:
+    with _google_stats_lock:
+        return {**_google_stats, "espera_cupo_s": round(_google_stats["espera_cupo_s"], 3),
+                "hilos": GOOGLE_HILOS, "concurrencia": dict(GOOGLE_CONCURRENCIA)}
+
+
+def cerrar_ejecutor_google() -> None:
+    global _EJECUTOR_GOOGLE
+    with _EJECUTOR_GOOGLE_LOCK:
+        if _EJECUTOR_GOOGLE is not None:
+            _EJECUTOR_GOOGLE.shutdown(wait=True)
+            _EJECUTOR_GOOGLE = None
+
+
+def benchmark_fanout_planificado(mensajes: int = 10, latencia: float = 0.2) -> dict:
+    """
+    Mide el fan-out de PLANNED (insert en Calendar + append en Sheets por factura) con
+    servicios simulados de latencia fija: llamadas bloqueantes en el event loop, una tras
+    otra, contra el adaptador con asyncio.gather. Devuelve segundos por escenario.
+    """
+    class _Peticion:
+        def execute(self):
+            time.sleep(latencia)
+            return {}
+
+    class _Simulado:
+        def events(self):
+            return self
+
+        def spreadsheets(self):
+            return self
+
+        def values(self):
+            return self
+
+        def insert(self, **kwargs):
+            return _Peticion()
+
+        def append(self, **kwargs):
+            return _Peticion()
+
+    calendar, sheets = _Simulado(), _Simulado()
+
+    def _calendar(c):
+        return c.events().insert(calendarId='primary', body={}).execute()
+
+    def _sheets(s):
+        return s.spreadsheets().values().append(spreadsheetId='bench', range='Deuda Pendiente!A:H', body={}).execute()
+
+    async def _bloqueante(n):
+        for _ in range(n):
+            _calendar(calendar)
+            _sheets(sheets)
+
+    async def _concurrente(n):
+        await asyncio.gather(*(
+            asyncio.gather(llamar_google(calendar, _calendar, 'calendar'), llamar_google(sheets, _sheets, 'sheets'))
+            for _ in range(n)
+        ))
+
+    def _medir(corrutina):
+        inicio = time.perf_counter()
+        asyncio.run(corrutina)
+        return round(time.perf_counter() - inicio, 3)
+
+    resultado = {
+        "mensajes": mensajes, "latencia_s": latencia,
+        "un_mensaje_bloqueante_s": _medir(_bloqueante(1)),
+        "un_mensaje_concurrente_s": _medir(_concurrente(1)),
+        "lote_bloqueante_s": _medir(_bloqueante(mensajes)),
+        "lote_concurrente_s": _medir(_concurrente(mensajes)),
+    }
+    resultado["aceleracion_lote"] = round(resultado["lote_bloqueante_s"] / resultado["lote_concurrente_s"], 1)
+    return resultado
+
+
+# --- Cliente HTTP compartido para OpenRouter ---
+
+OPENROUTER_TIMEOUT = float(os.environ.get('OPENROUTER_TIMEOUT', '25'))
+OPENROUTER_MAX_CONNECTIONS = int(os.environ.get('OPENROUTER_MAX_CONNECTIONS', '20'))
+OPENROUTER_MAX_KEEPALIVE = int(os.environ.get('OPENROUTER_MAX_KEEPALIVE', '10'))
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.environ.get('OPENROUTER_KEEPALIVE_EXPIRY', '60'))
+
+try:
+    import h2  # noqa: F401  (HTTP/2 es opcional: pip install httpx[http2])
+    HTTP2_DISPONIBLE = True
+except ImportError:
+    HTTP2_DISPONIBLE = False
+
+_http_client = None
+_http_client_loop = None
+_http_stats = {
+    "solicitudes": 0,
+    "conexiones_nuevas": 0,
+    "conexiones_reusadas": 0,
+    "respuestas_http2": 0,
+    "clientes_creados": 0,
+}
+
+
+def _obtener_cliente_http() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente httpx del proceso (keep-alive + HTTP/2 si está disponible).
+    Un AsyncClient queda atado a su event loop, así que se recrea si el loop cambió.
+    """
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            timeout=OPENROUTER_TIMEOUT,
+            http2=HTTP2_DISPONIBLE,
+            limits=httpx.Limits(
+                max_connections=OPENROUTER_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+                keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _http_client_loop = loop
+        _http_stats["clientes_creados"] += 1
+
+    return _http_client
+
+
+async def cerrar_cliente_http() -> None:
+    """Cierra el cliente compartido (llamar al apagar el proceso)."""
+    global _http_client, _http_client_loop
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+    _http_client_loop = None
+
+
+def _nuevo_trace():
+    """Callback de trace de httpcore que detecta si la petición abrió una conexión nueva."""
+    estado = {"conexion_nueva": False}
+
+    async def _trace(event_name, info):
+        if event_name.startswith("connection.connect_tcp"):
+            estado["conexion_nueva"] = True
+
+    return _trace, estado
+
+
+def _contar_respuesta_http(response: httpx.Response, estado_trace: dict) -> None:
+    _http_stats["solicitudes"] += 1
+    _http_stats["conexiones_nuevas" if estado_trace["conexion_nueva"] else "conexiones_reusadas"] += 1
+    if response.http_version == "HTTP/2":
+        _http_stats["respuestas_http2"] += 1
+
+
+async def _post_openrouter(payload: dict, headers: dict, timeout: float | None = None) -> httpx.Response:
+    """POST a OpenRouter con el cliente compartido, contando reúso de conexiones."""
+    client = _obtener_cliente_http()
+    trace, estado_trace = _nuevo_trace()
+
+    response = await client.post(
+        OPENROUTER_URL,
+        headers=headers,
+        json=payload,
+        timeout=timeout if timeout is not None else OPENROUTER_TIMEOUT,
+        extensions={"trace": trace},
+    )
+
+    _contar_respuesta_http(response, estado_trace)
+    return response
+
+
+_stream_stats = {"streams": 0, "cortes_tempranos": 0, "chunks": 0}
+
+
+async def _stream_openrouter(payload: dict, headers: dict, detener_en,
+                             timeout: float | None = None) -> tuple[httpx.Response, str | None]:
+    """
+    POST con stream=True (SSE). Acumula el contenido y cierra el stream en cuanto
+    detener_en(texto_acumulado) es verdadero. Devuelve (response, texto); texto es None
+    si la respuesta no fue 200 (el cuerpo queda leído para inspeccionarlo).
+    """
+    client = _obtener_cliente_http()
+    trace, estado_trace = _nuevo_trace()
+    partes = []
+
+    async with client.stream(
+        "POST",
+        OPENROUTER_URL,
+        headers=headers,
+        json={**payload, "stream": True},
+        timeout=timeout if timeout is not None else OPENROUTER_TIMEOUT,
+        extensions={"trace": trace},
+    ) as response:
+        _contar_respuesta_http(response, estado_trace)
+        if response.status_code != 200:
+            await response.aread()
+            return response, None
+
+        _stream_stats["streams"] += 1
+        async for line in response.aiter_lines():
+            # Las líneas que empiezan con ':' son comentarios SSE (keep-alive de OpenRouter)
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content") or ""
+            if not delta:
+                continue
+            _stream_stats["chunks"] += 1
+            partes.append(delta)
+            if detener_en("".join(partes)):
+                _stream_stats["cortes_tempranos"] += 1
+                break
+
+    return response, "".join(partes)
+
+
+def obtener_estadisticas_stream() -> dict:
+    return dict(_stream_stats)
+
+
+def obtener_estadisticas_http() -> dict:
+    """Estadísticas de reúso de conexiones hacia OpenRouter."""
+    total = _http_stats["solicitudes"]
+    return {
+        **_http_stats,
+        "http2_habilitado": HTTP2_DISPONIBLE,
+        "tasa_reuso": round(_http_stats["conexiones_reusadas"] / total, 3) if total else 0.0,
+    }
+
+# --- Caché persistente de respuestas del LLM ---
+
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+LLM_CACHE_MAX_ITEMS = int(os.environ.get('LLM_CACHE_MAX_ITEMS', '2000'))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', str(24 * 3600)))
+
+
+def _hash_texto(texto: str) -> str:
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+
+def _normalizar_input(texto: str) -> str:
+    """Normaliza el input del usuario para la clave de caché (espacios y Unicode, no mayúsculas)."""
+    return " ".join(unicodedata.normalize('NFC', texto).split())
+
+
+class LLMCache:
+    """
+    Caché direccionada por contenido para respuestas deterministas (temperature 0.0).
+    Clave: (modelos, hash del system prompt, input normalizado).
+    Memoria LRU+TTL respaldada por SQLite para sobrevivir reinicios.
+    La base se abre en el primer uso, no al importar el módulo.
+    """
+
+    def __init__(self, path: str | None, max_items: int = 2000, ttl: float = 24 * 3600) -> None:
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self._memoria = OrderedDict()  # clave -> (timestamp, prompt_hash, respuesta)
+        self._lock = threading.Lock()
+        self.stats = {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "escrituras": 0, "expirados": 0, "invalidados": 0}
+        self._db = None
+        self._abierta = False
+        self._vigentes = None  # hashes a retener al abrir la base (ver retener_prompts)
+
+    def _conexion(self):
+        """Abre la base SQLite la primera vez (llamar con self._lock tomado)."""
+        if self._abierta:
+            return self._db
+        self._abierta = True
+        if not self.path:
+            return None
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "clave TEXT PRIMARY KEY, prompt_hash TEXT NOT NULL, "
+                "respuesta TEXT NOT NULL, creado REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_prompt ON llm_cache(prompt_hash)")
+            if self._vigentes:
+                self.stats["invalidados"] += self._borrar_prompts_obsoletos(self._vigentes)
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Caché LLM sin persistencia: {e}")
+            self._db = None
+        return self._db
+
+    @staticmethod
+    def clave(modelos, system_prompt: str, user_prompt: str) -> tuple[str, str]:
+        """Devuelve (clave, prompt_hash)."""
+        prompt_hash = _hash_texto(system_prompt)
+        modelos_str = ",".join(modelos) if isinstance(modelos, (list, tuple)) else str(modelos)
+        clave = _hash_texto(f"{modelos_str}\x00{prompt_hash}\x00{_normalizar_input(user_prompt)}")
+        return clave, prompt_hash
+
+    def get(self, clave: str) -> str | None:
+        ahora = time.time()
+        with self._lock:
+            item = self._memoria.get(clave)
+            if item is not None:
+                if ahora - item[0] <= self.ttl:
+                    self._memoria.move_to_end(clave)
+                    self.stats["hits_memoria"] += 1
+                    return item[2]
+                del self._memoria[clave]
+                self.stats["expirados"] += 1
+
+            db = self._conexion()
+            if db is not None:
+                row = db.execute(
+                    "SELECT creado, prompt_hash, respuesta FROM llm_cache WHERE clave = ?", (clave,)
+                ).fetchone()
+                if row is not None:
+                    if ahora - row[0] <= self.ttl:
+                        self._guardar_en_memoria(clave, row)
+                        self.stats["hits_disco"] += 1
+                        return row[2]
+                    db.execute("DELETE FROM llm_cache WHERE clave = ?", (clave,))
+                    db.commit()
+                    self.stats["expirados"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, clave: str, prompt_hash: str, respuesta: str) -> None:
+        item = (time.time(), prompt_hash, respuesta)
+        with self._lock:
+            self._guardar_en_memoria(clave, item)
+            self.stats["escrituras"] += 1
+            db = self._conexion()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (clave, prompt_hash, respuesta, creado) VALUES (?, ?, ?, ?)",
+                    (clave, prompt_hash, respuesta, item[0])
+                )
+                db.commit()
+
+    def borrar(self, clave: str) -> None:
+        """Quita una entrada (p. ej. una respuesta cacheada que ya no pasa la validación)."""
+        with self._lock:
+            self._memoria.pop(clave, None)
+            db = self._conexion()
+            if db is not None:
+                db.execute("DELETE FROM llm_cache WHERE clave = ?", (clave,))
+                db.commit()
+            self.stats["invalidados"] += 1
+
+    def _guardar_en_memoria(self, clave, item) -> None:
+        self._memoria[clave] = tuple(item)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_items:
+            self._memoria.popitem(last=False)
+
+    def invalidar(self, system_prompt: str | None = None) -> int:
+        """Borra las entradas de un system prompt (o todas si es None). Devuelve cuántas se borraron."""
+        with self._lock:
+            db = self._conexion()
+            if system_prompt is None:
+                borradas = len(self._memoria)
+                self._memoria.clear()
+                if db is not None:
+                    borradas = max(borradas, db.execute("DELETE FROM llm_cache").rowcount)
+            else:
+                prompt_hash = _hash_texto(system_prompt)
+                claves = [k for k, v in self._memoria.items() if v[1] == prompt_hash]
+                for k in claves:
+                    del self._memoria[k]
+                borradas = len(claves)
+                if db is not None:
+                    borradas = max(borradas, db.execute(
+                        "DELETE FROM llm_cache WHERE prompt_hash = ?", (prompt_hash,)
+                    ).rowcount)
+            if db is not None:
+                db.commit()
+            self.stats["invalidados"] += borradas
+            return borradas
+
+    def retener_prompts(self, system_prompts) -> int:
+        """
+        Borra las entradas de prompts que ya no existen (p. ej. tras editar _build_intent_prompt).
+        Si la base todavía no se abrió, el borrado en disco se hace una sola vez al abrirla.
+        """
+        vigentes = {_hash_texto(p) for p in system_prompts}
+        with self._lock:
+            self._vigentes = vigentes
+            claves = [k for k, v in self._memoria.items() if v[1] not in vigentes]
+            for k in claves:
+                del self._memoria[k]
+            borradas = len(claves)
+            if self._db is not None:
+                borradas = max(borradas, self._borrar_prompts_obsoletos(vigentes))
+                self._db.commit()
+            self.stats["invalidados"] += borradas
+            return borradas
+
+    def _borrar_prompts_obsoletos(self, vigentes: set) -> int:
+        marcadores = ",".join("?" * len(vigentes))
+        return self._db.execute(
+            f"DELETE FROM llm_cache WHERE prompt_hash NOT IN ({marcadores})", tuple(vigentes)
+        ).rowcount
+
+    def estadisticas(self) -> dict:
+        hits = self.stats["hits_memoria"] + self.stats["hits_disco"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "items_memoria": len(self._memoria),
+            "persistente": self._db is not None or (bool(self.path) and not self._abierta),
+            "tasa_hits": round(hits / total, 3) if total else 0.0,
+        }
+
+
+LLM_CACHE = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ITEMS, LLM_CACHE_TTL)
+
+def _detectar_intencion(texto: str) -> str | None:
+    """Devuelve la primera intención cuyas palabras clave aparecen en el texto."""
+    texto_upper = texto.upper()
+    for intent_name, keywords in INTENT_KEYWORDS.items():
+        if any(keyword in texto_upper for keyword in keywords):
+            return intent_name
+    return None
+
+
+def _tiene_intencion(texto: str) -> bool:
+    """Validador de caché: la respuesta de clasificación contiene una palabra clave."""
+    return _detectar_intencion(texto) is not None
+
+
+def _es_extraccion_valida(texto: str) -> bool:
+    """Validador de caché: la extracción es un objeto JSON con numero_factura."""
+    try:
+        datos = _parsear_json_llm(texto)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(datos, dict) and bool(datos.get("numero_factura"))
+
+
+def _parsear_json_llm(texto: str) -> dict:
+    """
+    Parsea el JSON devuelto por el LLM. Con salida estructurada basta json.loads;
+    la limpieza de ```json y comillas simples queda solo como respaldo.
+    """
+    data_json_clean = texto.strip()
+    try:
+        return json.loads(data_json_clean)
+    except json.JSONDecodeError:
+        pass
+    
+    # Si viene con ```json, limpiarlo
+    if '```' in data_json_clean:
+        json_match = re.search(r'```(?:json)?\s*([\{\[].*?[\}\]])\s*```', data_json_clean, re.DOTALL)
+        if json_match:
+            data_json_clean = json_match.group(1)
+        else:
+            json_match = re.search(r'[\{\[].*[\}\]]', data_json_clean, re.DOTALL)
+            if json_match:
+                data_json_clean = json_match.group(0)
+    
+    # Reemplazar comillas simples por dobles
+    data_json_clean = data_json_clean.replace("'", '"')
+    
+    print(f"🔄 JSON limpio a parsear:")
+    print(data_json_clean[:300])
+    
+    return json.loads(data_json_clean)
+
+# --- Control de admisión global hacia OpenRouter ---
+
+ADMISION_TASA = float(os.environ.get('ADMISION_TASA', '2'))        # peticiones por segundo
+ADMISION_RAFAGA = float(os.environ.get('ADMISION_RAFAGA', '5'))    # capacidad del token bucket
+ADMISION_COLA_MAX = int(os.environ.get('ADMISION_COLA_MAX', '50'))
+ADMISION_OLVIDO = float(os.environ.get('ADMISION_OLVIDO', '600'))  # segundos sin pedir tras los que se olvida la ronda de un usuario
+
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_LOTE = 1
+
+# Usuario y prioridad de la solicitud en curso (server.py los fija por request)
+USUARIO_ACTUAL = contextvars.ContextVar('usuario_actual', default='local')
+PRIORIDAD_ACTUAL = contextvars.ContextVar('prioridad_actual', default=PRIORIDAD_INTERACTIVA)
+
+
+class ColaLlenaError(Exception):
+    """La cola de admisión hacia OpenRouter está llena."""
+
+
+class ControlAdmision:
+    """
+    Token bucket + cola de prioridad acotada delante de todas las peticiones a OpenRouter.
+    Dentro de una misma prioridad se atiende por rondas de usuario (fair queuing), así un
+    usuario con muchas peticiones no bloquea a los demás. Un 429 con Retry-After pausa
+    el despacho para todos. La cola y su despachador quedan atados a un event loop y,
+    como el cliente httpx, se rehacen si el loop cambió.
+    """
+
+    def __init__(self, tasa: float, rafaga: float, cola_max: int) -> None:
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.cola_max = cola_max
+        self._tokens = rafaga
+        self._ultimo_relleno = time.monotonic()
+        self._pausado_hasta = 0.0
+        self._cola = []
+        self._seq = 0
+        self._ronda_global = 0
+        self._ronda_usuario = {}  # usuario -> (próxima ronda, última petición)
+        self._ultima_poda = time.monotonic()
+        self._despachador = None
+        self._loop = None
+        self._esperas = deque(maxlen=500)
+        self.stats = {"admitidas": 0, "rechazadas": 0, "pausas_retry_after": 0, "profundidad_max": 0}
+
+    async def adquirir(self, usuario: str | None = None, prioridad: int | None = None) -> None:
+        """Espera turno para una petición. Lanza ColaLlenaError si la cola está llena."""
+        usuario = usuario or USUARIO_ACTUAL.get()
+        prioridad = PRIORIDAD_ACTUAL.get() if prioridad is None else prioridad
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Los futuros y el despachador del loop anterior no sirven en este: se arranca otra
+            # cola (si ese loop sigue vivo, su despachador termina de atender la suya)
+            self._cola = []
+            self._despachador = None
+            self._loop = loop
+
+        if len(self._cola) >= self.cola_max:
+            self.stats["rechazadas"] += 1
+            raise ColaLlenaError(f"Cola de OpenRouter llena ({self.cola_max} en espera)")
+
+        ahora = time.monotonic()
+        self._podar_usuarios(ahora)
+        ronda = max(self._ronda_global, self._ronda_usuario.get(usuario, (0, ahora))[0])
+        self._ronda_usuario[usuario] = (ronda + 1, ahora)
+        self._seq += 1
+        futuro = loop.create_future()
+        heapq.heappush(self._cola, (prioridad, ronda, self._seq, usuario, futuro))
+        self.stats["profundidad_max"] = max(self.stats["profundidad_max"], len(self._cola))
+
+        if self._despachador is None or self._despachador.done():
+            self._despachador = asyncio.ensure_future(self._despachar())
+
+        inicio = time.monotonic()
+        await futuro
+        self._esperas.append(time.monotonic() - inicio)
+        self.stats["admitidas"] += 1
+
+    def _podar_usuarios(self, ahora: float) -> None:
+        """Olvida (como mucho una vez por minuto) a los usuarios sin peticiones en ADMISION_OLVIDO s."""
+        if ahora - self._ultima_poda < 60:
+            return
+        self._ultima_poda = ahora
+        en_cola = {entrada[3] for entrada in self._cola}
+        self._ronda_usuario = {
+            u: (ronda, visto) for u, (ronda, visto) in self._ronda_usuario.items()
+            if u in en_cola or (ronda > self._ronda_global and ahora - visto < ADMISION_OLVIDO)
+        }
+
+    def pausar(self, segundos: float) -> None:
+        """Detiene el despacho (p. ej. por un Retry-After de OpenRouter)."""
+        hasta = time.monotonic() + max(0.0, segundos)
+        if hasta > self._pausado_hasta:
+            self._pausado_hasta = hasta
+            self.stats["pausas_retry_after"] += 1
+            print(f"🚦 OpenRouter pidió esperar {segundos:.0f}s, pausando la cola")
+
+    def _rellenar(self) -> None:
+        ahora = time.monotonic()
+        self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo_relleno) * self.tasa)
+        self._ultimo_relleno = ahora
+
+    async def _despachar(self) -> None:
+        cola = self._cola  # la de su loop, aunque otro loop ya haya empezado la suya
+        while cola:
+            espera_pausa = self._pausado_hasta - time.monotonic()
+            if espera_pausa > 0:
+                await asyncio.sleep(espera_pausa)
+                continue
+
+            self._rellenar()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.tasa)
+                continue
+
+            _, ronda, _, usuario, futuro = heapq.heappop(cola)
+            if futuro.done():  # el que esperaba fue cancelado
+                continue
+            self._tokens -= 1
+            self._ronda_global = max(self._ronda_global, ronda)
+            futuro.set_result(None)
+
+    def estadisticas(self) -> dict:
+        esperas = sorted(self._esperas)
+        return {
+            **self.stats,
+            "profundidad": len(self._cola),
+            "usuarios_con_ronda": len(self._ronda_usuario),
+            "tokens": round(self._tokens, 2),
+            "pausado_por": max(0.0, round(self._pausado_hasta - time.monotonic(), 1)),
+            "espera_promedio": round(sum(esperas) / len(esperas), 3) if esperas else 0.0,
+            "espera_p95": round(esperas[min(len(esperas) - 1, int(len(esperas) * 0.95))], 3) if esperas else 0.0,
+        }
+
+
+ADMISION = ControlAdmision(ADMISION_TASA, ADMISION_RAFAGA, ADMISION_COLA_MAX)
+
+
+def _segundos_retry_after(valor: str | None) -> float | None:
+    """Interpreta la cabecera Retry-After (segundos o fecha HTTP)."""
+    if not valor:
+        return None
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+# --- Salud de modelos: latencia EWMA, tasa de error y circuit breaker ---
+
+SALUD_ALPHA = float(os.environ.get('SALUD_ALPHA', '0.3'))
+SALUD_LATENCIA_INICIAL = float(os.environ.get('SALUD_LATENCIA_INICIAL', '8'))
+CB_UMBRAL_FALLOS = int(os.environ.get('CB_UMBRAL_FALLOS', '3'))
+CB_ENFRIAMIENTO = float(os.environ.get('CB_ENFRIAMIENTO', '60'))
+
+
+class RegistroSaludModelos:
+    """
+    Registro global del estado de cada modelo. Ordena los candidatos por latencia
+    esperada y abre el circuito de un modelo tras CB_UMBRAL_FALLOS fallos seguidos;
+    pasado CB_ENFRIAMIENTO queda semiabierto y deja pasar una sola petición de prueba.
+    """
+
+    def __init__(self) -> None:
+        self._modelos = {}
+        self._lock = threading.Lock()
+        self.ultima_decision = None
+
+    def _estado_modelo(self, model_name: str) -> dict:
+        if model_name not in self._modelos:
+            self._modelos[model_name] = {
+                "latencia_ewma": None,
+                "tasa_error_ewma": 0.0,
+                "circuito": "cerrado",
+                "abierto_hasta": 0.0,
+                "sonda_hasta": 0.0,
+                "fallos_consecutivos": 0,
+                "exitos": 0,
+                "errores": 0,
+                "ultimo_error": None,
+            }
+        return self._modelos[model_name]
+
+    def _actualizar_circuito(self, st: dict, ahora: float) -> None:
+        if st["circuito"] == "abierto" and ahora >= st["abierto_hasta"]:
+            st["circuito"] = "semiabierto"
+
+    def latencia_esperada(self, model_name: str) -> float:
+        st = self._estado_modelo(model_name)
+        latencia = st["latencia_ewma"] if st["latencia_ewma"] is not None else SALUD_LATENCIA_INICIAL
+        return latencia / max(0.05, 1.0 - st["tasa_error_ewma"])
+
+    def ordenar(self, modelos: list) -> list:
+        """Ordena por latencia esperada; los modelos con circuito abierto van al final."""
+        ahora = time.time()
+        with self._lock:
+            motivos = {}
+            claves = {}
+            for idx, model_name in enumerate(modelos):
+                st = self._estado_modelo(model_name)
+                self._actualizar_circuito(st, ahora)
+                esperada = self.latencia_esperada(model_name)
+                abierto = st["circuito"] == "abierto"
+                claves[model_name] = (abierto, esperada, idx)
+                motivos[model_name] = (
+                    f"circuito abierto ({int(st['abierto_hasta'] - ahora)}s restantes)" if abierto
+                    else f"{st['circuito']}, latencia esperada {esperada:.2f}s, error {st['tasa_error_ewma']:.0%}"
+                )
+            orden = sorted(modelos, key=lambda m: claves[m])
+            self.ultima_decision = {
+                "fecha": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "orden": orden,
+                "motivos": motivos,
+            }
+            return orden
+
+    def permitir(self, model_name: str) -> bool:
+        """True si se puede enviar una petición; en semiabierto reserva la única sonda."""
+        ahora = time.time()
+        with self._lock:
+            st = self._estado_modelo(model_name)
+            self._actualizar_circuito(st, ahora)
+            if st["circuito"] == "cerrado":
+                return True
+            if st["circuito"] == "semiabierto" and ahora >= st["sonda_hasta"]:
+                st["sonda_hasta"] = ahora + OPENROUTER_TIMEOUT * 2
+                return True
+            return False
+
+    def liberar_sonda(self, model_name: str) -> None:
+        """Devuelve la sonda reservada por permitir() sin registrar resultado (intento cancelado)."""
+        with self._lock:
+            self._estado_modelo(model_name)["sonda_hasta"] = 0.0
+
+    def registrar(self, model_name: str, estado: str, latencia: float) -> None:
+        """Registra el resultado de un intento ('ok' o cualquier estado de fallo)."""
+        ahora = time.time()
+        with self._lock:
+            st = self._estado_modelo(model_name)
+            st["sonda_hasta"] = 0.0
+            if estado == "ok":
+                st["exitos"] += 1
+                st["fallos_consecutivos"] = 0
+                st["latencia_ewma"] = latencia if st["latencia_ewma"] is None else (
+                    SALUD_ALPHA * latencia + (1 - SALUD_ALPHA) * st["latencia_ewma"]
+                )
+                st["tasa_error_ewma"] *= (1 - SALUD_ALPHA)
+                if st["circuito"] != "cerrado":
+                    print(f"🟢 {model_name}: circuito cerrado")
+                st["circuito"] = "cerrado"
+                return
+
+            st["errores"] += 1
+            st["fallos_consecutivos"] += 1
+            st["ultimo_error"] = estado
+            st["tasa_error_ewma"] = SALUD_ALPHA + (1 - SALUD_ALPHA) * st["tasa_error_ewma"]
+            if st["circuito"] == "semiabierto" or st["fallos_consecutivos"] >= CB_UMBRAL_FALLOS:
+                if st["circuito"] != "abierto":
+                    print(f"🔴 {model_name}: circuito abierto por {int(CB_ENFRIAMIENTO)}s")
+                st["circuito"] = "abierto"
+                st["abierto_hasta"] = ahora + CB_ENFRIAMIENTO
+
+    def estado(self) -> dict:
+        ahora = time.time()
+        with self._lock:
+            modelos = {}
+            for model_name, st in self._modelos.items():
+                self._actualizar_circuito(st, ahora)
+                modelos[model_name] = {
+                    "circuito": st["circuito"],
+                    "latencia_ewma": round(st["latencia_ewma"], 3) if st["latencia_ewma"] is not None else None,
+                    "tasa_error_ewma": round(st["tasa_error_ewma"], 3),
+                    "latencia_esperada": round(self.latencia_esperada(model_name), 3),
+                    "exitos": st["exitos"],
+                    "errores": st["errores"],
+                    "ultimo_error": st["ultimo_error"],
+                }
+            return {"modelos": modelos, "ultima_decision": self.ultima_decision}
+
+
+SALUD_MODELOS = RegistroSaludModelos()
+
+
+def mostrar_salud_modelos():
+    """Imprime el estado de los modelos y la última decisión de enrutamiento."""
+    estado = SALUD_MODELOS.estado()
+    print("\n" + "="*70)
+    print("🩺 SALUD DE MODELOS")
+    print("="*70)
+    print(f"{'Modelo':<40} {'Circuito':<12} {'Latencia':>9} {'Error':>7}")
+    print("-"*70)
+    for model_name, st in estado["modelos"].items():
+        latencia = f"{st['latencia_ewma']:.2f}s" if st['latencia_ewma'] is not None else "-"
+        print(f"{model_name[:39]:<40} {st['circuito']:<12} {latencia:>9} {st['tasa_error_ewma']:>7.0%}")
+    decision = estado["ultima_decision"]
+    if decision:
+        print(f"\n🧭 Última decisión ({decision['fecha']}):")
+        for i, model_name in enumerate(decision["orden"], 1):
+            print(f"   {i}. {model_name}: {decision['motivos'][model_name]}")
+    print("="*70 + "\n")
+
+
+# --- Estadísticas por perfil de llamada ---
+
+_perfil_stats = {}
+
+
+def obtener_estadisticas_perfiles() -> dict:
+    """Latencia (p50/p95) y resultados de call_openrouter por perfil."""
+    resumen = {}
+    for perfil, st in _perfil_stats.items():
+        latencias = sorted(st["latencias"])
+        resumen[perfil] = {
+            "llamadas": st["llamadas"],
+            "desde_cache": st["desde_cache"],
+            "exitos": st["exitos"],
+            "errores": st["errores"],
+            "latencia_p50": round(latencias[len(latencias) // 2], 3) if latencias else None,
+            "latencia_p95": round(latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))], 3) if latencias else None,
+        }
+    return resumen
+
+
+# --- Modo hedged: varias peticiones en paralelo sobre MODELS_FALLBACK ---
+
+# 'secuencial' (un modelo a la vez), 'hedged' (respaldo tras HEDGE_DELAY) o 'fanout' (N modelos a la vez)
+OPENROUTER_MODO = os.environ.get('OPENROUTER_MODO', 'secuencial')
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', '4'))
+HEDGE_FANOUT = int(os.environ.get('HEDGE_FANOUT', '2'))
+HEDGE_MAX_POR_LLAMADA = int(os.environ.get('HEDGE_MAX_POR_LLAMADA', '3'))   # tope de costo por llamada
+HEDGE_MAX_CONCURRENCIA = int(os.environ.get('HEDGE_MAX_CONCURRENCIA', '8'))  # tope global en vuelo
+
+_hedge_semaforo = None
+_hedge_semaforo_loop = None
+_hedge_stats = {"llamadas": 0, "peticiones_lanzadas": 0, "peticiones_canceladas": 0, "ganadores": {}}
+
+# Modelos que rechazaron response_format (no se les vuelve a enviar)
+_modelos_sin_formato = set()
+
+
+def _obtener_semaforo_hedge() -> asyncio.Semaphore:
+    global _hedge_semaforo, _hedge_semaforo_loop
+    loop = asyncio.get_running_loop()
+    if _hedge_semaforo is None or _hedge_semaforo_loop is not loop:
+        _hedge_semaforo = asyncio.Semaphore(HEDGE_MAX_CONCURRENCIA)
+        _hedge_semaforo_loop = loop
+    return _hedge_semaforo
+
+
+def obtener_estadisticas_hedge() -> dict:
+    return {**_hedge_stats, "ganadores": dict(_hedge_stats["ganadores"]), "modo": OPENROUTER_MODO}
+
+
+async def _intentar_modelo(model_name: str, payload_base: dict, headers: dict,
+                           response_format: dict | None = None, detener_en=None,
+                           timeout: float | None = None) -> tuple[str, str | None]:
+    """
+    Un intento contra un modelo. Devuelve (estado, resultado) donde estado es:
+    'ok', 'siguiente' (probar otro modelo), 'reintentar' (mismo modelo), 'red' o 'auth'.
+    El resultado alimenta SALUD_MODELOS (salvo 'auth', que no es culpa del modelo).
+    Antes de enviar espera turno en ADMISION; si la cola está llena devuelve 'cola_llena'.
+    """
+    try:
+        await ADMISION.adquirir()
+    except ColaLlenaError as e:
+        print(f"🚫 {e}")
+        return "cola_llena", None
+    
+    inicio = time.monotonic()
+    estado, result = "siguiente", None
+    try:
+        estado, result = await _intentar_modelo_http(
+            model_name, payload_base, headers, response_format, detener_en, timeout
+        )
+        return estado, result
+    except asyncio.CancelledError:
+        # Perdió la carrera en _ronda_hedged: no es un fallo del modelo
+        estado = "cancelado"
+        SALUD_MODELOS.liberar_sonda(model_name)
+        raise
+    finally:
+        if estado not in ("auth", "cola_llena", "cancelado"):
+            SALUD_MODELOS.registrar(model_name, estado, time.monotonic() - inicio)
+
+
+async def _intentar_modelo_http(model_name: str, payload_base: dict, headers: dict,
+                                response_format: dict | None = None, detener_en=None,
+                                timeout: float | None = None) -> tuple[str, str | None]:
+    payload = {**payload_base, "model": model_name}
+    if response_format and model_name not in _modelos_sin_formato:
+        payload["response_format"] = response_format
+    
+    try:
+        if detener_en is not None:
+            response, texto = await _stream_openrouter(payload, headers, detener_en, timeout)
+            if response.status_code == 200:
+                if not texto or not texto.strip():
+                    print(f"⚠️ {model_name}: Respuesta vacía")
+                    return "siguiente", None
+                return "ok", texto.strip()
+        else:
+            response = await _post_openrouter(payload, headers, timeout)
+        
+        if response.status_code == 400 and "response_format" in payload:
+            print(f"⚠️ {model_name}: Sin soporte de salida estructurada, reintentando sin response_format")
+            _modelos_sin_formato.add(model_name)
+            payload.pop("response_format")
+            response = await _post_openrouter(payload, headers, timeout)
+        
+        if not response.content:
+            print(f"⚠️ {model_name}: Respuesta vacía")
+            return "siguiente", None
+        
+        if response.status_code == 429:
+            print(f"⚠️ {model_name}: Rate limit, probando otro modelo...")
+            retry_after = _segundos_retry_after(response.headers.get('Retry-After'))
+            if retry_after and retry_after > 0:
+                ADMISION.pausar(retry_after)
+            return "siguiente", None
+        
+        if response.status_code == 404:
+            print(f"⚠️ {model_name}: No disponible")
+            return "siguiente", None
+        
+        if response.status_code == 401:
+            return "auth", None
+        
+        if response.status_code == 503:
+            print(f"⚠️ {model_name}: Servicio no disponible")
+            return "reintentar", None
+        
+        if response.status_code != 200:
+            print(f"⚠️ {model_name}: HTTP {response.status_code}")
+            return "siguiente", None
+        
+        try:
+            response_data = response.json()
+        except json.JSONDecodeError:
+            print(f"⚠️ {model_name}: JSON inválido")
+            return "siguiente", None
+        
+        if 'choices' not in response_data or not response_data['choices']:
+            error_msg = response_data.get('error', {}).get('message', 'Sin detalles')
+            print(f"⚠️ {model_name}: {error_msg}")
+            return "siguiente", None
+        
+        return "ok", response_data['choices'][0]['message']['content'].strip()
+        
+    except httpx.TimeoutException:
+        print(f"⏱️ {model_name}: Timeout")
+        return "reintentar", None
+    
+    except httpx.RequestError:
+        print(f"⚠️ {model_name}: Error de red")
+        return "red", None
+    
+    except Exception as e:
+        print(f"⚠️ {model_name}: {type(e).__name__}")
+        return "siguiente", None
+
+
+async def _ronda_hedged(modelos: list, payload_base: dict, headers: dict,
+                        response_format: dict | None = None, detener_en=None,
+                        timeout: float | None = None) -> tuple[str, str | None]:
+    """
+    Lanza el modelo principal y agrega respaldos tras HEDGE_DELAY (o ante un fallo).
+    En modo 'fanout' arranca con HEDGE_FANOUT modelos a la vez.
+    Toma la primera respuesta válida y cancela el resto.
+    """
+    semaforo = _obtener_semaforo_hedge()
+    limite = max(1, HEDGE_MAX_POR_LLAMADA)
+    pendientes = {}
+    lanzados = []
+    siguiente = 0
+
+    async def _con_limite(model_name):
+        async with semaforo:
+            return await _intentar_modelo(model_name, payload_base, headers, response_format, detener_en, timeout)
+
+    def _quedan() -> bool:
+        return siguiente < len(modelos) and len(lanzados) < limite
+
+    def _arrancar(model_name):
+        pendientes[asyncio.ensure_future(_con_limite(model_name))] = model_name
+        lanzados.append(model_name)
+        _hedge_stats["peticiones_lanzadas"] += 1
+
+    def _lanzar() -> bool:
+        """Lanza el próximo modelo permitido; permitir() se consulta solo al lanzarlo."""
+        nonlocal siguiente
+        while _quedan():
+            model_name = modelos[siguiente]
+            siguiente += 1
+            if SALUD_MODELOS.permitir(model_name):
+                _arrancar(model_name)
+                return True
+        return False
+
+    iniciales = HEDGE_FANOUT if OPENROUTER_MODO == 'fanout' else 1
+    for _ in range(max(1, iniciales)):
+        if not _lanzar():
+            break
+    if not lanzados and modelos:
+        # Todos con el circuito abierto: el primero sale igual (mismo criterio que el modo secuencial)
+        _arrancar(modelos[0])
+
+    try:
+        while pendientes:
+            done, _ = await asyncio.wait(
+                set(pendientes), timeout=HEDGE_DELAY if _quedan() else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                model_name = pendientes.pop(task)
+                estado, result = task.result()
+                if estado == "ok":
+                    _hedge_stats["ganadores"][model_name] = _hedge_stats["ganadores"].get(model_name, 0) + 1
+                    print(f"🏁 Ganó {model_name} ({len(pendientes)} petición(es) cancelada(s))")
+                    return "ok", result
+                if estado in ("auth", "cola_llena"):
+                    return estado, None
+            _lanzar()
+        return "siguiente", None
+    finally:
+        for task in pendientes:
+            task.cancel()
+        _hedge_stats["peticiones_canceladas"] += len(pendientes)
+
+
+# En main.py, REEMPLAZA completamente la función call_openrouter() con esta:
+
+async def call_openrouter(system_prompt: str, user_prompt: str, usar_cache: bool = False,
+                          response_format: dict | None = None, detener_en=None, max_tokens: int | None = None,
+                          perfil: str = 'otro', validar=None) -> str:
+    """
+    Llama a OpenRouter con reintentos agresivos y delays progresivos.
+    El perfil ('clasificacion', 'extraccion', 'otro') define modelos, max_tokens,
+    timeout y tiempo máximo de reintentos (ver PERFILES_LLM).
+    Con usar_cache=True las respuestas exitosas se guardan en LLM_CACHE; si se pasa
+    validar(texto), solo las que el llamador puede interpretar (una entrada cacheada que
+    no lo cumple se descarta y se vuelve a consultar).
+    response_format pide salida estructurada; se descarta si el modelo no la soporta (HTTP 400).
+    Con OPENROUTER_MODO='hedged'/'fanout' cada ronda consulta varios modelos en paralelo.
+    Con detener_en(texto) la respuesta llega por streaming y se corta apenas devuelve True.
+    """
+    config = PERFILES_LLM.get(perfil) or PERFILES_LLM['otro']
+    stats = _perfil_stats.setdefault(perfil, {
+        "llamadas": 0, "desde_cache": 0, "exitos": 0, "errores": 0, "latencias": deque(maxlen=500)
+    })
+    stats["llamadas"] += 1
+
+    if usar_cache:
+        cache_clave, prompt_hash = LLMCache.clave(config["modelos"], system_prompt, user_prompt)
+        cached = LLM_CACHE.get(cache_clave)
+        if cached is not None and validar is not None and not validar(cached):
+            print(f"🗑️ Respuesta cacheada inválida, se descarta")
+            LLM_CACHE.borrar(cache_clave)
+            cached = None
+        if cached is not None:
+            print(f"⚡ Respuesta desde caché")
+            stats["desde_cache"] += 1
+            return cached
+
+    inicio = time.monotonic()
+    result = await _call_openrouter_red(
+        system_prompt, user_prompt, config,
+        response_format=response_format,
+        detener_en=detener_en,
+        max_tokens=max_tokens if max_tokens is not None else config["max_tokens"],
+    )
+    stats["latencias"].append(time.monotonic() - inicio)
+
+    if result.startswith("ERROR:"):
+        stats["errores"] += 1
+        return result
+
+    stats["exitos"] += 1
+    if usar_cache and result and (validar is None or validar(result)):
+        LLM_CACHE.set(cache_clave, prompt_hash, result)
+    return result
+
+
+async def _call_openrouter_red(system_prompt: str, user_prompt: str, config: dict,
+                               response_format: dict | None = None, detener_en=None,
+                               max_tokens: int = 512) -> str:
+    """Bucle de reintentos contra OpenRouter (sin caché) para la configuración de un perfil."""
+    
+    # 🔥 Modelos priorizados por latencia esperada y estado del circuito
+    MODELS_PRIORITY = SALUD_MODELOS.ordenar(config["modelos"])
+    timeout = config["timeout"]
+    
+    payload_base = {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "temperature": 0.0,
+        "max_tokens": max_tokens,
+    }
+    
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": YOUR_SITE_URL,
+        "X-Title": YOUR_SITE_NAME,
+    }
+    
+    start_time = asyncio.get_event_loop().time()
+    max_total_time = config["tiempo_max"]  # 3 minutos por defecto
+    
+    modelo_actual_idx = 0
+    intento_global = 0
+    hedged = OPENROUTER_MODO in ('hedged', 'fanout')
+    if hedged:
+        _hedge_stats["llamadas"] += 1
+    
+    while (asyncio.get_event_loop().time() - start_time) < max_total_time:
+        intento_global += 1
+        
+        if intento_global > 1:
+            delay = min(intento_global * 2, 30)
+            print(f"⏳ Esperando {delay}s antes de reintentar (intento {intento_global})...")
+            await asyncio.sleep(delay)
+        
+        if hedged:
+            # Rotar el orden en cada ronda para no insistir siempre con el mismo modelo
+            inicio = modelo_actual_idx % len(MODELS_PRIORITY)
+            modelos_ronda = MODELS_PRIORITY[inicio:] + MODELS_PRIORITY[:inicio]
+            model_name = "ronda hedged"
+            estado, result = await _ronda_hedged(modelos_ronda, payload_base, headers, response_format, detener_en, timeout)
+        else:
+            # Saltar modelos con el circuito abierto (si todos lo están, se usa el actual)
+            for _ in range(len(MODELS_PRIORITY)):
+                model_name = MODELS_PRIORITY[modelo_actual_idx % len(MODELS_PRIORITY)]
+                if SALUD_MODELOS.permitir(model_name):
+                    break
+                modelo_actual_idx += 1
+            estado, result = await _intentar_modelo(model_name, payload_base, headers, response_format, detener_en, timeout)
+        
+        if estado == "auth":
+            return "ERROR: API Key inválida"
+        
+        if estado == "cola_llena":
+            return "ERROR: Los servicios de IA están sobrecargados (cola de solicitudes llena). Intenta en unos segundos."
+        
+        if estado == "red":
+            await asyncio.sleep(5)
+            continue
+        
+        if estado == "reintentar":
+            continue
+        
+        if estado != "ok":
+            modelo_actual_idx += 1
+            continue
+        
+        if intento_global > 1:
+            print(f"✅ Éxito con {model_name} (intento {intento_global})")
+        
+        return result
+    
+    elapsed = int(asyncio.get_event_loop().time() - start_time)
+    print(f"\n❌ No se pudo obtener respuesta después de {elapsed}s y {intento_global} intentos")
+    
+    return "ERROR: Los servicios de IA están sobrecargados. Intenta en 5-10 minutos."
+    
+
+# --- Parser determinista (fast-path sin LLM) ---
+
+FAST_PATH_HABILITADO = os.environ.get('FAST_PATH_HABILITADO', '1') == '1'
+FAST_PATH_UMBRAL = float(os.environ.get('FAST_PATH_UMBRAL', '0.9'))
+
+MESES = {
+    'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6,
+    'julio': 7, 'agosto': 8, 'septiembre': 9, 'setiembre': 9, 'octubre': 10,
+    'noviembre': 11, 'diciembre': 12,
+}
+
+_RE_FACTURA = r'(?:la\s+)?factura\s+(?:n[°ºo]\.?\s*|#\s*)?(?P<factura>[A-Za-z0-9][A-Za-z0-9_]*)'
+_RE_MONTO = r'\$?\s*(?P<monto>\d[\d.,]*)(?:\s*(?:pesos|cop))?'
+_RE_VERBO_PLAN = r'(?:(?:planifica|ingresa|registra|crea|agrega)r?\s+)?'
+_RE_VERBO_PAGO = r'(?:pagu[eé]|abon[eé]|cancel[eé])'
+
+
+def _parsear_monto(texto: str):
+    """Convierte '150.000', '150,000' o '1500.50' en (float, es_ambiguo)."""
+    s = texto.strip().rstrip('.,')
+    if re.fullmatch(r'\d{1,3}(?:\.\d{3})+', s) or re.fullmatch(r'\d{1,3}(?:,\d{3})+', s):
+        return float(s.replace('.', '').replace(',', '')), False
+    if re.fullmatch(r'\d+', s):
+        return float(s), False
+    if re.fullmatch(r'\d+[.,]\d{1,2}', s):
+        return float(s.replace(',', '.')), True
+    return None, True
+
+
+def _parsear_fecha_texto(texto: str, hoy: date | None = None):
+    """Convierte '2025-12-25', '25/12/2025' o '25 de diciembre [de 2025]' a 'YYYY-MM-DD'."""
+    s = texto.strip().rstrip('.').lower()
+    hoy = hoy or date.today()
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y'):
+        try:
+            return datetime.strptime(s, fmt).date().strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    match = re.fullmatch(r'(\d{1,2})\s+de\s+([a-z]+)(?:\s+(?:de|del)\s+(\d{4}))?', s)
+    if not match or match.group(2) not in MESES:
+        return None
+    dia, mes = int(match.group(1)), MESES[match.group(2)]
+    try:
+        if match.group(3):
+            return date(int(match.group(3)), mes, dia).strftime('%Y-%m-%d')
+        fecha = date(hoy.year, mes, dia)
+        if fecha < hoy:
+            fecha = date(hoy.year + 1, mes, dia)
+        return fecha.strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+class ParserRapido:
+    """
+    Extrae intención y datos de los comandos con formato conocido (ver mostrar_menu())
+    sin llamar al LLM. Devuelve el mismo {intent, data} que el flujo del Organizador
+    más una confianza; por debajo de FAST_PATH_UMBRAL se deriva al LLM.
+    """
+
+    def __init__(self) -> None:
+        flags = re.IGNORECASE
+        self.reglas = [
+            ("planificar_dias", "PLANIFICAR", re.compile(
+                rf'^{_RE_VERBO_PLAN}{_RE_FACTURA}\s+por\s+{_RE_MONTO}\s+(?:que\s+)?(?:vence\s+en|a)\s+(?P<dias>\d+)\s+d[ií]as?$', flags)),
+            ("planificar_fecha", "PLANIFICAR", re.compile(
+                rf'^{_RE_VERBO_PLAN}{_RE_FACTURA}\s+por\s+{_RE_MONTO}\s+(?:que\s+)?vence\s+el\s+(?P<fecha>.+)$', flags)),
+            ("planificar_simple", "PLANIFICAR", re.compile(
+                rf'^{_RE_VERBO_PLAN}{_RE_FACTURA}\s+por\s+{_RE_MONTO}$', flags)),
+            ("pagar", "PAGAR", re.compile(
+                rf'^(?:yo\s+)?{_RE_VERBO_PAGO}\s+{_RE_MONTO}\s+(?:de|a|para)\s+(?:la\s+cuota\s+(?P<cuota>\d+)\s+de\s+)?{_RE_FACTURA}(?:\s*,?\s*cuota\s+(?P<cuota2>\d+))?$', flags)),
+            ("consulta_factura", "CONSULTA_FACTURA", re.compile(
+                rf'^(?:consultar?|ver|informaci[oó]n\s+de)\s+{_RE_FACTURA}$', flags)),
+            ("consulta_deudas", "CONSULTA_DEUDAS", re.compile(
+                r'^(?:ver\s+)?(?:mis\s+)?deudas(?:\s+pendientes)?$|^¿?cu[aá]nto\s+debo\??$', flags)),
+            ("consulta_estadisticas", "CONSULTA_ESTADISTICAS", re.compile(
+                r'^(?:ver\s+)?(?:estad[ií]sticas|resumen|total\s+pagado)$', flags)),
+        ]
+        self.stats = {"consultas": 0, "resueltas": 0, "derivadas_llm": 0, "sin_regla": 0}
+        self.hits_por_regla = {nombre: 0 for nombre, _, _ in self.reglas}
+        self.baja_confianza_por_regla = {nombre: 0 for nombre, _, _ in self.reglas}
+
+    def analizar(self, texto: str, umbral: float = FAST_PATH_UMBRAL):
+        """Devuelve {'intent', 'data', 'confianza', 'regla'} o None si debe ir al LLM."""
+        self.stats["consultas"] += 1
+        s = " ".join(texto.split()).rstrip('.!')
+
+        for nombre, intent, patron in self.reglas:
+            match = patron.match(s)
+            if not match:
+                continue
+
+            resultado = self._construir(nombre, intent, match)
+            if resultado is None or resultado["confianza"] < umbral:
+                self.baja_confianza_por_regla[nombre] += 1
+                self.stats["derivadas_llm"] += 1
+                return None
+
+            self.hits_por_regla[nombre] += 1
+            self.stats["resueltas"] += 1
+            return resultado
+
+        self.stats["sin_regla"] += 1
+        self.stats["derivadas_llm"] += 1
+        return None
+
+    def _construir(self, nombre: str, intent: str, match):
+        grupos = match.groupdict()
+        confianza = 1.0
+        data = {}
+
+        if grupos.get("factura"):
+            data["numero_factura"] = grupos["factura"]
+
+        if intent in ("PLANIFICAR", "PAGAR"):
+            monto, ambiguo = _parsear_monto(grupos["monto"])
+            if not monto:
+                return None
+            if ambiguo:
+                confianza -= 0.3
+
+            texto_lower = match.string.lower()
+            if intent == "PLANIFICAR" and re.search(_RE_VERBO_PAGO, texto_lower):
+                confianza -= 0.5
+
+            fecha = None
+            if grupos.get("fecha"):
+                fecha = _parsear_fecha_texto(grupos["fecha"])
+                if fecha is None:
+                    return None
+
+            cuota = grupos.get("cuota") or grupos.get("cuota2")
+            data.update({
+                "monto_total": monto if intent == "PLANIFICAR" else 0.0,
+                "monto_abono": monto if intent == "PAGAR" else 0.0,
+                "dias_vencimiento": int(grupos["dias"]) if grupos.get("dias") else None,
+                "fecha_vencimiento": fecha,
+                "cuota_especifica": int(cuota) if cuota else None,
+            })
+
+        return {"intent": intent, "data": data, "confianza": round(confianza, 2), "regla": nombre}
+
+    def estadisticas(self) -> dict:
+        consultas = self.stats["consultas"]
+        return {
+            **self.stats,
+            "tasa_resueltas": round(self.stats["resueltas"] / consultas, 3) if consultas else 0.0,
+            "hits_por_regla": dict(self.hits_por_regla),
+            "baja_confianza_por_regla": dict(self.baja_confianza_por_regla),
+        }
+
+
+PARSER_RAPIDO = ParserRapido()
+
+# --- 4. DEFINICIÓN DE AGENTES ---
+
+@default_subscription
+class Consultor(RoutedAgent):
+    """Agente que maneja consultas de información: facturas específicas, deudas y estadísticas."""
+    
+    def __init__(self, sheets_service, spreadsheet_id: str | None = None) -> None:
+        super().__init__("Consultor de información.")
+        self.sheets_service = sheets_service
+        self.spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+    
+    def _obtener_info_factura(self, factura_id: str, sheets_service=None) -> dict:
+        """Obtiene información detallada de una factura específica."""
+        try:
+            ledger = ledger_de_factura(sheets_service or self.sheets_service, factura_id, self.spreadsheet_id)
+            
+            # Obtener cuotas PENDIENTES
+            cuotas_pendientes = []
+            monto_total = 0
+            
+            for cuota in ledger.cuotas_de_factura(factura_id):
+                monto_total = cuota.monto_total  # Monto total de la factura
+                cuotas_pendientes.append({
+                    'cuota_id': cuota.cuota_id,
+                    'monto_pendiente': cuota.monto_pendiente,
+                })
+            
+            # 🔥 Cuotas PAGADAS del historial: "Pago Completo" con saldo 0
+            cuotas_pagadas = ledger.cuotas_pagadas_de_factura(factura_id)
+            
+            # Calcular totales
+            total_pendiente = sum(c['monto_pendiente'] for c in cuotas_pendientes)
+            total_pagado = monto_total - total_pendiente if monto_total > 0 else 0
+            
+            num_cuotas_pagadas = len(cuotas_pagadas)
+            num_cuotas_pendientes = len(cuotas_pendientes)
+            total_cuotas = num_cuotas_pagadas + num_cuotas_pendientes
+            
+            return {
+                'existe': total_cuotas > 0,
+                'monto_total': monto_total,
+                'total_pendiente': total_pendiente,
+                'total_pagado': total_pagado,
+                'num_cuotas_total': total_cuotas,
+                'num_cuotas_pagadas': num_cuotas_pagadas,
+                'num_cuotas_pendientes': num_cuotas_pendientes,
+            }
+        except Exception as e:
+            return {'existe': False, 'error': str(e)}
+    
+    def _obtener_deudas_pendientes(self, sheets_service=None) -> list:
+        """Obtiene todas las deudas pendientes."""
+        try:
+            ledger = ledger_activo(sheets_service or self.sheets_service, self.spreadsheet_id)
+            return [
+                {
+                    'cuota_id': cuota.cuota_id,
+                    'monto_pendiente': cuota.monto_pendiente,
+                    'fecha_vencimiento': cuota.fecha_vencimiento_raw
+                }
+                for cuota in ledger.cuotas_pendientes()
+            ]
         except Exception as e:
             return []
     
-    def _obtener_estadisticas(self) -> dict:
+    def _obtener_estadisticas(self, sheets_service=None) -> dict:
         """Obtiene estadísticas generales de pagos."""
-        try:
-            # Deudas pendientes
-            result_deuda = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, 
-                range=SHEETS_RANGE
-            ).execute()
-            
-            values_deuda = result_deuda.get('values', [])
+        try:
+            ledger = ledger_activo(sheets_service or self.sheets_service, self.spreadsheet_id)
             
+            # Deudas pendientes
             total_pendiente = 0
             cuotas_pendientes = 0
             facturas_unicas = set()
             
-            for i, row in enumerate(values_deuda):
-                if i == 0: continue
-                if len(row) >= 8 and row[7] == 'PENDIENTE':
-                    total_pendiente += float(row[3]) if row[3] else 0
-                    cuotas_pendientes += 1
-                    factura_base = row[1].split('-')[0]
-                    facturas_unicas.add(factura_base)
-            
-            # Historial de pagos
-            historial_sheet = 'Historial de Pagos' if 'Historial de Pagos' in ['Historial de Pagos'] else 'Facturas Pagadas'
-            result_historial = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'{historial_sheet}!A:F'
-            ).execute()
-            
-            values_historial = result_historial.get('values', [])
+            for cuota in ledger.cuotas_pendientes():
+                total_pendiente += cuota.monto_pendiente
+                cuotas_pendientes += 1
+                facturas_unicas.add(cuota.cuota_id.split('-')[0])
             
-            total_pagado = 0
-            num_transacciones = 0
-            
-            for i, row in enumerate(values_historial):
-                if i == 0: continue
-                if len(row) >= 4:
-                    total_pagado += float(row[3]) if row[3] else 0
-                    num_transacciones += 1
+            # Historial de pagos (agregados que el ledger mantiene al leer cada delta)
+            totales = ledger.totales_historial()
+            total_pagado = totales['total_pagado']
+            num_transacciones = totales['num_transacciones']
             
             return {
                 'total_pendiente': total_pendiente,
@@ -458,7 +4163,7 @@ class Consultor(RoutedAgent):
             if not factura_id or not isinstance(factura_id, str):
                 print(f"\n❌ No se especificó un número de factura válido\n")
                 return
-            info = self._obtener_info_factura(factura_id)
+            info = await llamar_google(self.sheets_service, lambda s: self._obtener_info_factura(factura_id, s))
             
             if info['existe']:
                 print(f"\n📋 INFORMACIÓN DE FACTURA {factura_id}")
@@ -472,7 +4177,7 @@ class Consultor(RoutedAgent):
                 print(f"\n❌ No se encontró la factura {factura_id}\n")
         
         elif consulta_tipo == 'DEUDAS_PENDIENTES':
-            deudas = self._obtener_deudas_pendientes()
+            deudas = await llamar_google(self.sheets_service, self._obtener_deudas_pendientes)
             
             if deudas:
                 print(f"\n💳 DEUDAS PENDIENTES")
@@ -495,7 +4200,7 @@ class Consultor(RoutedAgent):
                 print(f"\n✅ ¡No hay deudas pendientes!\n")
         
         elif consulta_tipo == 'ESTADISTICAS':
-            stats = self._obtener_estadisticas()
+            stats = await llamar_google(self.sheets_service, self._obtener_estadisticas)
             
             print(f"\n📈 ESTADÍSTICAS GENERALES")
             print("="*70)
@@ -516,8 +4221,10 @@ class Organizador(RoutedAgent):
         super().__init__("Organizador central de pagos.")
         self._intent_prompt = self._build_intent_prompt()
         self._data_extraction_prompt = self._build_data_extraction_prompt()
+        self._combined_prompt = self._build_combined_prompt()
 
-    def _build_intent_prompt(self):
+    @staticmethod
+    def _build_intent_prompt():
         return (
             "Eres un clasificador de intención. Analiza la petición del usuario y responde SOLO con "
             "UNA de las siguientes palabras (sin explicaciones adicionales):\n\n"
@@ -549,7 +4256,8 @@ class Organizador(RoutedAgent):
             "Responde SOLO con la palabra clave, nada más."
         )
 
-    def _build_data_extraction_prompt(self):
+    @staticmethod
+    def _build_data_extraction_prompt():
         return (
             "Extrae la siguiente información del texto y devuelve SOLO un objeto JSON válido.\n\n"
             "Campos a extraer:\n"
@@ -577,6 +4285,57 @@ class Organizador(RoutedAgent):
             "Ahora extrae del siguiente texto y devuelve SOLO el JSON:"
         )
 
+    @staticmethod
+    def _build_combined_prompt():
+        return (
+            "Clasifica la intención del usuario Y extrae sus datos. Devuelve SOLO un objeto JSON válido.\n\n"
+            "Campo intent (UNA de estas palabras):\n"
+            "- PLANIFICAR: crear, registrar, ingresar o planificar una nueva factura ('factura X por $Y', 'vence en', 'vence el')\n"
+            "- PAGAR: reporta un pago YA REALIZADO ('pagué', 'pagó', 'abono', 'abone', 'cancelé')\n"
+            "- CONSULTA_FACTURA: información de UNA factura ('consultar factura X', 'ver factura X')\n"
+            "- CONSULTA_DEUDAS: todas sus deudas ('deudas pendientes', 'cuánto debo')\n"
+            "- CONSULTA_ESTADISTICAS: estadísticas o métricas ('estadísticas', 'resumen', 'total pagado')\n"
+            "IMPORTANTE: Si menciona 'factura X por $Y' sin decir 'pagué', es PLANIFICAR.\n\n"
+            "Demás campos:\n"
+            "- numero_factura: número/ID de factura (string, puede contener letras) o null\n"
+            "- monto_total: monto total si es planificación (float, sin símbolos, 0.0 si no aplica)\n"
+            "- monto_abono: monto del pago/abono (float, sin símbolos, 0.0 si no aplica)\n"
+            "- dias_vencimiento: días desde hoy hasta el vencimiento (integer o null)\n"
+            "- fecha_vencimiento: fecha específica de vencimiento YYYY-MM-DD (string o null)\n"
+            "- cuota_especifica: número de cuota específica si se menciona (integer o null)\n\n"
+            "Ejemplos:\n"
+            "Input: 'Planifica la factura vad49888 por $471611 vence en 4 días'\n"
+            "Output: {\"intent\": \"PLANIFICAR\", \"numero_factura\": \"vad49888\", \"monto_total\": 471611.0, \"monto_abono\": 0.0, \"dias_vencimiento\": 4, \"fecha_vencimiento\": null, \"cuota_especifica\": null}\n\n"
+            "Input: 'pagué $50000 de la factura abc123'\n"
+            "Output: {\"intent\": \"PAGAR\", \"numero_factura\": \"abc123\", \"monto_total\": 0.0, \"monto_abono\": 50000.0, \"dias_vencimiento\": null, \"fecha_vencimiento\": null, \"cuota_especifica\": null}\n\n"
+            "Input: 'ver deudas pendientes'\n"
+            "Output: {\"intent\": \"CONSULTA_DEUDAS\", \"numero_factura\": null, \"monto_total\": 0.0, \"monto_abono\": 0.0, \"dias_vencimiento\": null, \"fecha_vencimiento\": null, \"cuota_especifica\": null}\n\n"
+            "NO incluyas texto extra, SOLO el JSON."
+        )
+
+    @staticmethod
+    def _interpretar_respuesta_combinada(respuesta: str):
+        """Devuelve (intent, datos) de la respuesta combinada, o None si no es utilizable."""
+        try:
+            datos = _parsear_json_llm(respuesta)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(datos, dict):
+            return None
+        
+        intent = str(datos.pop("intent", "") or "").strip().upper()
+        if intent not in INTENCIONES_VALIDAS:
+            return None
+        
+        if not datos.get("numero_factura"):
+            datos.pop("numero_factura", None)
+        return intent, datos
+
+    @staticmethod
+    def _es_respuesta_combinada_valida(respuesta: str) -> bool:
+        """Validador de caché para la llamada combinada."""
+        return Organizador._interpretar_respuesta_combinada(respuesta) is not None
+
     @message_handler
     async def handle_message(self, message: PaymentMessage, ctx: MessageContext) -> PaymentMessage:
         """
@@ -588,125 +4347,153 @@ class Organizador(RoutedAgent):
             print(f"{'='*60}")
 
             if message.status == "INITIAL":
-                # 1. Extraer intención
-                print(f"🔄 Paso 1: Detectando intención...")
-                
-                try:
-                    intent_response = await call_openrouter(self._intent_prompt, message.user_input)
-                    
-                    # 🔥 DEBUG: Mostrar respuesta COMPLETA
-                    print(f"\n{'='*60}")
-                    print(f"📥 RESPUESTA COMPLETA DE OPENROUTER:")
-                    print(f"{'='*60}")
-                    print(intent_response)
-                    print(f"{'='*60}")
-                    print(f"Tipo: {type(intent_response)}")
-                    print(f"Longitud: {len(intent_response)} caracteres")
-                    print(f"{'='*60}\n")
-                    
-                except Exception as e:
-                    print(f"❌ Error llamando a OpenRouter: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    return message.model_copy(update={"status": "ERROR"})
-                
-                if intent_response.startswith("ERROR:"):
-                    print(f"❌ OpenRouter falló: {intent_response}")
-                    return message.model_copy(update={"status": "ERROR"})
-                
-                
-                # 2. Limpieza de intención CON DEBUG
-                print(f"🔄 Paso 2: Limpiando respuesta...")
-
-                # 🔥 NUEVA ESTRATEGIA: Buscar palabras clave en cualquier parte
-                intent_response_upper = intent_response.upper()
-
-                # Mapeo de palabras clave a intenciones
-                intent_keywords = {
-                    "PLANIFICAR": ["PLANIFICAR", "CREAR", "REGISTRAR", "INGRESAR"],
-                    "PAGAR": ["PAGAR", "PAGO", "ABONO"],
-                    "CONSULTA_FACTURA": ["CONSULTA_FACTURA", "VER FACTURA", "INFO"],
-                    "CONSULTA_DEUDAS": ["CONSULTA_DEUDAS", "DEUDAS", "DEBO"],
-                    "CONSULTA_ESTADISTICAS": ["ESTADISTICAS", "STATS", "RESUMEN"]
-                }
+                clean_intent = None
+                data_ext = None
+                data_json_str = ""
 
-                clean_intent = "DESCONOCIDO"
+                # 📦 Mensajes ya clasificados (p. ej. por clasificar_lote) no vuelven a pasar por la IA
+                preclasificado = message.data.pop('preclasificado', None)
+                if preclasificado and preclasificado.get('intent') in INTENCIONES_VALIDAS:
+                    clean_intent, data_ext = preclasificado['intent'], dict(preclasificado.get('data') or {})
+                    print(f"📦 Intención preclasificada: {clean_intent}")
 
-                # Buscar cualquier palabra clave en la respuesta
-                for intent_name, keywords in intent_keywords.items():
-                    if any(keyword in intent_response_upper for keyword in keywords):
-                        clean_intent = intent_name
-                        print(f"✅ Intención detectada: {clean_intent}")
-                        break
+                # ⚡ Fast-path: comandos con formato conocido se resuelven sin LLM
+                if clean_intent is None and FAST_PATH_HABILITADO:
+                    rapido = PARSER_RAPIDO.analizar(message.user_input)
+                    if rapido:
+                        clean_intent, data_ext = rapido["intent"], rapido["data"]
+                        print(f"⚡ Resuelto sin IA (regla '{rapido['regla']}', confianza {rapido['confianza']})")
+                        print(f"🎯 Intención final: {clean_intent}")
 
-                # 🔥 FALLBACK: Si menciona "factura" + "monto" en el input = PLANIFICAR
-                if clean_intent == "DESCONOCIDO":
-                    user_lower = message.user_input.lower()
-                    if "factura" in user_lower and ("$" in user_lower or "pesos" in user_lower):
-                        if "pagué" not in user_lower and "pagó" not in user_lower:
-                            clean_intent = "PLANIFICAR"
-                            print(f"🔄 Fallback: Detectado como PLANIFICAR por contexto")
-
-                print(f"🎯 Intención final: {clean_intent}")
-
-                if clean_intent == "DESCONOCIDO":
-                    print(f"\n❌ No se pudo identificar la intención")
-                    print(f"💡 Respuesta de IA no contenía ninguna palabra clave válida")
-                    print(f"💡 Palabras esperadas: {valid_intents}")
-                    print(f"💡 Respuesta recibida: '{intent_response[:200]}'")
-                    return message.model_copy(update={"status": "ERROR"})
-                
-                # 3. Extraer datos si es necesario
-                if clean_intent in ["PLANIFICAR", "PAGAR"]:
-                    print(f"\n🔄 Paso 3: Extrayendo datos del mensaje...")
+                # 🔥 Modo combinado: intención + datos en una sola llamada
+                if clean_intent is None and ORGANIZADOR_MODO_COMBINADO:
+                    print(f"🔄 Paso 1: Clasificando y extrayendo datos (una sola llamada)...")
+
+                    try:
+                        combined_response = await call_openrouter(
+                            self._combined_prompt,
+                            message.user_input,
+                            usar_cache=True,
+                            response_format=RESPUESTA_COMBINADA_FORMAT,
+                            perfil='extraccion',
+                            validar=self._es_respuesta_combinada_valida
+                        )
+                    except Exception as e:
+                        print(f"❌ Error llamando a OpenRouter: {e}")
+                        import traceback
+                        traceback.print_exc()
+                        return message.model_copy(update={"status": "ERROR"})
+
+                    if combined_response.startswith("ERROR:"):
+                        print(f"❌ OpenRouter falló: {combined_response}")
+                        return message.model_copy(update={"status": "ERROR"})
+
+                    resultado = self._interpretar_respuesta_combinada(combined_response)
+                    if resultado:
+                        clean_intent, data_ext = resultado
+                        data_json_str = combined_response
+                        print(f"🎯 Intención final: {clean_intent}")
+                    else:
+                        print(f"⚠️ Respuesta combinada inválida, usando flujo de dos llamadas")
+                        print(f"📝 Respuesta recibida: '{combined_response[:200]}'")
+
+                if clean_intent is None:
+                    # 1. Extraer intención
+                    print(f"🔄 Paso 1: Detectando intención...")
                     
                     try:
-                        data_json_str = await call_openrouter(
-                            self._data_extraction_prompt, 
-                            message.user_input
+                        intent_response = await call_openrouter(
+                            self._intent_prompt,
+                            message.user_input,
+                            usar_cache=True,
+                            detener_en=_detectar_intencion if OPENROUTER_STREAMING else None,
+                            perfil='clasificacion',
+                            validar=_tiene_intencion
                         )
                         
-                        # 🔥 DEBUG: Mostrar respuesta de extracción
+                        # 🔥 DEBUG: Mostrar respuesta COMPLETA
                         print(f"\n{'='*60}")
-                        print(f"📥 RESPUESTA DE EXTRACCIÓN DE DATOS:")
+                        print(f"📥 RESPUESTA COMPLETA DE OPENROUTER:")
                         print(f"{'='*60}")
-                        print(data_json_str[:500])
+                        print(intent_response)
+                        print(f"{'='*60}")
+                        print(f"Tipo: {type(intent_response)}")
+                        print(f"Longitud: {len(intent_response)} caracteres")
                         print(f"{'='*60}\n")
                         
                     except Exception as e:
-                        print(f"❌ Error extrayendo datos: {e}")
+                        print(f"❌ Error llamando a OpenRouter: {e}")
                         import traceback
                         traceback.print_exc()
                         return message.model_copy(update={"status": "ERROR"})
                     
-                    if data_json_str.startswith("ERROR:"):
-                        print(f"❌ OpenRouter falló en extracción: {data_json_str}")
+                    if intent_response.startswith("ERROR:"):
+                        print(f"❌ OpenRouter falló: {intent_response}")
                         return message.model_copy(update={"status": "ERROR"})
                     
-                    try:
-                        # Limpiar respuesta
-                        data_json_clean = data_json_str.strip()
-                        
-                        # Si viene con ```json, limpiarlo
-                        if '```' in data_json_clean:
-                            import re
-                            json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', data_json_clean, re.DOTALL)
-                            if json_match:
-                                data_json_clean = json_match.group(1)
-                            else:
-                                json_match = re.search(r'\{.*\}', data_json_clean, re.DOTALL)
-                                if json_match:
-                                    data_json_clean = json_match.group(0)
-                        
-                        # Reemplazar comillas simples por dobles
-                        data_json_clean = data_json_clean.replace("'", '"')
+                    
+                    # 2. Limpieza de intención CON DEBUG
+                    print(f"🔄 Paso 2: Limpiando respuesta...")
+
+                    # 🔥 NUEVA ESTRATEGIA: Buscar palabras clave en cualquier parte
+                    intent_response_upper = intent_response.upper()
+
+                    clean_intent = _detectar_intencion(intent_response_upper) or "DESCONOCIDO"
+                    if clean_intent != "DESCONOCIDO":
+                        print(f"✅ Intención detectada: {clean_intent}")
+
+                    # 🔥 FALLBACK: Si menciona "factura" + "monto" en el input = PLANIFICAR
+                    if clean_intent == "DESCONOCIDO":
+                        user_lower = message.user_input.lower()
+                        if "factura" in user_lower and ("$" in user_lower or "pesos" in user_lower):
+                            if "pagué" not in user_lower and "pagó" not in user_lower:
+                                clean_intent = "PLANIFICAR"
+                                print(f"🔄 Fallback: Detectado como PLANIFICAR por contexto")
+
+                    print(f"🎯 Intención final: {clean_intent}")
+
+                    if clean_intent == "DESCONOCIDO":
+                        print(f"\n❌ No se pudo identificar la intención")
+                        print(f"💡 Respuesta de IA no contenía ninguna palabra clave válida")
+                        print(f"💡 Palabras esperadas: {list(INTENT_KEYWORDS)}")
+                        print(f"💡 Respuesta recibida: '{intent_response[:200]}'")
+                        return message.model_copy(update={"status": "ERROR"})
+                
+                # 3. Extraer datos si es necesario
+                if clean_intent in ["PLANIFICAR", "PAGAR"]:
+                    if data_ext is None:
+                        print(f"\n🔄 Paso 3: Extrayendo datos del mensaje...")
                         
-                        print(f"🔄 JSON limpio a parsear:")
-                        print(data_json_clean[:300])
+                        try:
+                            data_json_str = await call_openrouter(
+                                self._data_extraction_prompt, 
+                                message.user_input,
+                                usar_cache=True,
+                                perfil='extraccion',
+                                validar=_es_extraccion_valida
+                            )
+                            
+                            # 🔥 DEBUG: Mostrar respuesta de extracción
+                            print(f"\n{'='*60}")
+                            print(f"📥 RESPUESTA DE EXTRACCIÓN DE DATOS:")
+                            print(f"{'='*60}")
+                            print(data_json_str[:500])
+                            print(f"{'='*60}\n")
+                            
+                        except Exception as e:
+                            print(f"❌ Error extrayendo datos: {e}")
+                            import traceback
+                            traceback.print_exc()
+                            return message.model_copy(update={"status": "ERROR"})
                         
-                        # Parsear JSON
-                        data_ext = json.loads(data_json_clean)
-                        print(f"✅ JSON parseado exitosamente: {data_ext}")
+                        if data_json_str.startswith("ERROR:"):
+                            print(f"❌ OpenRouter falló en extracción: {data_json_str}")
+                            return message.model_copy(update={"status": "ERROR"})
+                    
+                    try:
+                        if data_ext is None:
+                            data_ext = _parsear_json_llm(data_json_str)
+                            print(f"✅ JSON parseado exitosamente: {data_ext}")
                         
                         message.data.update(data_ext)
                         
@@ -746,10 +4533,12 @@ class Organizador(RoutedAgent):
                 
                 elif clean_intent in ["CONSULTA_FACTURA", "CONSULTA_DEUDAS", "CONSULTA_ESTADISTICAS"]:
                     if clean_intent == "CONSULTA_FACTURA":
-                        import re
-                        numeros = re.findall(r'\d+', message.user_input)
-                        if numeros:
-                            message.data['numero_factura'] = numeros[0]
+                        if data_ext and data_ext.get('numero_factura'):
+                            message.data['numero_factura'] = str(data_ext['numero_factura'])
+                        else:
+                            numeros = re.findall(r'\d+', message.user_input)
+                            if numeros:
+                                message.data['numero_factura'] = numeros[0]
                     
                     consulta_map = {
                         "CONSULTA_FACTURA": "FACTURA_ESPECIFICA",
@@ -781,8 +4570,28 @@ class Organizador(RoutedAgent):
 
             elif message.status == "PLANNED":
                 print(f"✅ Planificación completada: {message.data.get('fracciones')} cuota(s) creada(s)")
-                await self.send_message(message, AgentId("notificador", "default"))
-                await self.send_message(message, AgentId("registrador", "default"))
+                notificador, registrador = AgentId("notificador", "default"), AgentId("registrador", "default")
+                if FANOUT_PARALELO:
+                    # Calendar y Sheets son independientes: se despachan juntos
+                    aviso, registro = await asyncio.gather(
+                        self.send_message(message.model_copy(deep=True), notificador),
+                        self.send_message(message, registrador),
+                        return_exceptions=True
+                    )
+                    if isinstance(aviso, Exception):
+                        print(f"⚠️ Error en Google Calendar: {aviso}")
+                else:
+                    await self.send_message(message, notificador)
+                    try:
+                        registro = await self.send_message(message, registrador)
+                    except Exception as e:
+                        registro = e
+                
+                if isinstance(registro, Exception) or (registro is not None and registro.status == "ERROR"):
+                    # Sin fila en Sheets no debe quedar un recordatorio huérfano
+                    print(f"↩️ La factura {message.data.get('numero_factura')} no quedó registrada; retirando su recordatorio")
+                    await self.send_message(message.model_copy(update={"status": "REVERTIR"}), notificador)
+                    return message.model_copy(update={"status": "ERROR"})
                 return message
             
             return message
@@ -798,9 +4607,10 @@ class Organizador(RoutedAgent):
 @default_subscription
 class Planificador(RoutedAgent):
     """Agente que determina la fecha óptima y calcula las fechas fraccionadas."""
-    def __init__(self, sheets_service) -> None:
+    def __init__(self, sheets_service, spreadsheet_id: str | None = None) -> None:
         super().__init__("Planificador de fechas de pago.")
         self.sheets_service = sheets_service
+        self.spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
         
     def _redondear_pesos_colombianos(self, monto: float) -> int:
         """
@@ -809,27 +4619,14 @@ class Planificador(RoutedAgent):
         """
         return int(round(monto / 50) * 50)
     
-    def _obtener_fechas_ocupadas(self) -> dict:
+    def _obtener_fechas_ocupadas(self, sheets_service=None) -> dict:
         """
         Obtiene todas las fechas de vencimiento ya programadas y cuenta cuántas hay por día.
         Retorna un diccionario: {'2025-12-15': 3, '2025-12-16': 1, ...}
         """
         try:
-            result = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, 
-                range='Deuda Pendiente!F:F'  # Columna F: Fecha Vencimiento
-            ).execute()
-            
-            values = result.get('values', [])
-            fechas_count = {}
-            
-            for i, row in enumerate(values):
-                if i == 0:  # Saltar encabezado
-                    continue
-                if row and row[0]:
-                    fecha = _normalize_sheet_date(row[0])
-                    if fecha:
-                        fechas_count[fecha] = fechas_count.get(fecha, 0) + 1
+            # Columna F (Fecha Vencimiento) desde el ledger compartido
+            fechas_count = ledger_activo(sheets_service or self.sheets_service, self.spreadsheet_id).fechas_ocupadas()
             
             if fechas_count:
                 print(f"📊 Fechas ocupadas: {len(fechas_count)} día(s) con pagos programados")
@@ -929,7 +4726,7 @@ class Planificador(RoutedAgent):
         fecha_vencimiento = self._calcular_fecha_vencimiento(message.data, fecha_actual)
         
         # Obtener fechas ya ocupadas
-        fechas_ocupadas = self._obtener_fechas_ocupadas()
+        fechas_ocupadas = await llamar_google(self.sheets_service, self._obtener_fechas_ocupadas)
         
         # Encontrar fecha disponible (máximo 2 pagos por día, buscar en próximos 3 días)
         fecha_pago_final = self._encontrar_fecha_disponible(
@@ -961,146 +4758,99 @@ class Planificador(RoutedAgent):
 class Notificador(RoutedAgent):
     """Agente que gestiona Google Calendar para recordatorios."""
     
-    def __init__(self, calendar_service) -> None: 
+    def __init__(self, calendar_service, spreadsheet_id: str | None = None) -> None: 
         super().__init__("Notificador de Eventos y Tareas.")
         self.calendar_service = calendar_service 
+        self.spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
         self.calendar_id = 'primary'
+        self.calendario = CalendarRecordatorios(calendar_service, self.calendar_id)
+        if TRABAJOS_DIFERIDOS:
+            obtener_cola_trabajos().registrar_servicio(USUARIO_ACTUAL.get(), 'calendar', calendar_service)
 
-    def _get_task_title(self, cuota_id: str, monto_pendiente: float) -> str:
-        """Genera título mostrando solo el monto pendiente total."""
-        factura_id, cuota_num = cuota_id.split('-')
-        if monto_pendiente <= 0:
-            return f"✅ PAGO COMPLETADO - Factura {factura_id}, Cuota {cuota_num}"
-        return f"💰 PAGO PENDIENTE - Factura {factura_id}, Cuota {cuota_num}: ${monto_pendiente:,.0f} COP"
+    async def _ejecutar(self, tipo: str, datos: dict, clave: str) -> None:
+        """Encola el trabajo de Calendar (respuesta inmediata) o lo ejecuta en línea si la cola está apagada."""
+        if TRABAJOS_DIFERIDOS:
+            encolar_trabajo(tipo, datos, clave)
+            return
+        try:
+            await llamar_google(
+                self.calendar_service,
+                lambda c: MANEJADORES_TRABAJOS[tipo](CalendarRecordatorios(c, self.calendar_id), datos),
+                api='calendar'
+            )
+        except LoteCalendarFallido as e:
+            for r in e.resultado:
+                if r["error"]:
+                    print(f"⚠️ Google Calendar, cuota {r['cuota_id']}: {r['error']}")
+        except Exception as e:
+            print(f"⚠️ Error en Google Calendar: {e}")
+
+    async def _ejecutar_lote(self, factura_id: str, operaciones: list, clave: str) -> None:
+        """Todas las operaciones de Calendar del mensaje van en un solo trabajo (un BatchHttpRequest)."""
+        await self._ejecutar(
+            'calendar_lote',
+            {"factura_id": factura_id, "operaciones": operaciones, "spreadsheet_id": self.spreadsheet_id},
+            clave
+        )
 
     @message_handler
     async def handle_message(self, message: PaymentMessage, ctx: MessageContext) -> None:
         
         factura_id = message.data.get('numero_factura')
         
-        if message.intent == "PLANIFICAR":
+        if message.intent == "PLANIFICAR" and message.status == "REVERTIR":
+            
+            # Compensación: el registro en Sheets falló, se borran los recordatorios recién planificados
+            operaciones = [
+                {"tipo": "post_abono", "cuota_id": f"{factura_id}-{i+1}", "monto": 0.0, "fecha": fecha_pago_str}
+                for i, fecha_pago_str in enumerate(message.data.get('fechas_pago', []))
+            ]
+            if operaciones:
+                await self._ejecutar_lote(factura_id, operaciones, f"calendar_revertir:{factura_id}:{','.join(message.data['fechas_pago'])}")
+                print(f"📅 {len(operaciones)} recordatorio(s) retirado(s) de Google Calendar")
+        
+        elif message.intent == "PLANIFICAR":
             
             fechas_pago = message.data.get('fechas_pago', [])
             monto_fraccionado = message.data.get('monto_fraccionado')
             
-            for i, fecha_pago_str in enumerate(fechas_pago):
-                cuota_id = f"{factura_id}-{i+1}"
-                montos_por_cuota = message.data.get('montos_por_cuota', [])
-                monto_pendiente = montos_por_cuota[i] if i < len(montos_por_cuota) else monto_fraccionado 
-                
-                try:
-                    time_min = datetime.strptime(fecha_pago_str, '%Y-%m-%d').isoformat() + 'Z' 
-                    time_max = (datetime.strptime(fecha_pago_str, '%Y-%m-%d') + timedelta(days=1)).isoformat() + 'Z'
-                    
-                    events_result = self.calendar_service.events().list(
-                        calendarId=self.calendar_id, 
-                        timeMin=time_min, 
-                        timeMax=time_max, 
-                        q=cuota_id,
-                        singleEvents=True, 
-                        orderBy='startTime'
-                    ).execute()
-                    
-                    events = events_result.get('items', [])
-                    
-                    if events:
-                        continue
-                
-                except Exception as e:
-                    pass
-                
-                self._create_or_update_task(cuota_id, monto_fraccionado, fecha_pago_str)
+            operaciones = [
+                {"tipo": "planificar", "cuota_id": f"{factura_id}-{i+1}", "monto": monto_fraccionado, "fecha": fecha_pago_str}
+                for i, fecha_pago_str in enumerate(fechas_pago)
+            ]
+            if operaciones:
+                await self._ejecutar_lote(factura_id, operaciones, f"calendar_planificar:{factura_id}:{','.join(fechas_pago)}")
+            
+            if TRABAJOS_DIFERIDOS and fechas_pago:
+                print(f"📅 {len(fechas_pago)} recordatorio(s) en cola para Google Calendar")
         
         elif message.intent == "PAGAR" and message.status == "POST_ABONO":
             
-            cuota_id = message.data.get('cuota_id')
-            monto_pendiente_nuevo = message.data.get('monto_pendiente_simulado', 0.0)
-            fecha_pago_original = message.data.get('fecha_pago_original')
-            
-            if not cuota_id:
+            # Registrador manda todas las cuotas afectadas por el pago en un solo mensaje
+            abonos = message.data.get('abonos') or [{
+                "cuota_id": message.data.get('cuota_id'),
+                "monto_pendiente_simulado": message.data.get('monto_pendiente_simulado', 0.0),
+                "fecha_pago_original": message.data.get('fecha_pago_original'),
+            }]
+            operaciones = [
+                {"tipo": "post_abono", "cuota_id": a["cuota_id"], "monto": a.get("monto_pendiente_simulado", 0.0),
+                 "fecha": a.get("fecha_pago_original") or datetime.now().strftime('%Y-%m-%d')}
+                for a in abonos if a.get("cuota_id")
+            ]
+            if not operaciones:
                 return
-            
-            if not fecha_pago_original:
-                fecha_pago_original = datetime.now().strftime('%Y-%m-%d')
 
-            eventos_eliminados = 0
-            try:
-                fecha_base = datetime.strptime(fecha_pago_original, '%Y-%m-%d')
-                time_min = (fecha_base - timedelta(days=90)).isoformat() + 'Z'
-                time_max = (fecha_base + timedelta(days=90)).isoformat() + 'Z'
-                
-                events_result = self.calendar_service.events().list(
-                    calendarId=self.calendar_id,
-                    timeMin=time_min,
-                    timeMax=time_max,
-                    singleEvents=True,
-                    maxResults=250
-                ).execute()
-                
-                all_events = events_result.get('items', [])
-                
-                events_to_delete = []
-                factura_id_base, cuota_num = cuota_id.split('-')
-                
-                for event in all_events:
-                    summary = event.get('summary', '')
-                    description = event.get('description', '')
-                    
-                    match_cuota_id = cuota_id in summary or cuota_id in description
-                    match_factura_cuota = (
-                        f"Factura {factura_id_base}" in summary and f"Cuota {cuota_num}" in summary
-                    ) or (
-                        f"Factura {factura_id_base}" in description and f"#{cuota_num}" in description
-                    )
-                    
-                    if match_cuota_id or match_factura_cuota:
-                        events_to_delete.append(event)
-                
-                for event in events_to_delete:
-                    try:
-                        event_id = event['id']
-                        
-                        self.calendar_service.events().delete(
-                            calendarId=self.calendar_id, 
-                            eventId=event_id
-                        ).execute()
-                        
-                        eventos_eliminados += 1
-                    except Exception as e_del:
-                        pass
-                
-            except Exception as e:
-                pass
+            factura_base = operaciones[0]["cuota_id"].rsplit('-', 1)[0]
+            await self._ejecutar_lote(
+                factura_base, operaciones,
+                "calendar_post_abono:" + ",".join(f"{op['cuota_id']}={op['monto']}" for op in operaciones)
+            )
             
-            if monto_pendiente_nuevo > 0:
-                self._create_or_update_task(cuota_id, monto_pendiente_nuevo, fecha_pago_original)
-                print(f"📅 Recordatorio actualizado en Google Calendar")
-            else:
-                print(f"📅 Recordatorio eliminado de Google Calendar")
-
-    def _create_or_update_task(self, cuota_id, monto_pendiente_nuevo, fecha_pago):
-        """Crea recordatorio con cuota_id explícito en descripción."""
-        title_new = self._get_task_title(cuota_id, monto_pendiente_nuevo)
-        factura_id, cuota_num = cuota_id.split('-')
-        
-        event = {
-            'summary': title_new, 
-            'description': f"[ID: {cuota_id}] Pago de cuota #{cuota_num} de Factura {factura_id}. Monto PENDIENTE: ${monto_pendiente_nuevo:,.0f} COP.",
-            'start': {'date': fecha_pago}, 
-            'end': {'date': fecha_pago},
-            'reminders': {
-                'useDefault': False,
-                'overrides': [{'method': 'email', 'minutes': 24 * 60}],
-            },
-        }
-        
-        try:
-            self.calendar_service.events().insert(
-                calendarId=self.calendar_id, 
-                body=event
-            ).execute()
-        except Exception as e:
-            pass
+            for op in operaciones:
+                if op["monto"] > 0:
+                    print(f"📅 Recordatorio de {op['cuota_id']} actualizado en Google Calendar")
+                else:
+                    print(f"📅 Recordatorio de {op['cuota_id']} eliminado de Google Calendar")
 
 
 @default_subscription
@@ -1110,53 +4860,44 @@ class Registrador(RoutedAgent):
     el estado de las facturas.
     """
     
-    def __init__(self, sheets_service) -> None: 
+    def __init__(self, sheets_service, spreadsheet_id: str | None = None) -> None: 
         super().__init__("Registrador de Sheets.")
         self.sheets_service = sheets_service
-        self.sheet_ids = self._get_sheet_ids()
-        self.facturas_existentes = self._load_facturas_from_sheets()
+        self.spreadsheet_id = spreadsheet_id or SPREADSHEET_ID
+        # Se cargan en el primer mensaje, fuera del event loop (ver _preparar)
+        self.sheet_ids = None
+        self.facturas_existentes = None
+        self._preparacion = None
         self.facturas_procesadas = set()
 
-    def _get_sheet_ids(self):
-        """Obtiene los IDs de todas las hojas en el Spreadsheet."""
+    async def _preparar(self) -> None:
+        """Pestañas y facturas existentes, leídas una vez vía llamar_google (el runtime se crea por mensaje)."""
+        if self.facturas_existentes is not None:
+            return
+        if self._preparacion is None:
+            self._preparacion = asyncio.ensure_future(llamar_google(
+                self.sheets_service, lambda s: (self._get_sheet_ids(s), self._load_facturas_from_sheets(s))
+            ))
+        sheet_ids, facturas = await self._preparacion
+        if self.facturas_existentes is None:
+            self.sheet_ids, self.facturas_existentes = sheet_ids, facturas
+
+    def _get_sheet_ids(self, sheets_service=None):
+        """Obtiene los IDs de todas las hojas en el Spreadsheet (cacheados por Spreadsheet)."""
         try:
-            spreadsheet = self.sheets_service.spreadsheets().get(
-                spreadsheetId=SPREADSHEET_ID
-            ).execute()
-            
-            sheet_ids = {}
-            for sheet in spreadsheet.get('sheets', []):
-                sheet_title = sheet['properties']['title']
-                sheet_id = sheet['properties']['sheetId']
-                sheet_ids[sheet_title] = sheet_id
-            
-            return sheet_ids
-            
+            return obtener_sheet_ids(sheets_service or self.sheets_service, self.spreadsheet_id)
         except HttpError as e:
             return {}
 
-    def _load_facturas_from_sheets(self):
-        """Carga datos de la hoja 'Deuda Pendiente' y los formatea."""
+    def _load_facturas_from_sheets(self, sheets_service=None):
+        """Carga datos de la hoja 'Deuda Pendiente' (vía ledger compartido) y los formatea."""
         try:
-            result = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, range=SHEETS_RANGE).execute()
-            
-            values = result.get('values', [])
+            ledger = ledger_activo(sheets_service or self.sheets_service, self.spreadsheet_id)
             
             facturas = {}
-            if values and len(values) > 1: 
-                for row in values[1:]: 
-                    try:
-                        if len(row) < 8: continue
-                        
-                        factura_id = str(row[1]).strip()
-                        monto_pendiente = float(row[3]) 
-                        estado = row[7].strip()
-
-                        if factura_id and estado == "PENDIENTE":
-                            facturas[factura_id] = {"monto_pendiente": monto_pendiente, "estado": estado}
-                    except (IndexError, ValueError):
-                        continue
+            for cuota in ledger.cuotas_pendientes():
+                if cuota.cuota_id:
+                    facturas[cuota.cuota_id] = {"monto_pendiente": cuota.monto_pendiente, "estado": cuota.estado}
             
             return facturas
             
@@ -1165,43 +4906,55 @@ class Registrador(RoutedAgent):
         except Exception as e:
             return {}
 
-    def _find_factura_row(self, factura_id: str):
+    def _find_factura_row(self, factura_id: str, sheets_service=None):
         """
         Busca una factura (o cuota) por ID en 'Deuda Pendiente' y devuelve el número de fila.
         """
+        sheets_service = sheets_service or self.sheets_service
         try:
-            result = self.sheets_service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID, range=SHEETS_RANGE).execute()
-            values = result.get('values', [])
-            
-            for i, row in enumerate(values):
-                if i == 0: continue
-
-                if len(row) > 7:
-                    sheet_id = str(row[1]).strip()
-                    estado = row[7].strip()
-                    row_number = i + 1
-
-                    if sheet_id == factura_id:
-                        return row_number, row
-                    
-                    if sheet_id.startswith(f"{factura_id}-") and estado == "PENDIENTE":
-                        return row_number, row
-            
-            return None, None
+            ledger = ledger_activo(sheets_service, self.spreadsheet_id)
+            cuota = ledger.buscar_cuota(factura_id)
+            if (cuota is not None and isinstance(ledger, LedgerCache) and LEDGER_VERIFICAR_FILAS
+                    and not ledger.verificar_fila(sheets_service, cuota)):
+                # El ledger se recargó: se busca de nuevo sobre datos frescos
+                cuota = ledger.buscar_cuota(factura_id)
+            if cuota is None:
+                return None, None
+            return cuota.fila, cuota.como_fila()
         
         except HttpError as e:
             return None, None
 
-    def _registrar_pago_en_historial(self, factura_id: str, tipo_transaccion: str, monto_abonado: float, monto_pendiente_restante: float, notas: str = ""):
-        """Registra en la hoja correcta con columnas en orden."""
+    def _nuevo_plan(self):
+        """Plan de escrituras del mensaje: al ledger local (y su espejo) o directo a Sheets."""
+        if LEDGER_LOCAL:
+            return PlanLocal(obtener_ledger_local(self.spreadsheet_id))
+        return PlanEscrituras(self.sheet_ids, self.spreadsheet_id, compactar_luego=True)
+
+    def _hoja_historial(self):
+        if 'Historial de Pagos' in self.sheet_ids:
+            return 'Historial de Pagos'
+        if 'Facturas Pagadas' in self.sheet_ids:
+            return 'Facturas Pagadas'
+        return None
+
+    def _registrar_pago_en_historial(self, factura_id: str, tipo_transaccion: str, monto_abonado: float, monto_pendiente_restante: float, notas: str = "", plan: PlanEscrituras | None = None, sheets_service=None):
+        """Registra en la hoja correcta con columnas en orden (o lo encola en el plan del mensaje)."""
+        sheets_service = sheets_service or self.sheets_service
         try:
-            historial_sheet_name = None
-            if 'Historial de Pagos' in self.sheet_ids:
-                historial_sheet_name = 'Historial de Pagos'
-            elif 'Facturas Pagadas' in self.sheet_ids:
-                historial_sheet_name = 'Facturas Pagadas'
-            else:
+            historial_sheet_name = self._hoja_historial()
+            if historial_sheet_name is None:
+                return
+            
+            if plan is not None or LEDGER_LOCAL:
+                plan_propio = plan is None
+                plan = plan if plan is not None else self._nuevo_plan()
+                plan.agregar_fila(factura_id, historial_sheet_name, [
+                    datetime.now().replace(microsecond=0), factura_id, tipo_transaccion,
+                    monto_abonado, monto_pendiente_restante, notas
+                ])
+                if plan_propio and not plan.ejecutar(sheets_service).get(factura_id):
+                    print(f"📊 Registrado en historial: {tipo_transaccion} - ${monto_abonado:,.0f} COP")
                 return
             
             nueva_fila_historial = [
@@ -1213,20 +4966,27 @@ class Registrador(RoutedAgent):
                 notas
             ]
             
-            self.sheets_service.spreadsheets().values().append(
-                spreadsheetId=SPREADSHEET_ID,
+            result = sheets_service.spreadsheets().values().append(
+                spreadsheetId=self.spreadsheet_id,
                 range=f'{historial_sheet_name}!A:F',
                 valueInputOption='USER_ENTERED',
                 body={'values': [nueva_fila_historial]}
             ).execute()
             
+            if historial_sheet_name == 'Historial de Pagos':
+                obtener_ledger(self.spreadsheet_id).agregar_historial(
+                    nueva_fila_historial,
+                    _fila_inicial_de_rango(result.get('updates', {}).get('updatedRange'))
+                )
+            
             print(f"📊 Registrado en historial: {tipo_transaccion} - ${monto_abonado:,.0f} COP")
             
         except HttpError as e:
             pass
 
     @message_handler
-    async def handle_message(self, message: PaymentMessage, ctx: MessageContext) -> None:
+    async def handle_message(self, message: PaymentMessage, ctx: MessageContext) -> Optional[PaymentMessage]:
+        """En PLANIFICAR responde REGISTERED o ERROR para que el Organizador sepa si compensar Calendar."""
         factura_id: str | None = message.data.get('numero_factura')
 
         if factura_id is None or factura_id == "N/A":
@@ -1237,6 +4997,7 @@ class Registrador(RoutedAgent):
         if mensaje_unico in self.facturas_procesadas:
             return
         self.facturas_procesadas.add(mensaje_unico)
+        await self._preparar()
 
         if message.intent == "PLANIFICAR":
             
@@ -1269,13 +5030,35 @@ class Registrador(RoutedAgent):
                 ]
                 rows_to_append.append(new_row)
             
+            if LEDGER_LOCAL:
+                plan = self._nuevo_plan()
+                for row in rows_to_append:
+                    plan.agregar_fila(row[1], 'Deuda Pendiente', row)
+                errores = {e for e in plan.ejecutar(self.sheets_service).values() if e}
+                if errores:
+                    print(f"❌ Error al registrar la factura {factura_id}: {'; '.join(errores)}")
+                    return message.model_copy(update={"status": "ERROR"})
+                print(f"✅ Factura {factura_id} registrada ({fracciones} cuota{'s' if fracciones > 1 else ''}); Google Sheets se actualiza en segundo plano")
+                
+                for i in range(fracciones):
+                    cuota_id = f"{factura_id}-{i+1}"
+                    monto_cuota = montos_por_cuota[i] if i < len(montos_por_cuota) else monto_fraccionado
+                    self.facturas_existentes[cuota_id] = {"monto_pendiente": monto_cuota, "estado": "PENDIENTE"} 
+                
+                self.facturas_existentes[factura_id] = {"monto_pendiente": monto_total, "estado": "PLANIFICADO"}
+                return message.model_copy(update={"status": "REGISTERED"})
+            
             try:
-                self.sheets_service.spreadsheets().values().append(
-                    spreadsheetId=SPREADSHEET_ID,
+                result = await llamar_google(self.sheets_service, lambda s: s.spreadsheets().values().append(
+                    spreadsheetId=self.spreadsheet_id,
                     range='Deuda Pendiente!A:H', 
                     valueInputOption='USER_ENTERED',
                     body={'values': rows_to_append}
-                ).execute()
+                ).execute())
+                obtener_ledger(self.spreadsheet_id).agregar_cuotas(
+                    rows_to_append,
+                    _fila_inicial_de_rango(result.get('updates', {}).get('updatedRange'))
+                )
                 print(f"✅ Factura {factura_id} registrada en Google Sheets ({fracciones} cuota{'s' if fracciones > 1 else ''})")
                 
                 # Actualizar caché con montos correctos por cuota
@@ -1285,9 +5068,11 @@ class Registrador(RoutedAgent):
                     self.facturas_existentes[cuota_id] = {"monto_pendiente": monto_cuota, "estado": "PENDIENTE"} 
                 
                 self.facturas_existentes[factura_id] = {"monto_pendiente": monto_total, "estado": "PLANIFICADO"}
+                return message.model_copy(update={"status": "REGISTERED"})
 
             except HttpError as e:
                 print(f"❌ Error al registrar en Sheets")
+                return message.model_copy(update={"status": "ERROR"})
                 
         
         elif message.intent == "PAGAR":
@@ -1323,13 +5108,14 @@ class Registrador(RoutedAgent):
                 if monto_abono > 0.0:
                     print(f"📝 Registrando pago de factura no planificada")
                     
-                    self._registrar_pago_en_historial(
+                    await llamar_google(self.sheets_service, lambda s: self._registrar_pago_en_historial(
                         factura_id,
                         "Pago Sin Planificación",
                         monto_abono,
                         0.0,
-                        f"Pago de factura no registrada previamente. Monto: ${monto_abono:.2f}"
-                    )
+                        f"Pago de factura no registrada previamente. Monto: ${monto_abono:.2f}",
+                        sheets_service=s
+                    ))
                     
                     self.facturas_existentes[factura_id] = {"monto_pendiente": 0.0, "estado": "PAGADA"}
                     
@@ -1363,11 +5149,17 @@ class Registrador(RoutedAgent):
                         self.facturas_existentes[k].get('estado') == 'PENDIENTE'
                     ])
                 
+                # Todas las escrituras del pago se aplican juntas al final del recorrido
+                plan = self._nuevo_plan()
+                estado_anterior = {}
+                
                 for cuota_actual in cuotas_a_procesar:
                     if monto_restante_por_aplicar <= 0:
                         break
                     
-                    row_number, current_row = self._find_factura_row(cuota_actual)
+                    row_number, current_row = await llamar_google(
+                        self.sheets_service, lambda s: self._find_factura_row(cuota_actual, s)
+                    )
                     
                     if not row_number or current_row is None:
                         continue
@@ -1385,6 +5177,7 @@ class Registrador(RoutedAgent):
                     factura_completa_id_sheets = current_row[1]
                     
                     if factura_completa_id_sheets in self.facturas_existentes:
+                        estado_anterior[factura_completa_id_sheets] = dict(self.facturas_existentes[factura_completa_id_sheets])
                         self.facturas_existentes[factura_completa_id_sheets]['monto_pendiente'] = monto_pendiente_nuevo_redondeado
                     
                     self._registrar_pago_en_historial(
@@ -1392,94 +5185,69 @@ class Registrador(RoutedAgent):
                         "Abono Parcial" if monto_pendiente_nuevo_redondeado > 0 else "Pago Completo",
                         monto_a_aplicar,
                         monto_pendiente_nuevo_redondeado,
-                        f"Abono de ${monto_a_aplicar:.2f}. Monto anterior: ${monto_pendiente_actual:.2f}"
+                        f"Abono de ${monto_a_aplicar:.2f}. Monto anterior: ${monto_pendiente_actual:.2f}",
+                        plan=plan
                     )
                     
                     if monto_pendiente_nuevo_redondeado > 0:
-                        new_value = [[monto_pendiente_nuevo_redondeado]] 
-                        range_to_update = f'Deuda Pendiente!D{row_number}' 
-                        
-                        try:
-                            self.sheets_service.spreadsheets().values().update(
-                                spreadsheetId=SPREADSHEET_ID, range=range_to_update,
-                                valueInputOption='USER_ENTERED', body={'values': new_value}
-                            ).execute()
-                            print(f"✅ Cuota {factura_completa_id_sheets}: ${monto_pendiente_actual:,.0f} → ${monto_pendiente_nuevo_redondeado:,.0f} COP")
-                            
-                        except HttpError as e:
-                            pass
-                        
-                        try:
-                            cuota_id_completo = current_row[1]
-                            fecha_pago_original = _normalize_sheet_date(current_row[5])
-                            if not fecha_pago_original:
-                                fecha_pago_original = datetime.now().strftime('%Y-%m-%d')
-                            
-                            mensaje_notificador = message.model_copy(update={
-                                "status": "POST_ABONO",
-                                "data": {
-                                    **message.data,
-                                    "cuota_id": cuota_id_completo,
-                                    "fecha_pago_original": fecha_pago_original,
-                                    "monto_pendiente_simulado": monto_pendiente_nuevo_redondeado
-                                }
-                            })
-                            
-                            await self.send_message(mensaje_notificador, AgentId("notificador", "default"))
-                            
-                        except (IndexError, ValueError) as e:
-                            pass
-                    
+                        plan.actualizar_celda(factura_completa_id_sheets, 'Deuda Pendiente', row_number, 3, monto_pendiente_nuevo_redondeado)
+                    elif CUOTAS_LAPIDA:
+                        plan.marcar_pagada(factura_completa_id_sheets, 'Deuda Pendiente', row_number)
                     else:
-                        try:
-                            deuda_sheet_id = self.sheet_ids.get('Deuda Pendiente', 0)
-                            
-                            if deuda_sheet_id is None:
-                                continue
-                            
-                            requests = [{'deleteDimension': {'range': {
-                                'sheetId': deuda_sheet_id,
-                                'dimension': 'ROWS', 
-                                'startIndex': row_number - 1, 
-                                'endIndex': row_number
-                            }}}]
-                            
-                            self.sheets_service.spreadsheets().batchUpdate(
-                                spreadsheetId=SPREADSHEET_ID, body={'requests': requests}
-                            ).execute()
-                            
-                            print(f"✅ Cuota {factura_completa_id_sheets} PAGADA COMPLETAMENTE")
-                            
-                            self.facturas_existentes[factura_completa_id_sheets] = {"monto_pendiente": 0.0, "estado": "PAGADA"}
-                            
-                            try:
-                                cuota_id_completo = current_row[1]
-                                fecha_pago_original = _normalize_sheet_date(current_row[5])
-                                
-                                mensaje_notificador = message.model_copy(update={
-                                    "status": "POST_ABONO",
-                                    "data": {
-                                        **message.data,
-                                        "cuota_id": cuota_id_completo,
-                                        "fecha_pago_original": fecha_pago_original or datetime.now().strftime('%Y-%m-%d'),
-                                        "monto_pendiente_simulado": 0.0
-                                    }
-                                })
-                                
-                                await self.send_message(mensaje_notificador, AgentId("notificador", "default"))
-                                
-                            except (IndexError, ValueError) as e:
-                                pass
-                        
-                        except HttpError as e:
-                            pass
+                        plan.eliminar_fila(factura_completa_id_sheets, 'Deuda Pendiente', row_number)
                     
                     monto_restante_por_aplicar -= monto_a_aplicar
                     cuotas_procesadas.append({
                         'cuota': factura_completa_id_sheets,
                         'aplicado': monto_a_aplicar,
-                        'restante': monto_pendiente_nuevo_redondeado
+                        'anterior': monto_pendiente_actual,
+                        'restante': monto_pendiente_nuevo_redondeado,
+                        'fecha_pago_original': _normalize_sheet_date(current_row[5]) if len(current_row) > 5 else None
+                    })
+                
+                resultados = await llamar_google(self.sheets_service, plan.ejecutar)
+                if len(plan) and LEDGER_LOCAL:
+                    print(f"📊 {len(plan)} escritura(s) guardadas; Google Sheets se actualiza en segundo plano")
+                elif len(plan):
+                    print(f"📊 {len(plan)} escritura(s) enviadas a Sheets en un solo batchUpdate")
+                
+                for cuota in cuotas_procesadas:
+                    cuota_id_completo = cuota['cuota']
+                    error = resultados.get(cuota_id_completo)
+                    
+                    if error:
+                        print(f"❌ Cuota {cuota_id_completo}: no se pudo registrar el pago ({error})")
+                        if cuota_id_completo in estado_anterior:
+                            self.facturas_existentes[cuota_id_completo] = estado_anterior[cuota_id_completo]
+                        monto_restante_por_aplicar += cuota['aplicado']
+                        continue
+                    
+                    print(f"📊 Registrado en historial: {'Abono Parcial' if cuota['restante'] > 0 else 'Pago Completo'} - ${cuota['aplicado']:,.0f} COP")
+                    if cuota['restante'] > 0:
+                        print(f"✅ Cuota {cuota_id_completo}: ${cuota['anterior']:,.0f} → ${cuota['restante']:,.0f} COP")
+                    else:
+                        print(f"✅ Cuota {cuota_id_completo} PAGADA COMPLETAMENTE")
+                        self.facturas_existentes[cuota_id_completo] = {"monto_pendiente": 0.0, "estado": "PAGADA"}
+                
+                cuotas_procesadas = [c for c in cuotas_procesadas if not resultados.get(c['cuota'])]
+                
+                if cuotas_procesadas:
+                    # Un solo mensaje con todas las cuotas: Calendar las actualiza en un solo lote
+                    mensaje_notificador = message.model_copy(update={
+                        "status": "POST_ABONO",
+                        "data": {
+                            **message.data,
+                            "abonos": [
+                                {
+                                    "cuota_id": c['cuota'],
+                                    "fecha_pago_original": c['fecha_pago_original'] or datetime.now().strftime('%Y-%m-%d'),
+                                    "monto_pendiente_simulado": c['restante'],
+                                }
+                                for c in cuotas_procesadas
+                            ]
+                        }
                     })
+                    await self.send_message(mensaje_notificador, AgentId("notificador", "default"))
                 
                 if monto_restante_por_aplicar > 0:
                     print(f"⚠️ Excedente de ${monto_restante_por_aplicar:,.0f} COP - No hay más cuotas pendientes")
@@ -1490,6 +5258,151 @@ class Registrador(RoutedAgent):
                  print(f"⚠️ Para marcar como pagada, debe especificar el monto del pago")
 
 
+# --- 4b. CLASIFICACIÓN POR LOTES ---
+
+LOTE_PRESUPUESTO_TOKENS = int(os.environ.get('LOTE_PRESUPUESTO_TOKENS', '1500'))
+LOTE_MAX_ITEMS = int(os.environ.get('LOTE_MAX_ITEMS', '20'))
+LOTE_TOKENS_SALIDA_POR_ITEM = 80
+
+
+def _estimar_tokens(texto: str) -> int:
+    """Estimación gruesa (~4 caracteres por token) suficiente para armar lotes."""
+    return len(texto) // 4 + 1
+
+
+def _build_batch_prompt() -> str:
+    return (
+        Organizador._build_combined_prompt()
+        + "\n\nMODO LOTE: recibirás un arreglo JSON de mensajes con la forma "
+        "[{\"id\": 0, \"texto\": \"...\"}, ...]. Aplica las reglas anteriores a CADA mensaje "
+        "y devuelve SOLO un arreglo JSON con un objeto por mensaje, en el mismo orden, "
+        "incluyendo su \"id\" además de los campos indicados."
+    )
+
+
+# Si cambió algún prompt, las respuestas cacheadas con el prompt anterior ya no sirven
+# (en disco se aplica una sola vez, cuando la caché abre su base)
+LLM_CACHE.retener_prompts([
+    Organizador._build_intent_prompt(), Organizador._build_data_extraction_prompt(),
+    Organizador._build_combined_prompt(), _build_batch_prompt(),
+])
+
+
+def _armar_lotes(textos: list, presupuesto_tokens: int, max_items: int) -> list:
+    """Agrupa índices de textos en lotes que respetan el presupuesto de tokens."""
+    base = _estimar_tokens(_build_batch_prompt())
+    lotes, actual, tokens_actual = [], [], base
+    for idx, texto in enumerate(textos):
+        tokens = _estimar_tokens(texto) + 10  # + envoltorio {"id", "texto"}
+        if actual and (tokens_actual + tokens > presupuesto_tokens or len(actual) >= max_items):
+            lotes.append(actual)
+            actual, tokens_actual = [], base
+        actual.append(idx)
+        tokens_actual += tokens
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+
+def _interpretar_lote(respuesta: str, indices: list) -> dict:
+    """Interpreta la respuesta de un lote: {índice: (intent, datos)} de los ítems válidos."""
+    try:
+        salida = _parsear_json_llm(respuesta)
+    except json.JSONDecodeError:
+        print(f"⚠️ Lote con JSON inválido, se reintenta ítem por ítem")
+        return {}
+    if isinstance(salida, dict):
+        salida = [salida]
+    if not isinstance(salida, list):
+        return {}
+
+    interpretados = {}
+    for pos, item in enumerate(salida):
+        if not isinstance(item, dict):
+            continue
+        idx = item.pop("id", indices[pos] if pos < len(indices) else None)
+        try:
+            idx = int(idx)
+        except (TypeError, ValueError):
+            continue
+        if idx not in indices or idx in interpretados:
+            continue
+        interpretado = Organizador._interpretar_respuesta_combinada(json.dumps(item))
+        if interpretado:
+            interpretados[idx] = interpretado
+    return interpretados
+
+
+async def clasificar_mensaje(texto: str) -> dict | None:
+    """Clasificación de un solo mensaje (fast-path y luego llamada combinada)."""
+    rapido = PARSER_RAPIDO.analizar(texto)
+    if rapido:
+        return {"intent": rapido["intent"], "data": rapido["data"], "origen": "parser"}
+
+    respuesta = await call_openrouter(
+        Organizador._build_combined_prompt(), texto,
+        usar_cache=True, response_format=RESPUESTA_COMBINADA_FORMAT, perfil='extraccion',
+        validar=Organizador._es_respuesta_combinada_valida
+    )
+    if respuesta.startswith("ERROR:"):
+        return None
+    resultado = Organizador._interpretar_respuesta_combinada(respuesta)
+    if not resultado:
+        return None
+    return {"intent": resultado[0], "data": resultado[1], "origen": "individual"}
+
+
+async def clasificar_lote(textos: list, presupuesto_tokens: int = LOTE_PRESUPUESTO_TOKENS,
+                          max_items: int = LOTE_MAX_ITEMS) -> list:
+    """
+    Clasifica muchos mensajes empaquetándolos en pocas llamadas al LLM.
+    Devuelve una lista alineada con textos: {'intent', 'data', 'origen'} o None si falló.
+    Los ítems que el lote devuelve mal formados se reintentan con clasificar_mensaje().
+    """
+    token_prioridad = PRIORIDAD_ACTUAL.set(PRIORIDAD_LOTE)
+    try:
+        resultados = [None] * len(textos)
+        pendientes = []
+        for idx, texto in enumerate(textos):
+            rapido = PARSER_RAPIDO.analizar(texto)
+            if rapido:
+                resultados[idx] = {"intent": rapido["intent"], "data": rapido["data"], "origen": "parser"}
+            else:
+                pendientes.append(idx)
+
+        prompt = _build_batch_prompt()
+        sub_textos = [textos[i] for i in pendientes]
+        for lote in _armar_lotes(sub_textos, presupuesto_tokens, max_items):
+            indices = [pendientes[i] for i in lote]
+            items = [{"id": idx, "texto": textos[idx]} for idx in indices]
+            print(f"📦 Clasificando lote de {len(items)} mensaje(s)...")
+
+            respuesta = await call_openrouter(
+                prompt, json.dumps(items, ensure_ascii=False),
+                usar_cache=True,
+                max_tokens=LOTE_TOKENS_SALIDA_POR_ITEM * len(items) + 50,
+                perfil='extraccion',
+                # Solo se cachea un lote que vino completo y bien formado
+                validar=lambda r, indices=indices: len(_interpretar_lote(r, indices)) == len(indices)
+            )
+            if respuesta.startswith("ERROR:"):
+                print(f"⚠️ Lote falló: {respuesta}")
+                continue
+
+            for idx, interpretado in _interpretar_lote(respuesta, indices).items():
+                if resultados[idx] is None:
+                    resultados[idx] = {"intent": interpretado[0], "data": interpretado[1], "origen": "lote"}
+
+        for idx in pendientes:
+            if resultados[idx] is None:
+                print(f"🔁 Ítem {idx} mal formado en el lote, clasificando individualmente")
+                resultados[idx] = await clasificar_mensaje(textos[idx])
+
+        return resultados
+    finally:
+        PRIORIDAD_ACTUAL.reset(token_prioridad)
+
+
 # --- 5. FUNCIÓN PRINCIPAL - MODO CHATBOT ---
 
 def mostrar_menu():
@@ -1516,6 +5429,8 @@ def mostrar_menu():
     print("📈 STATS:      'Estadísticas'")
     print("\n🛠️  UTILIDADES:")
     print("🧹 LIMPIAR:    'limpiar hoja' (elimina TODAS las facturas)")
+    print("🩺 MODELOS:    'modelos' (salud y enrutamiento de la IA)")
+    print("🧹 COMPACTAR:  'compactar' (quita de la hoja las cuotas ya PAGADAS)")
     print("\n❓ AYUDA:      'ayuda' o 'comandos'")
     print("🚪 SALIR:      'salir' o 'exit'")
     print("="*70)
@@ -1549,10 +5464,27 @@ async def chatbot_loop(runtime, sheets_service):
                 mostrar_menu()
                 continue
             
+            if user_input.lower() in ['modelos', 'salud modelos']:
+                mostrar_salud_modelos()
+                continue
+            
             if user_input.lower() in ['sheets', 'ver sheets', 'link']:
                 print(f"\n🔗 Tu Google Sheets: https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}")
                 continue
             
+            if user_input.lower() in ['compactar', 'compactar hoja']:
+                if LEDGER_LOCAL:
+                    # El hilo espejo es el único que escribe en la hoja: compacta cuando vacíe su cola
+                    obtener_ledger_local().espejo.solicitar_compactacion()
+                    print("\n🧹 Compactación programada; se hará en cuanto el espejo termine de replicar.")
+                else:
+                    try:
+                        filas = compactar_deuda(sheets_service)
+                        print(f"\n🧹 {filas} fila(s) pagada(s) eliminada(s)." if filas else "\n🧹 No hay cuotas pagadas que compactar.")
+                    except HttpError as e:
+                        print(f"\n❌ No se pudo compactar: {e}")
+                continue
+            
             # Comando para limpiar hoja
             if user_input.lower() in ['limpiar', 'limpiar hoja', 'borrar todo', 'reset']:
                 print("\n⚠️  ¿ESTÁS SEGURO? Esto eliminará TODAS las facturas pendientes.")
@@ -1560,13 +5492,8 @@ async def chatbot_loop(runtime, sheets_service):
                 
                 if confirmacion == "SI CONFIRMO":
                     try:
-                        # Obtener todas las filas
-                        result = sheets_service.spreadsheets().values().get(
-                            spreadsheetId=SPREADSHEET_ID,
-                            range='Deuda Pendiente!A:H'
-                        ).execute()
-                        
-                        values = result.get('values', [])
+                        # Solo hace falta contar filas: basta con A:B
+                        values = leer_rangos(sheets_service, ['Deuda Pendiente!A:B'])['Deuda Pendiente!A:B']
                         num_filas = len(values)
                         
                         if num_filas > 1:  # Si hay más que solo el encabezado
@@ -1587,6 +5514,9 @@ async def chatbot_loop(runtime, sheets_service):
                                 body={'requests': requests}
                             ).execute()
                             
+                            obtener_ledger().invalidar()
+                            if LEDGER_LOCAL:
+                                obtener_ledger_local().limpiar_cuotas()
                             print(f"✅ Se eliminaron {num_filas - 1} factura(s) pendiente(s).")
                         else:
                             print("ℹ️  No hay facturas pendientes para eliminar.")
@@ -1670,7 +5600,36 @@ async def main() -> None:
     print(f"📅 Google Calendar: {CALENDAR_ID}")
     
     # Iniciar chatbot
-    await chatbot_loop(runtime, sheets_service)
+    try:
+        await chatbot_loop(runtime, sheets_service)
+    finally:
+        if CUOTAS_LAPIDA and not LEDGER_LOCAL:
+            # Sin hilo espejo, el cierre es el momento tranquilo para quitar las lápidas
+            cancelar_compactaciones()
+            try:
+                compactar_deuda(sheets_service)
+            except HttpError as e:
+                print(f"⚠️ No se pudo compactar 'Deuda Pendiente': {e}")
+        await cerrar_cliente_http()
+        cerrar_ejecutor_google()
+        detener_trabajos()
+        detener_espejos()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench-lectura':
+        # python main.py --bench-lectura [filas]
+        resultado = benchmark_lectura_tipada(int(sys.argv[2]) if len(sys.argv) > 2 else 100_000)
+        print(f"📊 {resultado['filas']:,} filas: formateado {resultado['formateado_s']}s, "
+              f"tipado {resultado['tipado_s']}s (x{resultado['aceleracion']})")
+    elif len(sys.argv) > 1 and sys.argv[1] == '--bench-fanout':
+        # python main.py --bench-fanout [mensajes] [latencia_s]
+        resultado = benchmark_fanout_planificado(
+            int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+            float(sys.argv[3]) if len(sys.argv) > 3 else 0.2,
+        )
+        print(f"📊 PLANNED (Calendar + Sheets, {resultado['latencia_s']}s por llamada): "
+              f"1 mensaje {resultado['un_mensaje_bloqueante_s']}s → {resultado['un_mensaje_concurrente_s']}s; "
+              f"{resultado['mensajes']} mensajes {resultado['lote_bloqueante_s']}s → {resultado['lote_concurrente_s']}s "
+              f"(x{resultado['aceleracion_lote']})")
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -2,12 +2,14 @@
 from flask import Flask, request, jsonify, session, make_response, redirect
 from flask_cors import CORS
 import asyncio
+import contextvars
 import os
 
 if os.environ.get('FLASK_ENV') == 'development' or os.environ.get('INSECURE_OAUTH') == '1' or not os.environ.get('RENDER'):
     os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Thread
+import atexit
 import sys
 import io
 import pickle
@@ -22,6 +24,41 @@ sys.stdout = sys.__stdout__
 sys.stderr = sys.__stderr__
 os.environ['PYTHONUNBUFFERED'] = '1'
 
+
+# Salida del mensaje en curso: las respuestas se arman a partir de lo que imprimen los agentes.
+# El loop es compartido, así que no se puede cambiar sys.stdout por request (dos mensajes
+# intercalados se pisarían el buffer); cada tarea escribe en el suyo vía contextvar y lo que
+# imprimen los hilos de fondo (espejo, trabajos) va a la consola.
+SALIDA_MENSAJE = contextvars.ContextVar('salida_mensaje', default=None)
+
+
+class _SalidaPorMensaje(io.TextIOBase):
+    def __init__(self, consola) -> None:
+        self._consola = consola
+
+    @property
+    def encoding(self):
+        return self._consola.encoding
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._consola.isatty()
+
+    def fileno(self) -> int:
+        return self._consola.fileno()
+
+    def write(self, texto: str) -> int:
+        buffer = SALIDA_MENSAJE.get()
+        return (buffer if buffer is not None else self._consola).write(texto)
+
+    def flush(self) -> None:
+        self._consola.flush()
+
+
+sys.stdout = _SalidaPorMensaje(sys.__stdout__)
+
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -70,6 +107,29 @@ user_sessions = {}
 _sheets_service_cache = None
 _calendar_service_cache = None
 
+# Event loop persistente: permite reutilizar el cliente HTTP de OpenRouter entre requests
+# (con asyncio.run() cada request creaba un loop nuevo y perdía las conexiones keep-alive)
+_async_loop = asyncio.new_event_loop()
+Thread(target=_async_loop.run_forever, name='async-loop', daemon=True).start()
+
+
+def ejecutar_async(coro, timeout=None):
+    """Ejecuta una corutina en el event loop persistente y espera el resultado."""
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop).result(timeout)
+
+
+@atexit.register
+def _cerrar_recursos_async():
+    """Cierra el cliente HTTP compartido, vacía el espejo de Sheets y detiene el loop al apagar el servidor."""
+    try:
+        ejecutar_async(main.cerrar_cliente_http(), timeout=5)
+    except Exception as e:
+        print(f"⚠️ Error al cerrar cliente HTTP: {e}")
+    main.cerrar_ejecutor_google()
+    main.detener_trabajos(timeout=10)
+    main.detener_espejos(timeout=10)
+    _async_loop.call_soon_threadsafe(_async_loop.stop)
+
 
 # ============================================================================
 # FUNCIONES DE GESTIÓN DE CREDENCIALES POR USUARIO
@@ -165,10 +225,11 @@ def save_user_sheets_id(user_id, sheets_id):
 # FUNCIONES DE RUNTIME Y PROCESAMIENTO
 # ============================================================================
 
-async def inicializar_runtime(user_id):
-    """Crea un nuevo runtime usando las credenciales y Sheets del usuario específico."""
-    new_runtime = SingleThreadedAgentRuntime()
-    
+def _preparar_servicios(user_id):
+    """
+    Credenciales (con refresh), Sheets del usuario (lo crea si no tiene) y clientes de Google.
+    Todo es bloqueante: se llama fuera del event loop compartido.
+    """
     # 🔥 CRÍTICO: Obtener o crear el Sheets ID del usuario
     user_sheets_id = get_user_sheets_id(user_id)
     
@@ -194,28 +255,46 @@ async def inicializar_runtime(user_id):
     else:
         print(f"✅ Usando Sheets existente del usuario: {user_sheets_id}")
     
-    # 🔥 ASIGNAR el Sheets ID del usuario a main.py
-    main.SPREADSHEET_ID = user_sheets_id
-    
     # Crear servicios con credenciales del usuario
     sheets_service, calendar_service = create_google_services(user_id)
     
     if not sheets_service or not calendar_service:
         raise ValueError("No se pudieron crear los servicios de Google para este usuario")
     
+    return user_sheets_id, sheets_service, calendar_service
+
+
+async def inicializar_runtime(user_id):
+    """
+    Crea un nuevo runtime usando las credenciales y Sheets del usuario específico.
+    Lo devuelve sin arrancar: quien lo arranca fija antes el contexto (salida) de sus agentes.
+    """
+    new_runtime = SingleThreadedAgentRuntime()
+    
+    # Un refresh de token lento no debe frenar a los demás usuarios del loop
+    user_sheets_id, sheets_service, calendar_service = await asyncio.get_running_loop().run_in_executor(
+        None, _preparar_servicios, user_id
+    )
+    
+    # 🔥 El Sheets ID va explícito a cada agente: el loop es compartido y main.SPREADSHEET_ID
+    # (global) se pisaría entre mensajes de usuarios distintos que se intercalan
+    
     # Registrar agentes con los servicios del usuario
     await main.Organizador.register(new_runtime, "organizador", main.Organizador)
-    await main.Planificador.register(new_runtime, "planificador", lambda: main.Planificador(sheets_service))
-    await main.Notificador.register(new_runtime, "notificador", lambda: main.Notificador(calendar_service))
-    await main.Registrador.register(new_runtime, "registrador", lambda: main.Registrador(sheets_service))
-    await main.Consultor.register(new_runtime, "consultor", lambda: main.Consultor(sheets_service))
+    await main.Planificador.register(new_runtime, "planificador", lambda: main.Planificador(sheets_service, user_sheets_id))
+    await main.Notificador.register(new_runtime, "notificador", lambda: main.Notificador(calendar_service, user_sheets_id))
+    await main.Registrador.register(new_runtime, "registrador", lambda: main.Registrador(sheets_service, user_sheets_id))
+    await main.Consultor.register(new_runtime, "consultor", lambda: main.Consultor(sheets_service, user_sheets_id))
     
-    new_runtime.start()
     return new_runtime
 
 
-async def procesar_mensaje(user_input: str, user_id: str):
-    """Procesa cada mensaje con un runtime limpio usando credenciales del usuario."""
+async def procesar_mensaje(user_input: str, user_id: str, preclasificado: dict | None = None, mensaje_id: str | None = None):
+    """
+    Procesa cada mensaje con un runtime limpio usando credenciales del usuario.
+    Si viene preclasificado ({'intent', 'data'}), el Organizador no vuelve a llamar a la IA.
+    Con mensaje_id, los trabajos en segundo plano del mensaje se consultan en /api/jobs/<mensaje_id>.
+    """
     print(f"\n{'='*70}")
     print(f"🔵 INICIO procesar_mensaje")
     print(f"📝 Input: '{user_input}'")
@@ -227,12 +306,17 @@ async def procesar_mensaje(user_input: str, user_id: str):
     print(f"   Handle message: {main.Organizador.handle_message}")
     print(f"{'='*70}")
     
+    # Identifica al usuario ante el control de admisión de OpenRouter (fair queuing)
+    main.USUARIO_ACTUAL.set(user_id)
+    # Agrupa los trabajos diferidos (Calendar, réplica a Sheets) de este mensaje
+    main.MENSAJE_ACTUAL.set(mensaje_id or uuid.uuid4().hex)
+    
     user_lower = user_input.lower()
     comandos_directos = ['ayuda', 'help', 'sheets', 'calendar']
     
     if any(cmd in user_lower for cmd in comandos_directos):
         print(f"🟢 Comando directo detectado, sin runtime")
-        return generar_respuesta_contextual(user_input)
+        return generar_respuesta_contextual(user_input, get_user_sheets_id(user_id))
     
     print(f"🟡 Inicializando runtime para usuario {user_id[:8]}...")
     
@@ -251,14 +335,19 @@ async def procesar_mensaje(user_input: str, user_id: str):
         return ("❌ Error del servidor", 
                 "<strong>❌ Error del servidor</strong><br>Por favor, intenta de nuevo.")
     
-    old_stdout = sys.stdout
-    sys.stdout = buffer = io.StringIO()
+    # El runtime copia el contexto al arrancar: sus agentes escriben en el buffer de este mensaje
+    buffer = io.StringIO()
+    salida = SALIDA_MENSAJE.set(buffer)
     
     try:
+        local_runtime.start()
         print(f"🟡 Creando mensaje...")
         data_mensaje = {"user_input": user_input}
         mensaje = main.PaymentMessage.model_validate(data_mensaje)
+        if preclasificado:
+            mensaje.data['preclasificado'] = preclasificado
         
+        lecturas_antes = main.lecturas_sheets_totales()
         print(f"🟡 Enviando mensaje al organizador...")
         await local_runtime.send_message(mensaje, AgentId("organizador", "default"))
         
@@ -267,6 +356,7 @@ async def procesar_mensaje(user_input: str, user_id: str):
         
         console_output = buffer.getvalue()
         print(f"✅ Procesamiento completo. Output: {len(console_output)} chars")
+        print(f"📊 Lecturas a Google Sheets en este mensaje: {main.lecturas_sheets_totales() - lecturas_antes}")
         
         # 🔥 NUEVO: Mostrar parte del output para debugging
         if console_output:
@@ -283,7 +373,7 @@ async def procesar_mensaje(user_input: str, user_id: str):
         import traceback
         traceback.print_exc()
     finally:
-        sys.stdout = old_stdout
+        SALIDA_MENSAJE.reset(salida)
         print(f"🟡 Limpiando runtime...")
         try:
             await local_runtime.stop()
@@ -819,17 +909,26 @@ def chat():
             return jsonify({'success': False, 'message': '❌ Mensaje vacío'}), 400
 
         # 🔥 Ejecutar el procesamiento pasando user_id
-        result = asyncio.run(procesar_mensaje(user_message, user_id))
+        mensaje_id = uuid.uuid4().hex
+        result = ejecutar_async(procesar_mensaje(user_message, user_id, mensaje_id=mensaje_id))
         
         if isinstance(result, tuple) and len(result) >= 2:
             result_text, result_html = result[0], result[1]
         else:
             result_text, result_html = str(result), None
 
+        # La respuesta sale sin esperar a Calendar/Sheets: el frontend consulta /api/jobs/<job_id>
+        estado = main.estado_de_mensaje(mensaje_id, user_id, get_user_sheets_id(user_id))
+        if estado['pendientes'] and result_html:
+            result_html += '<br><small>⏳ Google Calendar y Sheets se están actualizando en segundo plano.</small>'
+
         return jsonify({
             'success': True,
             'message': result_text,
-            'html': result_html
+            'html': result_html,
+            'job_id': mensaje_id,
+            'jobs_pending': estado['pendientes'],
+            'jobs_url': f'/api/jobs/{mensaje_id}'
         })
 
     except Exception as e:
@@ -841,6 +940,78 @@ def chat():
             'message': f'❌ Error: {str(e)}'
         }), 500
 
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """
+    Clasifica muchos mensajes en pocas llamadas a la IA (importaciones / replays).
+    Con 'ejecutar': true además procesa cada mensaje con su clasificación.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return jsonify({'success': False, 'message': '❌ No estás autenticado. Por favor inicia sesión.'}), 401
+
+    token = auth_header.replace('Bearer ', '')
+    session_data = user_sessions.get(token)
+    
+    if not session_data:
+        return jsonify({'success': False, 'message': '❌ Tu sesión ha expirado. Por favor vuelve a iniciar sesión.'}), 401
+
+    user_id = session_data['user_id']
+
+    try:
+        data = request.json or {}
+        mensajes = [str(m).strip() for m in (data.get('messages') or []) if str(m).strip()]
+        if not mensajes:
+            return jsonify({'success': False, 'message': '❌ No se recibieron mensajes'}), 400
+
+        async def _clasificar():
+            main.USUARIO_ACTUAL.set(user_id)
+            return await main.clasificar_lote(mensajes)
+
+        clasificaciones = ejecutar_async(_clasificar())
+
+        resultados = []
+        for texto, clasificacion in zip(mensajes, clasificaciones):
+            item = {'message': texto, 'classification': clasificacion}
+            if data.get('ejecutar') and clasificacion:
+                mensaje_id = uuid.uuid4().hex
+                result = ejecutar_async(procesar_mensaje(texto, user_id, preclasificado=clasificacion, mensaje_id=mensaje_id))
+                item['result'] = result[0] if isinstance(result, tuple) else str(result)
+                item['job_id'] = mensaje_id
+            resultados.append(item)
+
+        return jsonify({
+            'success': True,
+            'total': len(resultados),
+            'fallidos': sum(1 for r in resultados if not r['classification']),
+            'results': resultados
+        })
+
+    except Exception as e:
+        print(f"❌ Error en chat_batch(): {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'❌ Error: {str(e)}'}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Estado de los trabajos en segundo plano (Calendar / Sheets) de un mensaje del chat."""
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return jsonify({'success': False, 'message': 'No autenticado'}), 401
+
+    token = auth_header.replace('Bearer ', '')
+    session_data = user_sessions.get(token)
+    
+    if not session_data:
+        return jsonify({'success': False, 'message': 'Sesión expirada'}), 401
+
+    user_id = session_data['user_id']
+    estado = main.estado_de_mensaje(job_id, user_id, get_user_sheets_id(user_id))
+    return jsonify({'success': True, **estado})
+
+
 @app.route('/api/user/sheets-url', methods=['GET'])
 def get_user_sheets_url():
     """Devuelve el link del Google Sheets del usuario."""
@@ -880,6 +1051,36 @@ def status():
     })
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Métricas internas de rendimiento (requiere sesión; los ledgers van agregados, sin datos por usuario)."""
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return jsonify({'success': False, 'message': 'No autenticado'}), 401
+
+    token = auth_header.replace('Bearer ', '')
+    if not user_sessions.get(token):
+        return jsonify({'success': False, 'message': 'Sesión expirada'}), 401
+
+    return jsonify({
+        'openrouter_http': main.obtener_estadisticas_http(),
+        'openrouter_stream': main.obtener_estadisticas_stream(),
+        'perfiles_llm': main.obtener_estadisticas_perfiles(),
+        'ledgers': main.obtener_estadisticas_ledgers(),
+        'ledger_local': main.obtener_estadisticas_ledger_local(),
+        'trabajos': main.obtener_estadisticas_trabajos(),
+        'espejo_calendar': main.obtener_estadisticas_espejos_calendar(),
+        'llamadas_google': main.obtener_estadisticas_google(),
+        'lecturas_sheets': main.obtener_estadisticas_lecturas(),
+        'escrituras_sheets': main.obtener_estadisticas_escrituras(),
+        'llm_cache': main.LLM_CACHE.estadisticas(),
+        'parser_rapido': main.PARSER_RAPIDO.estadisticas(),
+        'openrouter_hedge': main.obtener_estadisticas_hedge(),
+        'salud_modelos': main.SALUD_MODELOS.estado(),
+        'admision_openrouter': main.ADMISION.estadisticas()
+    })
+
+
 @app.route('/')
 def index():
     """Información de la API."""
@@ -891,7 +1092,10 @@ def index():
             'login': '/api/auth/login',
             'logout': '/api/auth/logout',
             'chat': '/api/chat',
-            'status': '/api/status'
+            'chat_batch': '/api/chat/batch',
+            'jobs': '/api/jobs/<job_id>',
+            'status': '/api/status',
+            'metrics': '/api/metrics'
         }
     })
 
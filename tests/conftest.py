@@ -0,0 +1,215 @@
+import os
+import sys
+import tempfile
+
+# main.py crea sus bases SQLite y ledgers en rutas configurables: se apuntan a un directorio temporal
+_TMP = tempfile.mkdtemp(prefix='organizador-tests-')
+os.environ.setdefault('LLM_CACHE_PATH', os.path.join(_TMP, 'llm_cache.sqlite3'))
+os.environ.setdefault('TRABAJOS_DB', os.path.join(_TMP, 'trabajos.sqlite3'))
+os.environ.setdefault('LEDGER_DB_DIR', os.path.join(_TMP, 'ledgers'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import itertools
+import re
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import main
+
+
+class _Llamada:
+    def __init__(self, resultado):
+        self._resultado = resultado
+
+    def execute(self):
+        return self._resultado() if callable(self._resultado) else self._resultado
+
+
+class HojaFalsa:
+    """Spreadsheet en memoria con la forma mínima de la API de Sheets que usa main.py."""
+
+    _RANGO = re.compile(r"^'?(?P<hoja>[^'!]+)'?!A(?P<desde>\d*):[A-Z](?P<hasta>\d*)$")
+
+    def __init__(self, deuda=None, historial=None):
+        encabezado_deuda = ['Fecha Registro', 'ID Cuota', 'Monto Total', 'Monto Pendiente',
+                            'Monto Cuota', 'Fecha Vencimiento', 'Tipo Pago', 'Estado']
+        encabezado_historial = ['Fecha', 'ID Cuota', 'Tipo', 'Monto Pagado', 'Saldo', 'Notas']
+        self.pestanas = {
+            'Deuda Pendiente': [encabezado_deuda] + [list(r) for r in (deuda or [])],
+            'Historial de Pagos': [encabezado_historial] + [list(r) for r in (historial or [])],
+        }
+        self.sheet_ids = {'Deuda Pendiente': 0, 'Historial de Pagos': 1}
+        self.lecturas = 0
+        self.metadatos = 0
+        self.escrituras = []
+        self.spreadsheets_leidos = []
+
+    # -- API --
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId=None, **kwargs):
+        self.metadatos += 1
+        return _Llamada({'sheets': [{'properties': {'title': t, 'sheetId': i}} for t, i in self.sheet_ids.items()]})
+
+    def batchGet(self, spreadsheetId=None, ranges=(), **opciones):
+        self.lecturas += 1
+        self.spreadsheets_leidos.append(spreadsheetId)
+        return _Llamada(lambda: {'valueRanges': [{'values': self._leer(r)} for r in ranges]})
+
+    def batchUpdate(self, spreadsheetId=None, body=None):
+        def aplicar():
+            self.escrituras.append(body)
+            for req in sorted(body['requests'], key=lambda r: -r.get('deleteDimension', {}).get('range', {}).get('startIndex', 0)):
+                if 'updateCells' in req:
+                    inicio = req['updateCells']['start']
+                    fila = self.pestanas[self._hoja(inicio['sheetId'])][inicio['rowIndex']]
+                    fila[inicio['columnIndex']] = next(iter(req['updateCells']['rows'][0]['values'][0]['userEnteredValue'].values()))
+                if 'deleteDimension' in req:
+                    rango = req['deleteDimension']['range']
+                    hoja = self._hoja(rango['sheetId'])
+                    del self.pestanas[hoja][rango['startIndex']:rango['endIndex']]
+            return {'replies': []}
+        return _Llamada(aplicar)
+
+    # -- apoyo --
+
+    def _hoja(self, sheet_id):
+        return next(t for t, i in self.sheet_ids.items() if i == sheet_id)
+
+    def _leer(self, rango):
+        m = self._RANGO.match(rango)
+        filas = self.pestanas[m.group('hoja')]
+        desde = int(m.group('desde') or 1)
+        hasta = int(m.group('hasta')) if m.group('hasta') else len(filas)
+        return [list(r) for r in filas[desde - 1:hasta]]
+
+
+@pytest.fixture
+def hoja_falsa():
+    return HojaFalsa
+
+
+def error_http(status: int) -> HttpError:
+    return HttpError(httplib2.Response({'status': status}), b'{}', uri='https://www.googleapis.com/calendar/v3')
+
+
+class _Lote:
+    def __init__(self, calendar, callback):
+        self._calendar = calendar
+        self._callback = callback
+        self._peticiones = []
+
+    def add(self, peticion, request_id=None):
+        self._peticiones.append((request_id, peticion))
+
+    def execute(self):
+        self._calendar.lotes.append(len(self._peticiones))
+        for request_id, peticion in self._peticiones:
+            try:
+                respuesta, error = peticion.execute(), None
+            except HttpError as e:
+                respuesta, error = None, e
+            self._callback(request_id, respuesta, error)
+
+
+class CalendarFalso:
+    """Calendar en memoria: IDs fijos (409 al repetir), borrado lógico, syncToken y lotes."""
+
+    def __init__(self):
+        self.eventos = {}       # id -> evento (los borrados quedan con status 'cancelled')
+        self.cambios = {}       # id -> número de cambio, para los syncToken
+        self.peticiones = []    # (método, id) de cada petición ejecutada
+        self.lotes = []         # tamaño de cada BatchHttpRequest
+        self.tam_pagina = 2500
+        self.token_vencido = False
+        self.fallas = {}        # id -> estado HTTP con que falla cualquier petición sobre ese evento
+        self._secuencia = itertools.count(1)
+        self._ids = itertools.count(1)
+
+    # -- API --
+
+    def events(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return _Lote(self, callback)
+
+    def insert(self, calendarId=None, body=None):
+        def insertar():
+            evento_id = body.get('id') or f'sinid{next(self._ids)}'
+            if evento_id in self.eventos:
+                raise error_http(409)
+            return self._guardar(evento_id, {'status': 'confirmed', **body, 'id': evento_id})
+        return self._peticion('insert', body.get('id'), insertar)
+
+    def update(self, calendarId=None, eventId=None, body=None):
+        return self._peticion('update', eventId, lambda: self._guardar(eventId, {**self._existente(eventId), **body, 'id': eventId}))
+
+    def patch(self, calendarId=None, eventId=None, body=None):
+        return self._peticion('patch', eventId, lambda: self._guardar(eventId, {**self._existente(eventId), **body}))
+
+    def delete(self, calendarId=None, eventId=None):
+        def borrar():
+            if self._existente(eventId)['status'] == 'cancelled':
+                raise error_http(410)
+            self._guardar(eventId, {**self.eventos[eventId], 'status': 'cancelled'})
+            return ''
+        return self._peticion('delete', eventId, borrar)
+
+    def get(self, calendarId=None, eventId=None, **kwargs):
+        return self._peticion('get', eventId, lambda: dict(self._existente(eventId)))
+
+    def list(self, calendarId=None, syncToken=None, pageToken=None, **kwargs):
+        def listar():
+            if syncToken is not None and self.token_vencido:
+                self.token_vencido = False
+                raise error_http(410)
+            desde = int(syncToken or 0)
+            ids = sorted((i for i, n in self.cambios.items() if n > desde), key=self.cambios.get)
+            inicio = int(pageToken or 0)
+            pagina = ids[inicio:inicio + self.tam_pagina]
+            resultado = {'items': [dict(self.eventos[i]) for i in pagina]}
+            if inicio + self.tam_pagina < len(ids):
+                resultado['nextPageToken'] = str(inicio + self.tam_pagina)
+            else:
+                resultado['nextSyncToken'] = str(max(self.cambios.values(), default=0))
+            return resultado
+        return self._peticion('list', syncToken, listar)
+
+    # -- apoyo --
+
+    def vigentes(self) -> dict:
+        return {i: e for i, e in self.eventos.items() if e['status'] != 'cancelled'}
+
+    def _peticion(self, metodo, evento_id, fn):
+        def ejecutar():
+            self.peticiones.append((metodo, evento_id))
+            if evento_id in self.fallas:
+                raise error_http(self.fallas[evento_id])
+            return fn()
+        return _Llamada(ejecutar)
+
+    def _existente(self, evento_id):
+        if evento_id not in self.eventos:
+            raise error_http(404)
+        return self.eventos[evento_id]
+
+    def _guardar(self, evento_id, evento):
+        self.eventos[evento_id] = evento
+        self.cambios[evento_id] = next(self._secuencia)
+        return dict(evento)
+
+
+@pytest.fixture
+def calendar_falso(monkeypatch):
+    """CalendarFalso con los espejos de Calendar vacíos (son globales por Spreadsheet)."""
+    monkeypatch.setattr(main, '_ESPEJOS_CALENDAR', {})
+    return CalendarFalso()
@@ -0,0 +1,125 @@
+import pytest
+
+import main
+
+SPREADSHEET_ID = 'hoja-prueba'
+
+
+def _op(tipo, cuota_id, monto=100000.0, fecha='2025-03-01'):
+    return {"tipo": tipo, "cuota_id": cuota_id, "monto": monto, "fecha": fecha}
+
+
+def _id(cuota_id):
+    return main.CalendarRecordatorios.evento_id(SPREADSHEET_ID, cuota_id)
+
+
+@pytest.fixture
+def recordatorios(calendar_falso):
+    return main.CalendarRecordatorios(calendar_falso)
+
+
+def _legado(calendar, cuota_id, fecha='2025-03-01'):
+    """Recordatorio creado antes de los IDs fijos: ID aleatorio y la cuota solo en la descripción."""
+    return calendar.insert(body={
+        'summary': f'💰 PAGO PENDIENTE - {cuota_id}', 'description': f'[ID: {cuota_id}] Pago de cuota',
+        'start': {'date': fecha}, 'end': {'date': fecha},
+    }).execute()['id']
+
+
+@pytest.mark.parametrize('monto', [40000.0, 0.0])
+def test_post_abono_quita_los_recordatorios_legados(recordatorios, calendar_falso, monto):
+    legado = _legado(calendar_falso, 'L1-1')
+
+    resultado = recordatorios.ejecutar_lote([_op('post_abono', 'L1-1', monto)], SPREADSHEET_ID)
+
+    assert resultado[0]["eliminados"] == 1 and resultado[0]["error"] is None
+    assert calendar_falso.eventos[legado]['status'] == 'cancelled'
+    if monto:
+        assert resultado[0]["accion"] == "creado"
+        assert list(calendar_falso.vigentes()) == [_id('L1-1')]
+    else:
+        assert resultado[0]["accion"] == "eliminado"
+        assert calendar_falso.vigentes() == {}
+    # El espejo encontró el legado por su descripción: no hubo búsquedas por rango de fechas
+    assert [m for m, _ in calendar_falso.peticiones if m == 'list'] == ['list']
+
+
+def test_id_fijo_se_actualiza_sin_buscar(recordatorios, calendar_falso):
+    recordatorios.ejecutar_lote([_op('planificar', 'F1-1')], SPREADSHEET_ID)
+    recordatorios.ejecutar_lote([_op('post_abono', 'F1-1', 30000.0)], SPREADSHEET_ID)
+
+    assert list(calendar_falso.vigentes()) == [_id('F1-1')]
+    assert ('patch', _id('F1-1')) in calendar_falso.peticiones
+    assert '30,000' in calendar_falso.eventos[_id('F1-1')]['summary']
+
+
+def test_mas_de_50_operaciones_van_en_varios_lotes(recordatorios, calendar_falso):
+    operaciones = [_op('planificar', f'F{n}-1') for n in range(120)]
+
+    resultado = recordatorios.ejecutar_lote(operaciones, SPREADSHEET_ID)
+
+    assert calendar_falso.lotes == [50, 50, 20]
+    assert [r["accion"] for r in resultado] == ["creado"] * 120
+    assert len(calendar_falso.vigentes()) == 120
+
+
+def test_error_de_un_item_lanza_lote_fallido_con_el_detalle(recordatorios, calendar_falso):
+    operaciones = [_op('planificar', f'F{n}-1') for n in range(3)]
+    calendar_falso.fallas[_id('F1-1')] = 503
+
+    with pytest.raises(main.LoteCalendarFallido) as excinfo:
+        recordatorios.ejecutar_lote(operaciones, SPREADSHEET_ID)
+
+    detalle = excinfo.value.resultado
+    assert [(r["cuota_id"], r["accion"], bool(r["error"])) for r in detalle] == [
+        ('F0-1', 'creado', False), ('F1-1', None, True), ('F2-1', 'creado', False)]
+
+    # Reintento (lo que hace la cola): las ya creadas no se duplican y la que faltaba se crea
+    del calendar_falso.fallas[_id('F1-1')]
+    reintento = recordatorios.ejecutar_lote(operaciones, SPREADSHEET_ID)
+    assert [r["accion"] for r in reintento] == ['existente', 'creado', 'existente']
+    assert len(calendar_falso.vigentes()) == 3
+
+
+def _espejo(calendar):
+    return main.obtener_espejo_calendar(SPREADSHEET_ID).sincronizar(calendar, forzar=True)
+
+
+def test_sincronizacion_incremental_trae_los_borrados_a_mano(recordatorios, calendar_falso):
+    recordatorios.ejecutar_lote([_op('planificar', 'F1-1'), _op('planificar', 'F2-1')], SPREADSHEET_ID)
+    calendar_falso.delete(eventId=_id('F1-1')).execute()  # el usuario lo borra en Calendar
+
+    espejo = _espejo(calendar_falso)
+    assert (espejo.stats["completas"], espejo.stats["incrementales"]) == (1, 1)
+    assert espejo.evento(_id('F1-1'))["estado"] == 'cancelled'
+
+    # Un abono sobre el borrado a mano no lo revive ni hace peticiones
+    antes = len(calendar_falso.peticiones)
+    resultado = recordatorios.ejecutar_lote([_op('post_abono', 'F1-1', 50000.0)], SPREADSHEET_ID)
+    assert resultado[0]["accion"] == "omitido"
+    assert len(calendar_falso.peticiones) == antes
+
+
+def test_token_vencido_vuelve_a_listar_todo(recordatorios, calendar_falso):
+    recordatorios.ejecutar_lote([_op('planificar', 'F1-1')], SPREADSHEET_ID)
+    legado = _legado(calendar_falso, 'F2-1')
+    calendar_falso.token_vencido = True
+
+    espejo = _espejo(calendar_falso)
+
+    assert espejo.stats["tokens_vencidos"] == 1
+    assert espejo.stats["completas"] == 2
+    assert espejo.legados('F2-1', _id('F2-1')) == [legado]
+    assert espejo.evento(_id('F1-1'))["estado"] == 'confirmed'
+    assert [m for m, token in calendar_falso.peticiones if m == 'list'] == ['list'] * 3
+
+
+def test_listado_completo_recorre_todas_las_paginas(calendar_falso):
+    calendar_falso.tam_pagina = 2
+    legados = {_legado(calendar_falso, f'F{n}-1'): f'F{n}-1' for n in range(5)}
+
+    espejo = _espejo(calendar_falso)
+
+    assert [m for m, _ in calendar_falso.peticiones if m == 'list'] == ['list'] * 3
+    assert {l: c for c in legados.values() for l in espejo.legados(c, None)} == legados
+    assert espejo.estadisticas()["con_token"]
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+
+LIBRES = ["me llegó el recibo del agua, son 80 mil y hay que pagarlo en dos semanas",
+          "ya le abonamos 20 mil a la del gas",
+          "quiero saber qué tengo pendiente este mes"]
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Sustituye call_openrouter: lotes y llamadas individuales responden según `respuestas`."""
+    llamadas = []
+    respuestas = {"lote": None, "individual": '{"intent": "CONSULTA_DEUDAS"}'}
+
+    async def falso(system_prompt, user_prompt, **kwargs):
+        tipo = "lote" if system_prompt == main._build_batch_prompt() else "individual"
+        llamadas.append((tipo, user_prompt, kwargs, main.PRIORIDAD_ACTUAL.get()))
+        respuesta = respuestas[tipo]
+        return respuesta(user_prompt) if callable(respuesta) else respuesta
+
+    monkeypatch.setattr(main, 'call_openrouter', falso)
+    return respuestas, llamadas
+
+
+def test_armar_lotes_respeta_maximo_y_presupuesto():
+    base = main._estimar_tokens(main._build_batch_prompt())
+    assert main._armar_lotes(['x'] * 5, base + 1000, 2) == [[0, 1], [2, 3], [4]]
+    # Cada texto largo llena el presupuesto por sí solo, pero nunca queda un lote vacío
+    largos = ['y' * 400] * 3
+    assert main._armar_lotes(largos, base + 120, 20) == [[0], [1], [2]]
+    assert main._armar_lotes([], base + 1000, 20) == []
+
+
+def test_lote_resuelve_con_una_llamada_y_salta_el_parser(llm):
+    respuestas, llamadas = llm
+    respuestas["lote"] = lambda prompt: json.dumps([
+        {"id": item["id"], "intent": "CONSULTA_DEUDAS"} for item in json.loads(prompt)
+    ])
+    textos = ["ver factura A1"] + LIBRES
+
+    resultados = asyncio.run(main.clasificar_lote(textos))
+    assert [r["origen"] for r in resultados] == ['parser', 'lote', 'lote', 'lote']
+    assert [tipo for tipo, *_ in llamadas] == ['lote']
+    assert [item["id"] for item in json.loads(llamadas[0][1])] == [1, 2, 3]
+    assert llamadas[0][3] == main.PRIORIDAD_LOTE
+    assert main.PRIORIDAD_ACTUAL.get() != main.PRIORIDAD_LOTE
+
+
+def test_items_mal_formados_se_reintentan_individualmente(llm):
+    respuestas, llamadas = llm
+    respuestas["lote"] = json.dumps([
+        {"id": 0, "intent": "PLANIFICAR", "numero_factura": "AGUA", "monto_total": 80000},
+        {"id": 1, "intent": "NO_SE"},
+    ])
+
+    resultados = asyncio.run(main.clasificar_lote(LIBRES))
+    assert resultados[0] == {"intent": "PLANIFICAR", "origen": "lote",
+                             "data": {"numero_factura": "AGUA", "monto_total": 80000}}
+    assert [r["origen"] for r in resultados[1:]] == ['individual', 'individual']
+    assert [u for tipo, u, *_ in llamadas if tipo == 'individual'] == LIBRES[1:]
+
+    # Un lote incompleto no pasa el validador de caché
+    validar = llamadas[0][2]["validar"]
+    assert not validar(respuestas["lote"])
+
+
+def test_lote_con_error_cae_a_llamadas_individuales(llm):
+    respuestas, llamadas = llm
+    respuestas["lote"] = "ERROR: sobrecargado"
+    respuestas["individual"] = "ERROR: sobrecargado"
+
+    assert asyncio.run(main.clasificar_lote(LIBRES[:2])) == [None, None]
+    assert [tipo for tipo, *_ in llamadas] == ['lote', 'individual', 'individual']
+
+
+def test_interpretar_lote_ignora_ids_ajenos_y_repetidos():
+    respuesta = json.dumps([
+        {"id": 5, "intent": "CONSULTA_DEUDAS"},
+        {"id": 5, "intent": "ESTADISTICAS"},
+        {"id": 99, "intent": "CONSULTA_DEUDAS"},
+        {"id": "x", "intent": "CONSULTA_DEUDAS"},
+    ])
+    assert main._interpretar_lote(respuesta, [5, 6]) == {5: ("CONSULTA_DEUDAS", {})}
+    assert main._interpretar_lote("no es json", [5]) == {}
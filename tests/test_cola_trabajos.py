@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def ejecutados(monkeypatch):
+    registro = []
+
+    def manejador(servicio, datos):
+        registro.append(datos["n"])
+        if datos.get("fallar"):
+            raise RuntimeError("fallo transitorio")
+        return {"n": datos["n"]}
+
+    monkeypatch.setitem(main.MANEJADORES_TRABAJOS, 'prueba_tarea', manejador)
+    return registro
+
+
+@pytest.fixture
+def cola(tmp_path):
+    """Cola sin hilos: los tests avanzan a mano con _tomar/_ejecutar."""
+    cola = main.ColaTrabajos(str(tmp_path / 'trabajos.sqlite3'), workers=1)
+    cola.detener(timeout=5)
+    return cola
+
+
+def _procesar(cola) -> int:
+    procesados = 0
+    while (tomado := cola._tomar()) is not None:
+        cola._ejecutar(*tomado)
+        procesados += 1
+    return procesados
+
+
+def _estado(cola, trabajo_id):
+    return cola._db.execute("SELECT estado, intentos FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+
+
+def test_clave_repetida_devuelve_el_mismo_trabajo(cola, ejecutados):
+    primero = cola.encolar('prueba_tarea', {"n": 1}, 'k', 'ana')
+    segundo = cola.encolar('prueba_tarea', {"n": 1}, 'k', 'ana')
+    assert primero == segundo
+    assert cola.stats["duplicados"] == 1
+    cola.registrar_servicio('ana', 'prueba', object())
+    assert _procesar(cola) == 1
+    assert ejecutados == [1]
+
+
+def test_trabajos_de_un_grupo_salen_en_orden(cola, ejecutados):
+    cola.registrar_servicio('ana', 'prueba', object())
+    for n in range(3):
+        cola.encolar('prueba_tarea', {"n": n}, f'k{n}', 'ana', grupo='ana:F1')
+
+    tomado = cola._tomar()
+    # Mientras el primero está en curso, los demás del grupo esperan
+    assert cola._tomar() is None
+    cola._ejecutar(*tomado)
+    _procesar(cola)
+    assert ejecutados == [0, 1, 2]
+
+
+def test_grupos_distintos_no_se_bloquean(cola, ejecutados):
+    cola.registrar_servicio('ana', 'prueba', object())
+    cola.encolar('prueba_tarea', {"n": 1}, 'a', 'ana', grupo='ana:F1')
+    cola.encolar('prueba_tarea', {"n": 2}, 'b', 'ana', grupo='ana:F2')
+    assert cola._tomar() is not None
+    assert cola._tomar() is not None
+
+
+def test_fallo_reintenta_con_backoff_y_luego_es_definitivo(cola, ejecutados, monkeypatch):
+    monkeypatch.setattr(main, 'TRABAJOS_MAX_INTENTOS', 2)
+    monkeypatch.setattr(main, 'TRABAJOS_BACKOFF_BASE', 0)
+    cola.registrar_servicio('ana', 'prueba', object())
+    trabajo_id = cola.encolar('prueba_tarea', {"n": 1, "fallar": True}, 'k', 'ana')
+
+    cola._ejecutar(*cola._tomar())
+    assert _estado(cola, trabajo_id) == ('pendiente', 1)
+    assert cola.stats["reintentos"] == 1
+
+    cola._ejecutar(*cola._tomar())
+    assert _estado(cola, trabajo_id) == ('error', 2)
+    assert cola.stats["fallidos"] == 1
+    assert cola._tomar() is None
+
+
+def test_backoff_retrasa_el_reintento(cola, ejecutados, monkeypatch):
+    monkeypatch.setattr(main, 'TRABAJOS_BACKOFF_BASE', 60)
+    cola.registrar_servicio('ana', 'prueba', object())
+    cola.encolar('prueba_tarea', {"n": 1, "fallar": True}, 'k', 'ana')
+    cola._ejecutar(*cola._tomar())
+    assert cola._tomar() is None
+
+
+def test_trabajos_sin_servicio_no_tapan_a_otros_usuarios(cola, ejecutados):
+    # Tras un reinicio: muchos trabajos de usuarios que todavía no escribieron
+    for n in range(30):
+        cola.encolar('prueba_tarea', {"n": n}, f'viejo{n}', f'ausente{n}')
+    cola.encolar('prueba_tarea', {"n": 99}, 'nuevo', 'ana')
+    cola.registrar_servicio('ana', 'prueba', object())
+
+    assert _procesar(cola) == 1
+    assert ejecutados == [99]
+
+
+def test_trabajos_sin_servicio_expiran(cola, ejecutados, monkeypatch):
+    monkeypatch.setattr(main, 'TRABAJOS_SIN_SERVICIO_TTL', 0)
+    huerfano = cola.encolar('prueba_tarea', {"n": 1}, 'h', 'ausente')
+    propio = cola.encolar('prueba_tarea', {"n": 2}, 'p', 'ana')
+    cola.registrar_servicio('ana', 'prueba', object())
+    time.sleep(0.01)
+    cola._ultima_expiracion = 0.0  # la expiración corre como mucho una vez por minuto
+
+    _procesar(cola)
+    assert _estado(cola, huerfano)[0] == 'error'
+    assert _estado(cola, propio)[0] == 'completado'
+    assert cola.stats["expirados"] == 1
+
+
+def test_reinicio_devuelve_en_curso_a_pendiente(tmp_path, ejecutados):
+    path = str(tmp_path / 'trabajos.sqlite3')
+    cola = main.ColaTrabajos(path, workers=1)
+    cola.detener(timeout=5)
+    trabajo_id = cola.encolar('prueba_tarea', {"n": 1}, 'k', 'ana')
+    cola.registrar_servicio('ana', 'prueba', object())
+    cola._tomar()
+    assert _estado(cola, trabajo_id)[0] == 'en_curso'
+
+    reiniciada = main.ColaTrabajos(path, workers=1)
+    reiniciada.detener(timeout=5)
+    assert _estado(reiniciada, trabajo_id)[0] == 'pendiente'
+
+
+def test_hilos_ejecutan_los_trabajos(tmp_path, ejecutados):
+    cola = main.ColaTrabajos(str(tmp_path / 'trabajos.sqlite3'), workers=2)
+    try:
+        cola.registrar_servicio('ana', 'prueba', object())
+        ids = [cola.encolar('prueba_tarea', {"n": n}, f'k{n}', 'ana', grupo='ana:F1') for n in range(5)]
+        limite = time.monotonic() + 5
+        while time.monotonic() < limite and any(_estado(cola, i)[0] != 'completado' for i in ids):
+            time.sleep(0.02)
+        assert ejecutados == [0, 1, 2, 3, 4]
+    finally:
+        cola.detener(timeout=5)
+
+
+class _ServicioConCredenciales:
+    def __init__(self, refresh_token='r1'):
+        self._http = type('Http', (), {})()
+        self._http.credentials = type('Creds', (), {'client_id': 'c', 'refresh_token': refresh_token})()
+
+
+def test_cada_worker_usa_su_propio_cliente(cola, monkeypatch):
+    construidos = []
+    monkeypatch.setattr(main, 'build', lambda *a, **kw: construidos.append(object()) or construidos[-1])
+    cola.registrar_servicio('ana', 'calendar', _ServicioConCredenciales())
+
+    clientes = {}
+    hilos = [threading.Thread(target=lambda n=n: clientes.__setitem__(n, cola._cliente('ana', 'calendar')))
+             for n in range(2)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert clientes[0] is not clientes[1]
+    assert clientes[0].calendar_service is not clientes[1].calendar_service
+
+    # Servicio nuevo por mensaje, mismas credenciales: el hilo reutiliza su cliente
+    propio = cola._cliente('ana', 'calendar')
+    cola.registrar_servicio('ana', 'calendar', _ServicioConCredenciales())
+    assert cola._cliente('ana', 'calendar') is propio
+    cola.registrar_servicio('ana', 'calendar', _ServicioConCredenciales(refresh_token='r2'))
+    assert cola._cliente('ana', 'calendar') is not propio
+    assert len(construidos) == 4
+
+
+def test_clientes_por_hilo_tiene_tope():
+    clientes = main.ClientesPorHilo(maximo=2)
+    servicio = object()
+    primero = clientes.obtener(('ana', 'sheets'), servicio, lambda s: object())
+    clientes.obtener(('beto', 'sheets'), servicio, lambda s: object())
+    clientes.obtener(('caro', 'sheets'), servicio, lambda s: object())
+    assert len(clientes._hilo.clientes) == 2
+    assert clientes.obtener(('ana', 'sheets'), servicio, lambda s: object()) is not primero
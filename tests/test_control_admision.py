@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+def _orden_de_admision(admision, peticiones):
+    """Lanza todas las peticiones juntas; devuelve en qué orden fueron admitidas."""
+    orden = []
+
+    async def pedir(etiqueta, usuario, prioridad):
+        await admision.adquirir(usuario, prioridad)
+        orden.append(etiqueta)
+
+    async def correr():
+        await asyncio.gather(*(pedir(*p) for p in peticiones))
+
+    asyncio.run(correr())
+    return orden
+
+
+def test_interactivas_antes_que_lotes():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=100)
+    orden = _orden_de_admision(admision, [
+        ('lote1', 'ana', main.PRIORIDAD_LOTE),
+        ('lote2', 'ana', main.PRIORIDAD_LOTE),
+        ('chat', 'beto', main.PRIORIDAD_INTERACTIVA),
+    ])
+    assert orden == ['chat', 'lote1', 'lote2']
+
+
+def test_rondas_por_usuario_dentro_de_una_prioridad():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=100)
+    orden = _orden_de_admision(admision, [
+        ('a1', 'ana', 0), ('a2', 'ana', 0), ('a3', 'ana', 0),
+        ('b1', 'beto', 0), ('b2', 'beto', 0),
+    ])
+    assert orden == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+
+def test_usuario_nuevo_no_se_salta_las_rondas_ya_servidas():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=100)
+    _orden_de_admision(admision, [('a1', 'ana', 0), ('a2', 'ana', 0), ('a3', 'ana', 0)])
+    # beto llega después: entra en la ronda actual, no en la 0 (ya despachada)
+    orden = _orden_de_admision(admision, [('a4', 'ana', 0), ('b1', 'beto', 0)])
+    assert orden == ['b1', 'a4']
+
+
+def test_cola_llena_rechaza_sin_encolar():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=2)
+
+    async def correr():
+        admision.pausar(60)
+        esperando = [asyncio.ensure_future(admision.adquirir('ana', 0)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(main.ColaLlenaError):
+            await admision.adquirir('beto', 0)
+        for tarea in esperando:
+            tarea.cancel()
+        await asyncio.gather(*esperando, return_exceptions=True)
+        admision._despachador.cancel()
+
+    asyncio.run(correr())
+    assert admision.stats["rechazadas"] == 1
+    assert admision.stats["profundidad_max"] == 2
+
+
+def test_token_bucket_limita_la_tasa():
+    admision = main.ControlAdmision(tasa=50, rafaga=1, cola_max=100)
+    inicio = time.monotonic()
+    _orden_de_admision(admision, [(n, 'ana', 0) for n in range(3)])
+    # La ráfaga cubre la primera; las otras dos esperan 1/50 s cada una
+    assert time.monotonic() - inicio >= 0.035
+    assert admision.stats["admitidas"] == 3
+
+
+def test_cancelado_no_consume_token():
+    admision = main.ControlAdmision(tasa=0.001, rafaga=1, cola_max=100)
+
+    async def correr():
+        admision.pausar(0.02)
+        cancelada = asyncio.ensure_future(admision.adquirir('ana', 0))
+        viva = asyncio.ensure_future(admision.adquirir('beto', 0))
+        await asyncio.sleep(0)
+        cancelada.cancel()
+        await asyncio.wait_for(viva, timeout=1)
+
+    asyncio.run(correr())
+    assert admision.stats["admitidas"] == 1
+
+
+def test_otro_event_loop_tiene_su_propio_despachador():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=100)
+    anterior = asyncio.new_event_loop()
+    try:
+        # Un loop que queda vivo con su despachador esperando la pausa
+        admision.pausar(0.05)
+        anterior.create_task(admision.adquirir('ana', 0))
+        anterior.run_until_complete(asyncio.sleep(0.01))
+        assert not admision._despachador.done()
+
+        async def correr():
+            await asyncio.wait_for(admision.adquirir('beto', 0), timeout=2)
+
+        for _ in range(3):
+            asyncio.run(correr())
+        assert admision.stats["admitidas"] == 3
+    finally:
+        tareas = asyncio.all_tasks(anterior)
+        for tarea in tareas:
+            tarea.cancel()
+        anterior.run_until_complete(asyncio.gather(*tareas, return_exceptions=True))
+        anterior.close()
+
+
+def test_usuarios_inactivos_se_olvidan():
+    admision = main.ControlAdmision(tasa=1000, rafaga=100, cola_max=100)
+    _orden_de_admision(admision, [(u, u, 0) for u in ('ana', 'beto', 'carla')])
+    assert admision.estadisticas()["usuarios_con_ronda"] == 3
+
+    # Como si hubieran pasado ADMISION_OLVIDO s sin que pidieran nada
+    atraso = main.ADMISION_OLVIDO + 61
+    admision._ronda_usuario = {u: (ronda, visto - atraso) for u, (ronda, visto) in admision._ronda_usuario.items()}
+    admision._ultima_poda -= atraso
+    _orden_de_admision(admision, [('d1', 'dani', 0)])
+    assert list(admision._ronda_usuario) == ['dani']
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import uuid
+from typing import Optional
+
+import pytest
+from autogen_core import AgentId, MessageContext, RoutedAgent, SingleThreadedAgentRuntime, message_handler
+
+import main
+
+
+class RegistradorFalso(RoutedAgent):
+    """Responde al PLANNED como lo haría el Registrador real (REGISTERED, ERROR o None)."""
+
+    def __init__(self, responder) -> None:
+        super().__init__("Registrador de prueba.")
+        self.responder = responder
+
+    @message_handler
+    async def handle_message(self, message: main.PaymentMessage, ctx: MessageContext) -> Optional[main.PaymentMessage]:
+        return self.responder(message)
+
+
+@pytest.fixture
+def cola(tmp_path, monkeypatch):
+    """Cola diferida sin hilos: el test decide cuándo corre cada trabajo."""
+    cola = main.ColaTrabajos(str(tmp_path / 'trabajos.sqlite3'), workers=1)
+    cola.detener(timeout=5)
+    monkeypatch.setattr(main, 'TRABAJOS_DIFERIDOS', True)
+    monkeypatch.setattr(main, '_COLA_TRABAJOS', cola)
+    return cola
+
+
+SPREADSHEET_ID = 'hoja-prueba'
+
+
+def _planificado(factura_id: str, fecha: str = '2025-03-01', monto: float = 100000.0) -> main.PaymentMessage:
+    return main.PaymentMessage(
+        user_input=f"factura {factura_id} por {monto:.0f}",
+        intent="PLANIFICAR",
+        status="PLANNED",
+        data={"numero_factura": factura_id, "monto_total": monto, "monto_fraccionado": monto,
+              "fracciones": 1, "fechas_pago": [fecha]},
+    )
+
+
+def _despachar(mensaje, responder, calendar) -> main.PaymentMessage:
+    """Organizador + Notificador reales y un Registrador de prueba, como arma el runtime server.py."""
+    async def correr():
+        main.USUARIO_ACTUAL.set('ana')
+        main.MENSAJE_ACTUAL.set(uuid.uuid4().hex)
+        runtime = SingleThreadedAgentRuntime()
+        await main.Organizador.register(runtime, "organizador", main.Organizador)
+        await main.Notificador.register(runtime, "notificador", lambda: main.Notificador(calendar, SPREADSHEET_ID))
+        await RegistradorFalso.register(runtime, "registrador", lambda: RegistradorFalso(responder))
+        runtime.start()
+        try:
+            return await runtime.send_message(mensaje, AgentId("organizador", "default"))
+        finally:
+            await runtime.stop_when_idle()
+
+    return asyncio.run(correr())
+
+
+def _procesar(cola) -> None:
+    while (tomado := cola._tomar()) is not None:
+        cola._ejecutar(*tomado)
+
+
+def _evento(calendar, cuota_id):
+    return calendar.eventos.get(main.CalendarRecordatorios.evento_id(SPREADSHEET_ID, cuota_id))
+
+
+def _fallar(message):
+    return message.model_copy(update={"status": "ERROR"})
+
+
+def _explotar(message):
+    raise RuntimeError("Sheets caído")
+
+
+@pytest.mark.parametrize('paralelo', [True, False])
+@pytest.mark.parametrize('responder', [_fallar, _explotar])
+def test_registro_fallido_no_deja_recordatorio(cola, calendar_falso, monkeypatch, paralelo, responder):
+    monkeypatch.setattr(main, 'FANOUT_PARALELO', paralelo)
+
+    respuesta = _despachar(_planificado('F1'), responder, calendar_falso)
+    assert respuesta.status == "ERROR"
+
+    trabajos = cola._db.execute("SELECT grupo FROM trabajos ORDER BY creado").fetchall()
+    assert trabajos == [('ana:F1',), ('ana:F1',)]
+
+    # El planificar sale primero y, mientras está en curso, la reversión espera su turno
+    tomado = cola._tomar()
+    assert tomado[2]["operaciones"][0]["tipo"] == 'planificar'
+    assert cola._tomar() is None
+    cola._ejecutar(*tomado)
+    assert _evento(calendar_falso, 'F1-1')['status'] == 'confirmed'
+
+    cola._ejecutar(*cola._tomar())
+    assert cola._tomar() is None
+    assert calendar_falso.vigentes() == {}
+
+
+def test_registro_exitoso_deja_el_recordatorio(cola, calendar_falso):
+    respuesta = _despachar(_planificado('F2'), lambda m: m.model_copy(update={"status": "REGISTERED"}), calendar_falso)
+    assert respuesta.status == "PLANNED"
+    _procesar(cola)
+    assert _evento(calendar_falso, 'F2-1')['start'] == {'date': '2025-03-01'}
+    assert len(calendar_falso.vigentes()) == 1
+
+
+@pytest.mark.parametrize('espejo', [True, False])
+def test_factura_existente_no_revierte_ni_pisa_su_recordatorio(cola, calendar_falso, monkeypatch, espejo):
+    monkeypatch.setattr(main, 'CALENDAR_ESPEJO', espejo)
+    registrada = lambda m: m.model_copy(update={"status": "REGISTERED"})
+    _despachar(_planificado('F3'), registrada, calendar_falso)
+    _procesar(cola)
+    original = dict(_evento(calendar_falso, 'F3-1'))
+
+    # Se repite "factura F3" con otros datos: el Registrador la rechaza (None) y no hay reversión...
+    respuesta = _despachar(_planificado('F3', fecha='2025-04-15', monto=250000.0), lambda m: None, calendar_falso)
+    assert respuesta.status == "PLANNED"
+    tipos = [op["tipo"] for (datos,) in cola._db.execute("SELECT datos FROM trabajos WHERE estado = 'pendiente'")
+             for op in json.loads(datos)["operaciones"]]
+    assert tipos == ['planificar']
+
+    # ...y el planificar que ya salió hacia Calendar deja el recordatorio como estaba, igual que Sheets
+    _procesar(cola)
+    assert _evento(calendar_falso, 'F3-1') == original
+    assert not any(metodo in ('update', 'patch') for metodo, _ in calendar_falso.peticiones)
+
+
+@pytest.mark.parametrize('espejo', [True, False])
+def test_factura_revertida_se_puede_volver_a_planificar(cola, calendar_falso, monkeypatch, espejo):
+    monkeypatch.setattr(main, 'CALENDAR_ESPEJO', espejo)
+    _despachar(_planificado('F4'), _fallar, calendar_falso)
+    _procesar(cola)
+    assert _evento(calendar_falso, 'F4-1')['status'] == 'cancelled'
+
+    _despachar(_planificado('F4', fecha='2025-05-01'), lambda m: m.model_copy(update={"status": "REGISTERED"}), calendar_falso)
+    _procesar(cola)
+    evento = _evento(calendar_falso, 'F4-1')
+    assert (evento['status'], evento['start']) == ('confirmed', {'date': '2025-05-01'})
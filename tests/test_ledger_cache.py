@@ -0,0 +1,110 @@
+import time
+import uuid
+
+import pytest
+
+import main
+
+
+def _cuota(cuota_id, pendiente=100000, estado='PENDIENTE'):
+    return ['2025-01-01', cuota_id, 300000, pendiente, 100000, '2025-02-01', 'Cuota', estado]
+
+
+@pytest.fixture
+def cargar(hoja_falsa):
+    """LedgerCache recién cargado desde una HojaFalsa con las filas dadas (la fila 1 es el encabezado)."""
+    def _cargar(*filas):
+        hoja = hoja_falsa(deuda=list(filas))
+        ledger = main.LedgerCache(f'hoja-{uuid.uuid4().hex[:8]}')
+        ledger.asegurar(hoja)
+        return ledger, hoja
+    return _cargar
+
+
+def test_indice_apunta_a_la_fila_y_omite_lapidas(cargar):
+    ledger, _ = cargar(_cuota('A-1'), _cuota('A-2'), _cuota('B-1', estado=main.ESTADO_LAPIDA), _cuota('B-2'))
+    assert [ledger.fila_de(c) for c in ('A-1', 'A-2', 'B-1', 'B-2')] == [2, 3, None, 5]
+    assert ledger.buscar_cuota('A').cuota_id == 'A-1'
+    assert [c.cuota_id for c in ledger.cuotas_de_factura('B')] == ['B-2']
+    assert ledger.lapidas() == [4]
+
+
+def test_marcar_pagada_la_saca_del_indice(cargar):
+    ledger, _ = cargar(_cuota('A-1'), _cuota('A-2'))
+    ledger.actualizar_estado(2, main.ESTADO_LAPIDA)
+
+    assert ledger.fila_de('A-1') is None
+    assert ledger.buscar_cuota('A').cuota_id == 'A-2'
+    assert [c.cuota_id for c in ledger.cuotas_de_factura('A')] == ['A-2']
+    assert ledger.lapidas() == [2]
+    assert ledger.estadisticas()["cuotas_indexadas"] == 1
+
+
+def test_id_repetido_pasa_a_la_siguiente_fila(cargar):
+    ledger, _ = cargar(_cuota('A-1', 50000), _cuota('A-1', 70000))
+    assert ledger.fila_de('A-1') == 2
+    ledger.actualizar_estado(2, main.ESTADO_LAPIDA)
+    assert ledger.fila_de('A-1') == 3
+
+
+def test_eliminar_fila_corre_las_de_abajo(cargar):
+    ledger, _ = cargar(_cuota('A-1'), _cuota('A-2'), _cuota('B-1'))
+    ledger.eliminar_fila(3)
+    assert (ledger.fila_de('A-1'), ledger.fila_de('A-2'), ledger.fila_de('B-1')) == (2, None, 3)
+    assert [c.fila for c in ledger.pendientes] == [2, 3]
+
+
+def test_fila_desconocida_invalida_en_vez_de_adivinar(cargar):
+    ledger, _ = cargar(_cuota('A-1'))
+    ledger.eliminar_fila(9)
+    assert ledger.vencido()
+
+
+def test_compactar_borra_tramos_en_un_solo_batch(cargar):
+    ledger, hoja = cargar(_cuota('A-1'), _cuota('A-2'), _cuota('B-1'), _cuota('C-1'), _cuota('C-2'))
+    for fila in (2, 3, 5):
+        hoja.pestanas['Deuda Pendiente'][fila - 1][7] = main.ESTADO_LAPIDA
+        ledger.actualizar_estado(fila, main.ESTADO_LAPIDA)
+
+    assert ledger.compactar(hoja, hoja.sheet_ids['Deuda Pendiente']) == 3
+    assert len(hoja.escrituras) == 1
+    rangos = [r['deleteDimension']['range'] for r in hoja.escrituras[0]['requests']]
+    assert [(r['startIndex'], r['endIndex']) for r in rangos] == [(4, 5), (1, 3)]
+
+    # La copia en memoria y la hoja quedan con las mismas filas
+    assert [row[1] for row in hoja.pestanas['Deuda Pendiente'][1:]] == ['B-1', 'C-2']
+    assert (ledger.fila_de('B-1'), ledger.fila_de('C-2')) == (2, 3)
+    assert ledger.lapidas() == []
+
+
+def test_compactar_respeta_ediciones_manuales(cargar):
+    ledger, hoja = cargar(_cuota('A-1'), _cuota('A-2'))
+    ledger.actualizar_estado(2, main.ESTADO_LAPIDA)
+    # En la hoja alguien la volvió a dejar PENDIENTE: compactar relee y no la borra
+    assert ledger.compactar(hoja, hoja.sheet_ids['Deuda Pendiente']) == 0
+    assert hoja.escrituras == []
+    assert ledger.fila_de('A-1') == 2
+
+
+def test_plan_sin_ledger_local_agenda_la_compactacion(hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'COMPACTACION_INACTIVIDAD', 0.05)
+    monkeypatch.setattr(main, '_LEDGERS', {})
+    monkeypatch.setattr(main, '_ULTIMA_COMPACTACION', {})
+    hoja = hoja_falsa(deuda=[_cuota('A-1'), _cuota('A-2'), _cuota('B-1')])
+    ledger = main.obtener_ledger('hoja-sin-espejo')
+    ledger.asegurar(hoja)
+
+    for cuota_id in ('A-1', 'B-1'):
+        plan = main.PlanEscrituras(hoja.sheet_ids, 'hoja-sin-espejo', compactar_luego=True)
+        plan.marcar_pagada(cuota_id, 'Deuda Pendiente', ledger.fila_de(cuota_id))
+        plan.ejecutar(hoja)
+    assert ledger.lapidas() == [2, 4]
+
+    # Una sola compactación para las dos lápidas, al rato de la última
+    fin = time.monotonic() + 5
+    while ledger.lapidas() and time.monotonic() < fin:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert [fila[1] for fila in hoja.pestanas['Deuda Pendiente'][1:]] == ['A-2']
+    assert ledger.stats["compactaciones"] == 1
+    assert ledger.fila_de('A-2') == 2
@@ -0,0 +1,136 @@
+import time
+import uuid
+
+import pytest
+
+import main
+
+
+def _cuota(cuota_id, pendiente, estado='PENDIENTE', total=300000):
+    return ['2025-01-01', cuota_id, total, pendiente, 100000, '2025-02-01', 'Cuota', estado]
+
+
+@pytest.fixture
+def ledger_local(tmp_path):
+    spreadsheet_id = f'hoja-{uuid.uuid4().hex[:8]}'
+    return main.LedgerLocal(spreadsheet_id, str(tmp_path / 'ledger.sqlite3'))
+
+
+def _pendientes(ledger):
+    return {c.cuota_id: c.monto_pendiente for c in ledger.cuotas_pendientes()}
+
+
+def test_importar_omite_lapidas(ledger_local, hoja_falsa):
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000), _cuota('A-2', 0, estado=main.ESTADO_LAPIDA)])
+    ledger_local.importar_desde_hojas(hoja)
+    assert _pendientes(ledger_local) == {'A-1': 100000}
+
+
+def test_reconciliar_incorpora_ediciones_manuales(ledger_local, hoja_falsa):
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000), _cuota('A-2', 100000), _cuota('A-3', 100000)],
+                      historial=[['2025-01-05', 'A-0', 'Pago Completo', 100000, 0, '']])
+    ledger_local.importar_desde_hojas(hoja)
+    orden_a1 = ledger_local.buscar_cuota('A-1').fila
+
+    # A mano: cambia un saldo, borra una fila y agrega otra
+    hoja.pestanas['Deuda Pendiente'][1][3] = 40000
+    del hoja.pestanas['Deuda Pendiente'][2]
+    hoja.pestanas['Deuda Pendiente'].append(_cuota('B-1', 50000))
+    hoja.pestanas['Historial de Pagos'].append(['2025-01-06', 'A-1', 'Abono', 60000, 40000, ''])
+
+    assert ledger_local.reconciliar(hoja) == 3
+    assert _pendientes(ledger_local) == {'A-1': 40000, 'A-3': 100000, 'B-1': 50000}
+    assert ledger_local.buscar_cuota('A-1').fila == orden_a1
+    assert ledger_local.totales_historial()['num_transacciones'] == 2
+    assert ledger_local.stats['cambios_externos'] == 3
+
+
+def test_reconciliar_sin_cambios_no_toca_nada(ledger_local, hoja_falsa):
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    ledger_local.importar_desde_hojas(hoja)
+    assert ledger_local.reconciliar(hoja) == 0
+
+
+def test_reconciliar_espera_a_que_se_replique_la_cola(ledger_local, hoja_falsa):
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    ledger_local.importar_desde_hojas(hoja)
+    plan = main.PlanLocal(ledger_local)
+    plan.actualizar_celda('A-1', 'Deuda Pendiente', ledger_local.buscar_cuota('A-1').fila, 3, 70000)
+    plan.ejecutar()
+    lecturas = hoja.lecturas
+
+    # La hoja todavía no tiene el abono: reconciliar ahora lo pisaría
+    assert ledger_local.reconciliar(hoja) == 0
+    assert hoja.lecturas == lecturas
+    assert _pendientes(ledger_local) == {'A-1': 70000}
+
+
+def test_agentes_leen_su_propio_spreadsheet(hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'LEDGER_LOCAL', False)
+    monkeypatch.setattr(main, 'SPREADSHEET_ID', 'global-de-otro-usuario')
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    spreadsheet_id = f'hoja-{uuid.uuid4().hex[:8]}'
+
+    fechas = main.Planificador(hoja, spreadsheet_id)._obtener_fechas_ocupadas()
+    assert sum(fechas.values()) == 1
+    assert hoja.spreadsheets_leidos == [spreadsheet_id]
+
+
+def _esperar(condicion, limite=5.0):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin and not condicion():
+        time.sleep(0.01)
+    return condicion()
+
+
+def test_sin_uso_no_se_reconcilia(ledger_local, hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'LEDGER_RECONCILIAR', 0.01)
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    ledger_local.importar_desde_hojas(hoja)
+    espejo = ledger_local.espejo
+    espejo._servicio = hoja
+    espejo._ultimo_uso = time.monotonic()
+    espejo._ultima_reconciliacion = time.monotonic()
+    time.sleep(0.02)
+    assert not espejo._toca_reconciliar()
+
+    # Un acceso posterior (asegurar -> configurar) la vuelve a habilitar
+    espejo._ultimo_uso = time.monotonic()
+    assert espejo._toca_reconciliar()
+
+
+def test_espejo_se_detiene_inactivo_y_vuelve_con_una_escritura(ledger_local, hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'ESPEJO_INACTIVIDAD', 0.05)
+    monkeypatch.setattr(main, 'ESPEJO_INTERVALO', 0.01)
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    espejo = ledger_local.espejo
+    try:
+        ledger_local.asegurar(hoja)
+        assert _esperar(lambda: espejo._hilo is None)
+        assert espejo.stats["detenciones_por_inactividad"] == 1
+        lecturas = hoja.lecturas
+        time.sleep(0.1)
+        assert hoja.lecturas == lecturas  # detenido no relee la hoja
+
+        plan = main.PlanLocal(ledger_local)
+        plan.actualizar_celda('A-1', 'Deuda Pendiente', ledger_local.buscar_cuota('A-1').fila, 3, 70000)
+        plan.ejecutar()
+        assert _esperar(lambda: not ledger_local.operaciones_en_cola(1))
+        assert hoja.escrituras
+        assert _esperar(lambda: espejo._hilo is None)
+    finally:
+        espejo.detener(timeout=5)
+
+
+def test_metricas_agregadas_sin_ids_de_hoja(tmp_path, hoja_falsa, monkeypatch):
+    ledgers = {}
+    for n, cuotas in enumerate([[_cuota('A-1', 100000)], [_cuota('B-1', 100000), _cuota('B-2', 50000)]]):
+        ledger = main.LedgerLocal(f'hoja-secreta-{n}', str(tmp_path / f'{n}.sqlite3'))
+        ledger.importar_desde_hojas(hoja_falsa(deuda=cuotas))
+        ledgers[ledger.spreadsheet_id] = ledger
+    monkeypatch.setattr(main, '_LEDGERS_LOCALES', ledgers)
+
+    metricas = main.obtener_estadisticas_ledger_local()
+    assert (metricas["hojas"], metricas["cuotas"]) == (2, 3)
+    assert metricas["espejo"]["activo"] == 0
+    assert 'hoja-secreta' not in repr(metricas)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+class _Servicio:
+    """Servicio de Google como los que server.py crea en cada mensaje: objeto nuevo, mismas credenciales."""
+
+    def __init__(self, refresh_token='r1'):
+        self._http = type('Http', (), {})()
+        self._http.credentials = type('Creds', (), {'client_id': 'c', 'refresh_token': refresh_token})()
+
+
+@pytest.fixture
+def construidos(monkeypatch):
+    registro = []
+    monkeypatch.setattr(main, 'build', lambda *a, **kw: registro.append(object()) or registro[-1])
+    monkeypatch.setattr(main, '_CLIENTES_GOOGLE', main.ClientesPorHilo(maximo=2))
+    main.cerrar_ejecutor_google()
+    yield registro
+    main.cerrar_ejecutor_google()
+
+
+def _llamar(usuario, servicio):
+    async def correr():
+        main.USUARIO_ACTUAL.set(usuario)
+        return await main.llamar_google(servicio, lambda cliente: cliente)
+    return asyncio.run(correr())
+
+
+def test_mensajes_del_mismo_usuario_reutilizan_el_cliente(construidos, monkeypatch):
+    monkeypatch.setattr(main, 'GOOGLE_HILOS', 1)
+    clientes = {id(_llamar('ana', _Servicio())) for _ in range(20)}
+    assert len(clientes) == 1
+    assert len(construidos) == 1
+
+
+def test_cache_por_hilo_acotado(construidos, monkeypatch):
+    monkeypatch.setattr(main, 'GOOGLE_HILOS', 1)
+    for usuario in ('ana', 'beto', 'caro', 'ana'):
+        _llamar(usuario, _Servicio())
+    # 'ana' salió del LRU (tope 2) al entrar 'caro'
+    assert len(construidos) == 4
+
+
+def test_credenciales_nuevas_reconstruyen(construidos, monkeypatch):
+    monkeypatch.setattr(main, 'GOOGLE_HILOS', 1)
+    primero = _llamar('ana', _Servicio('r1'))
+    assert _llamar('ana', _Servicio('r2')) is not primero
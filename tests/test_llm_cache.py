@@ -0,0 +1,102 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    llm_cache = main.LLMCache(str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(main, 'LLM_CACHE', llm_cache)
+    return llm_cache
+
+
+@pytest.fixture
+def red(monkeypatch):
+    """Sustituye la llamada de red por respuestas en cola."""
+    respuestas = []
+    llamadas = []
+
+    async def falsa_red(system_prompt, user_prompt, config, **kwargs):
+        llamadas.append(user_prompt)
+        return respuestas.pop(0)
+
+    monkeypatch.setattr(main, '_call_openrouter_red', falsa_red)
+    return respuestas, llamadas
+
+
+def test_crear_la_cache_no_toca_el_disco(tmp_path):
+    path = tmp_path / 'cache.sqlite3'
+    llm_cache = main.LLMCache(str(path))
+    llm_cache.retener_prompts(['prompt'])
+    assert not path.exists()
+    assert llm_cache.get('x') is None
+    assert path.exists()
+
+
+def test_importar_main_no_crea_la_base_por_defecto():
+    assert not main.LLM_CACHE._abierta
+
+
+def test_retencion_de_prompts_se_aplica_al_abrir(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    anterior = main.LLMCache(path)
+    for prompt in ('viejo', 'vigente'):
+        clave, prompt_hash = main.LLMCache.clave(['m'], prompt, 'hola')
+        anterior.set(clave, prompt_hash, prompt)
+
+    nueva = main.LLMCache(path)
+    nueva.retener_prompts(['vigente'])
+    assert nueva.get(main.LLMCache.clave(['m'], 'vigente', 'hola')[0]) == 'vigente'
+    assert nueva.get(main.LLMCache.clave(['m'], 'viejo', 'hola')[0]) is None
+    filas = sqlite3.connect(path).execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+    assert filas == 1
+
+
+def test_clave_normaliza_espacios_pero_no_mayusculas():
+    assert main.LLMCache.clave(['m'], 'p', 'hola   mundo')[0] == main.LLMCache.clave(['m'], 'p', ' hola mundo ')[0]
+    assert main.LLMCache.clave(['m'], 'p', 'Hola')[0] != main.LLMCache.clave(['m'], 'p', 'hola')[0]
+
+
+def test_respuesta_invalida_no_se_cachea(cache, red):
+    respuestas, llamadas = red
+    respuestas.extend(['no sé', 'PAGAR'])
+
+    primera = asyncio.run(main.call_openrouter('p', 'pagué 10', usar_cache=True, validar=main._tiene_intencion))
+    segunda = asyncio.run(main.call_openrouter('p', 'pagué 10', usar_cache=True, validar=main._tiene_intencion))
+    tercera = asyncio.run(main.call_openrouter('p', 'pagué 10', usar_cache=True, validar=main._tiene_intencion))
+
+    assert (primera, segunda, tercera) == ('no sé', 'PAGAR', 'PAGAR')
+    assert len(llamadas) == 2
+
+
+def test_entrada_cacheada_invalida_se_descarta(cache, red):
+    respuestas, llamadas = red
+    clave, prompt_hash = main.LLMCache.clave(main.PERFILES_LLM['otro']['modelos'], 'p', 'texto')
+    cache.set(clave, prompt_hash, '{"intent": "NADA"')
+    respuestas.append('{"intent": "PAGAR", "numero_factura": "A1"}')
+
+    resultado = asyncio.run(main.call_openrouter(
+        'p', 'texto', usar_cache=True, validar=main.Organizador._es_respuesta_combinada_valida
+    ))
+    assert main.Organizador._interpretar_respuesta_combinada(resultado)[0] == 'PAGAR'
+    assert llamadas == ['texto']
+    assert cache.get(clave) == resultado
+
+
+def test_sin_validador_se_cachea_como_antes(cache, red):
+    respuestas, llamadas = red
+    respuestas.append('cualquier cosa')
+    asyncio.run(main.call_openrouter('p', 'x', usar_cache=True))
+    assert asyncio.run(main.call_openrouter('p', 'x', usar_cache=True)) == 'cualquier cosa'
+    assert len(llamadas) == 1
+
+
+def test_errores_no_se_cachean(cache, red):
+    respuestas, llamadas = red
+    respuestas.extend(['ERROR: caído', 'PAGAR'])
+    assert asyncio.run(main.call_openrouter('p', 'x', usar_cache=True)).startswith('ERROR:')
+    assert asyncio.run(main.call_openrouter('p', 'x', usar_cache=True)) == 'PAGAR'
+    assert len(llamadas) == 2
@@ -0,0 +1,76 @@
+from datetime import date
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def parser():
+    return main.ParserRapido()
+
+
+@pytest.mark.parametrize('texto, regla, data', [
+    ("Factura A123 por 150.000 vence en 15 días", 'planificar_dias',
+     {"numero_factura": 'A123', "monto_total": 150000.0, "dias_vencimiento": 15}),
+    ("registrar la factura #F7 por $2,500,000 que vence el 2025-12-25", 'planificar_fecha',
+     {"numero_factura": 'F7', "monto_total": 2500000.0, "fecha_vencimiento": '2025-12-25'}),
+    ("factura B2 por 80000 pesos", 'planificar_simple',
+     {"numero_factura": 'B2', "monto_total": 80000.0, "dias_vencimiento": None}),
+    ("pagué 50.000 de la cuota 2 de la factura A123", 'pagar',
+     {"numero_factura": 'A123', "monto_abono": 50000.0, "cuota_especifica": 2}),
+    ("Abone $30.000 a factura A123, cuota 3.", 'pagar',
+     {"numero_factura": 'A123', "monto_abono": 30000.0, "cuota_especifica": 3}),
+    ("ver factura A123", 'consulta_factura', {"numero_factura": 'A123'}),
+    ("¿Cuánto debo?", 'consulta_deudas', {}),
+    ("estadísticas", 'consulta_estadisticas', {}),
+])
+def test_comandos_conocidos_se_resuelven_sin_llm(parser, texto, regla, data):
+    resultado = parser.analizar(texto)
+    assert resultado["regla"] == regla
+    assert resultado["confianza"] == 1.0
+    assert {k: resultado["data"].get(k) for k in data} == data
+
+
+@pytest.mark.parametrize('texto', [
+    "factura A1 por 1500,50",            # monto ambiguo: ¿decimales o miles?
+    "factura A1 por 100 vence el 31 de febrero",  # fecha imposible
+    "hola, ¿me ayudas con mis cuentas?",  # sin regla
+])
+def test_casos_dudosos_van_al_llm(parser, texto):
+    assert parser.analizar(texto) is None
+    assert parser.stats["derivadas_llm"] == 1
+
+
+def test_umbral_configurable(parser):
+    assert parser.analizar("factura A1 por 1500,50", umbral=0.5)["data"]["monto_total"] == 1500.5
+
+
+def test_estadisticas_por_regla(parser):
+    parser.analizar("ver factura A1")
+    parser.analizar("factura A1 por 10,5")
+    parser.analizar("algo libre")
+    stats = parser.estadisticas()
+    assert (stats["consultas"], stats["resueltas"], stats["sin_regla"]) == (3, 1, 1)
+    assert stats["hits_por_regla"]["consulta_factura"] == 1
+    assert stats["baja_confianza_por_regla"]["planificar_simple"] == 1
+    assert stats["tasa_resueltas"] == round(1 / 3, 3)
+
+
+@pytest.mark.parametrize('texto, esperado', [
+    ('150.000', (150000.0, False)),
+    ('150,000', (150000.0, False)),
+    ('1500', (1500.0, False)),
+    ('1500.50', (1500.5, True)),
+    ('1.2.3', (None, True)),
+])
+def test_parsear_monto(texto, esperado):
+    assert main._parsear_monto(texto) == esperado
+
+
+def test_fecha_sin_anio_pasa_al_siguiente_si_ya_paso():
+    hoy = date(2025, 6, 15)
+    assert main._parsear_fecha_texto('25 de diciembre', hoy) == '2025-12-25'
+    assert main._parsear_fecha_texto('1 de marzo', hoy) == '2026-03-01'
+    assert main._parsear_fecha_texto('25/12/2025', hoy) == '2025-12-25'
+    assert main._parsear_fecha_texto('mañana', hoy) is None
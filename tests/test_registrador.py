@@ -0,0 +1,33 @@
+import asyncio
+import uuid
+
+import main
+
+
+def _cuota(cuota_id, pendiente, estado='PENDIENTE', total=300000):
+    return ['2025-01-01', cuota_id, total, pendiente, 100000, '2025-02-01', 'Cuota', estado]
+
+
+def test_crear_registrador_no_llama_a_google(hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'LEDGER_LOCAL', False)
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    main.Registrador(hoja, f'hoja-{uuid.uuid4().hex[:8]}')
+    assert (hoja.metadatos, hoja.lecturas) == (0, 0)
+
+
+def test_preparar_carga_una_vez_y_cachea_pestanas_por_spreadsheet(hoja_falsa, monkeypatch):
+    monkeypatch.setattr(main, 'LEDGER_LOCAL', False)
+    hoja = hoja_falsa(deuda=[_cuota('A-1', 100000)])
+    spreadsheet_id = f'hoja-{uuid.uuid4().hex[:8]}'
+
+    async def preparar_dos():
+        # Como en server.py: un runtime (y un Registrador) por mensaje
+        for _ in range(2):
+            registrador = main.Registrador(hoja, spreadsheet_id)
+            await asyncio.gather(registrador._preparar(), registrador._preparar())
+        return registrador
+
+    registrador = asyncio.run(preparar_dos())
+    assert registrador.sheet_ids == hoja.sheet_ids
+    assert registrador.facturas_existentes == {'A-1': {"monto_pendiente": 100000.0, "estado": 'PENDIENTE'}}
+    assert hoja.metadatos == 1
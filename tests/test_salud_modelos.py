@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def salud(monkeypatch):
+    registro = main.RegistroSaludModelos()
+    monkeypatch.setattr(main, 'SALUD_MODELOS', registro)
+    return registro
+
+
+@pytest.fixture
+def sin_admision(monkeypatch):
+    monkeypatch.setattr(main, 'ADMISION', main.ControlAdmision(tasa=1000, rafaga=1000, cola_max=100))
+
+
+def _abrir(registro, model_name):
+    for _ in range(main.CB_UMBRAL_FALLOS):
+        registro.registrar(model_name, 'siguiente', 1.0)
+
+
+def test_circuito_abre_tras_umbral_de_fallos(salud):
+    for _ in range(main.CB_UMBRAL_FALLOS - 1):
+        salud.registrar('a', 'siguiente', 1.0)
+    assert salud.permitir('a')
+    salud.registrar('a', 'siguiente', 1.0)
+    assert salud.estado()['modelos']['a']['circuito'] == 'abierto'
+    assert not salud.permitir('a')
+
+
+def test_semiabierto_deja_una_sola_sonda_y_cierra_con_exito(salud, monkeypatch):
+    _abrir(salud, 'a')
+    monkeypatch.setattr(main, 'CB_ENFRIAMIENTO', 0)
+    salud._modelos['a']['abierto_hasta'] = 0.0
+
+    assert salud.permitir('a')
+    assert not salud.permitir('a')
+    salud.registrar('a', 'ok', 0.5)
+    assert salud.estado()['modelos']['a']['circuito'] == 'cerrado'
+    assert salud.permitir('a')
+
+
+def test_fallo_en_semiabierto_vuelve_a_abrir(salud):
+    _abrir(salud, 'a')
+    salud._modelos['a']['abierto_hasta'] = 0.0
+    assert salud.permitir('a')
+    salud.registrar('a', 'reintentar', 1.0)
+    assert salud.estado()['modelos']['a']['circuito'] == 'abierto'
+
+
+def test_liberar_sonda_permite_otra_prueba(salud):
+    _abrir(salud, 'a')
+    salud._modelos['a']['abierto_hasta'] = 0.0
+    assert salud.permitir('a')
+    salud.liberar_sonda('a')
+    assert salud.permitir('a')
+    assert salud.estado()['modelos']['a']['errores'] == main.CB_UMBRAL_FALLOS
+
+
+def test_ordenar_por_latencia_y_abiertos_al_final(salud):
+    salud.registrar('lento', 'ok', 5.0)
+    salud.registrar('rapido', 'ok', 0.5)
+    _abrir(salud, 'caido')
+    assert salud.ordenar(['caido', 'lento', 'rapido']) == ['rapido', 'lento', 'caido']
+
+
+def test_hedge_perdedor_cancelado_no_cuenta_como_error(salud, sin_admision, monkeypatch):
+    async def falso_http(model_name, *args, **kwargs):
+        await asyncio.sleep(0.01 if model_name == 'rapido' else 5)
+        return 'ok', model_name
+
+    monkeypatch.setattr(main, '_intentar_modelo_http', falso_http)
+    monkeypatch.setattr(main, 'OPENROUTER_MODO', 'fanout')
+    monkeypatch.setattr(main, 'HEDGE_FANOUT', 2)
+
+    async def rondas():
+        for _ in range(main.CB_UMBRAL_FALLOS + 1):
+            assert await main._ronda_hedged(['lento', 'rapido'], {}, {}) == ('ok', 'rapido')
+        await asyncio.sleep(0)
+
+    asyncio.run(rondas())
+    lento = salud.estado()['modelos']['lento']
+    assert lento['errores'] == 0
+    assert lento['tasa_error_ewma'] == 0.0
+    assert lento['circuito'] == 'cerrado'
+
+
+def test_hedge_no_reserva_sonda_de_modelos_no_lanzados(salud, sin_admision, monkeypatch):
+    async def falso_http(model_name, *args, **kwargs):
+        return 'ok', model_name
+
+    monkeypatch.setattr(main, '_intentar_modelo_http', falso_http)
+    monkeypatch.setattr(main, 'OPENROUTER_MODO', 'hedged')
+    _abrir(salud, 'respaldo')
+    salud._modelos['respaldo']['abierto_hasta'] = 0.0
+
+    assert asyncio.run(main._ronda_hedged(['principal', 'respaldo'], {}, {})) == ('ok', 'principal')
+    assert salud._modelos['respaldo']['sonda_hasta'] == 0.0
+    assert salud.permitir('respaldo')
+
+
+def test_hedge_con_todos_abiertos_lanza_el_primero(salud, sin_admision, monkeypatch):
+    lanzados = []
+
+    async def falso_http(model_name, *args, **kwargs):
+        lanzados.append(model_name)
+        return 'ok', model_name
+
+    monkeypatch.setattr(main, '_intentar_modelo_http', falso_http)
+    _abrir(salud, 'a')
+    _abrir(salud, 'b')
+
+    assert asyncio.run(main._ronda_hedged(['a', 'b'], {}, {})) == ('ok', 'a')
+    assert lanzados == ['a']